@@ -39,6 +39,11 @@ def main():
                     program.load(tokenlist[1].val)
                     print('Program loaded')
                 
+                # Merge program lines from a file
+                elif tokenlist[0].cat == Token.MERGE:
+                    program.merge(tokenlist[1].val)
+                    print('Program merged')
+                
                 # Add new statement
                 elif tokenlist[0].cat == Token.UNSIGNEDINT and len(tokenlist) > 1:
                     program.add_stmt(tokenlist)
@@ -86,9 +91,39 @@ def main():
                     elif len(tokenlist) == 4:
                         # if there are 4 tokens, assume RENUM x-y
                         program.renum(int(tokenlist[1].val), int(tokenlist[3].val))
+                    elif len(tokenlist) in (5, 6) and tokenlist[4].val == '-':
+                        # RENUM x y a-b renumbers lines a to b, or to the 
+                        # end of the program if b is left out
+                        last = int(tokenlist[5].val) \
+                                if len(tokenlist) == 6 else None
+                        program.renum(int(tokenlist[1].val), 
+                                int(tokenlist[2].val), 
+                                int(tokenlist[3].val), last)
                     else:
                         program.renum()
                 
+                # Report the memory used by variables and the program
+                elif tokenlist[0].cat == Token.MEM:
+                    program.memory_report()
+                
+                # Set breakpoints, watch variables or trace execution
+                elif program.debugger.command(tokenlist):
+                    pass
+                
+                # Run the program, stopping before the first line
+                elif tokenlist[0].cat == Token.STEP:
+                    program.debugger.stepping = True
+                    try:
+                        program.run()
+                    except KeyboardInterrupt:
+                        print('Program terminated')
+                    finally:
+                        program.debugger.stepping = False
+                
+                # A stopped program is continued at its prompt
+                elif tokenlist[0].cat == Token.CONT:
+                    print("Can't continue", file=stderr)
+                
                 # Save the program
                 elif tokenlist[0].cat == Token.SAVE:
                     program.save(tokenlist[1].val)
@@ -96,8 +131,11 @@ def main():
                 
                 # Run the program
                 elif tokenlist[0].cat == Token.RUN:
+                    # RUN VERBOSE also lists the optimisations made
+                    verbose = len(tokenlist) > 1 and \
+                            tokenlist[1].val == 'VERBOSE'
                     try:
-                        program.run()
+                        program.run(verbose)
                     except KeyboardInterrupt:
                         print('Program terminated')
                 
@@ -0,0 +1,2649 @@
+from tokens import Token
+from message import Msg, jump_msg, return_msg
+from functions import function_table, UserFunction, default_cache_size, \
+        mid_replace, to_integer
+from math import pi
+import operator
+
+
+# Relational operators
+relational = (Token.ASSIGNOP, Token.EQUAL, Token.NOTEQUAL, Token.LESSER,
+    Token.GREATER, Token.LESSEQUAL, Token.GREATEQUAL)
+
+
+# Kinds of numeric value
+numeric = ('int', 'float', 'num')
+
+
+class Node:
+    '''A compiled expression.  Constant expressions hold their value,
+    which was calculated when the program was compiled.  All other
+    expressions hold a closure that calculates the value when called.
+    
+    The kind of value is inferred from literals, the $ suffix of variable
+    names and the operations applied: one of 'int', 'float', 'num' (either
+    int or float), 'str', or None where it cannot be determined.
+    '''
+    
+    def __init__(self, fn=None, value=None, kind=None, name=None):
+        self.fn = fn        # Closure returning the value, None if constant
+        self.value = value  # Value of a constant expression
+        self.kind = kind    # Kind of value, see above
+        self.name = name    # Variable name, if a simple variable
+        self.op = None      # Operator, if a binary operation
+        self.args = None    # Left and right operands of the operation
+        self.element = None # Array name and index, if a 1-D array element
+        
+        if fn == None:
+            self.kind = kind_of(value)
+    
+    
+    def is_const(self):
+        return self.fn == None
+    
+    
+    def closure(self):
+        '''Returns a closure that calculates the value of the expression.'''
+        
+        if self.fn == None:
+            value = self.value
+            def constant():
+                return value
+            return constant
+        
+        return self.fn
+
+
+class Selection:
+    '''A SELECT CASE statement being compiled.  Each CASE value that is a
+    constant is entered in a table giving the message which enters its
+    block, so that it is found with a single lookup however many cases
+    there are.  Ranges, and values only known at run time, are tested in
+    order, but only those that come before any constant case found.
+    '''
+    
+    def __init__(self, line_num, depth):
+        self.line_num = line_num  # Line of the SELECT CASE statement
+        self.depth = depth        # Number of loops open at the SELECT
+        self.table = {}           # Constant value -> (position, message)
+        self.tests = []           # (position, test, message) in order
+        self.positions = 0        # Number of CASE values so far
+        self.default = None       # Message entering CASE ELSE, if any
+        
+        # Message leaving the SELECT, the target is set at END SELECT
+        self.leave = Msg(target=line_num, type=Msg.JUMP_PAST)
+        
+        # Message used when no case matches
+        self.otherwise = self.leave
+
+
+class Compiler:
+    '''Compiles the lines of a BASIC program into Python closures, so that
+    the tokens of a statement are only parsed once rather than every time
+    the statement is executed.
+    
+    Whilst compiling, expressions made up only of constants are evaluated
+    (constant folding), IF statements with constant conditions are reduced
+    to the branch that will be taken, and statements that can never be
+    reached are removed.  A description of each change is kept in the
+    report list.
+    
+    Statements that the compiler does not handle are left to the parser,
+    which will process them at run time as usual.
+    
+    The compiler is kept between runs of the program, and a line that has
+    not changed since it was last compiled is reused, unless its compiled
+    form depends on other lines (see compile_line()).
+    '''
+    
+    def __init__(self, parser, profile=False):
+        self.parser = parser
+        self.symbol_table = parser.symbol_table
+        
+        # Compiled lines that may be reused, by line number, as
+        # (tokens, closure, facts), from this pass and the one before
+        self.cache = {}
+        self.previous = {}
+        
+        # Number of times each superinstruction was executed, if profiling.
+        # Kept as the closures that count executions refer to it
+        self.profile = profile
+        self.executed = dict.fromkeys(superinstructions, 0)
+        
+        # Statement compiler for each statement keyword
+        self.stmt_compilers = {
+            Token.NAME: self.assignmentstmt,
+            Token.LET: self.letstmt,
+            Token.PRINT: self.printstmt,
+            Token.GOTO: self.gotostmt,
+            Token.GOSUB: self.gosubstmt,
+            Token.RETURN: self.returnstmt,
+            Token.IF: self.ifstmt,
+            Token.FOR: self.forstmt,
+            Token.NEXT: self.nextstmt,
+            Token.ON: self.ongosubstmt,
+            Token.REM: self.remstmt,
+            Token.DATA: self.remstmt,
+            Token.FN: self.assignmentstmt,
+            Token.DEF: self.defstmt,
+            Token.FNEND: self.fnendstmt,
+            Token.WHILE: self.whilestmt,
+            Token.WEND: self.wendstmt,
+            Token.DO: self.dostmt,
+            Token.LOOP: self.loopstmt,
+            Token.EXIT: self.exitstmt,
+            Token.SELECT: self.selectstmt,
+            Token.CASE: self.casestmt,
+            Token.STOP: self.stopstmt,
+            Token.MID: self.midassignmentstmt,
+            }
+        
+        self.begin(profile)
+    
+    
+    def begin(self, profile=False):
+        '''Prepares to compile the program, from its first line.'''
+        
+        # Lines compiled with profiling cannot be reused without, and vice
+        # versa
+        if profile != self.profile:
+            self.cache.clear()
+            self.profile = profile
+        
+        self.previous = self.cache
+        self.cache = {}
+        for name in self.executed:
+            self.executed[name] = 0
+        
+        # Descriptions of the changes made whilst compiling
+        self.report = []
+        
+        # Number of times each superinstruction was compiled
+        self.compiled = dict.fromkeys(superinstructions, 0)
+        
+        # Line numbers targeted by jumps, including the return points
+        # following subroutine calls
+        self.targets = set()
+        
+        # Set when a jump target can only be calculated at run time,
+        # in which case any line may be a target
+        self.dynamic_jumps = False
+        
+        # Lines which always branch elsewhere (e.g. end in a GOTO)
+        self.terminal_lines = set()
+        
+        # Lines containing no executable statements (e.g. REM)
+        self.noop_lines = set()
+        
+        # Lines containing a subroutine call
+        self.gosub_lines = set()
+        
+        # Lines containing a NEXT statement
+        self.next_lines = set()
+        
+        # The multi-line function (DEF FN ... FNEND) being compiled, if any
+        self.open_function = None
+        
+        # Lines making up the bodies of multi-line functions, which are only
+        # executed when the function is called
+        self.function_lines = set()
+        
+        # Each multi-line function, with a list of the lines of its body
+        self.multiline_functions = []
+        
+        # The WHILE and DO loops whose ends have not yet been compiled, as
+        # (keyword, line number, exit message), innermost last
+        self.loops = []
+        
+        # Lines ending a WHILE or DO loop, and CASE and END SELECT lines,
+        # which are kept as execution continues after them following a jump
+        self.continue_lines = set()
+        
+        # The SELECT CASE statements whose END SELECT has not yet been
+        # compiled, innermost last
+        self.selects = []
+    
+    
+    def compile_line(self, line_num, tokenlist):
+        '''Compiles a program line, returning a closure that executes it.
+        Like Parser.parse(), the closure returns None or a message object
+        to indicate any branching necessary.
+        
+        The closure compiled for the same tokens in the last pass is
+        reused, along with the facts about the line used to find the lines
+        that need executing, unless the line defines a function, is part of
+        a multi-line function or contains a structured statement, which are
+        compiled together with their other lines.  Nor is it reused while a
+        multi-line function is open, as a line compiled outside a function
+        may since have been put inside one.  A jump is compiled the
+        same whichever line it targets, so changing a line does not mean
+        compiling the lines that jump to it.
+        
+        >>> from program import Program
+        >>> from scanner import Scanner
+        >>> program = Program()
+        >>> def enter(*lines):
+        ...     for line in lines:
+        ...         program.add_stmt(Scanner().tokenise(line))
+        >>> enter('10 PRINT "START"', '20 PRINT "BODY"', '30 R = 7', 
+        ...         '50 PRINT "END"')
+        >>> program.run()
+        START
+        BODY
+        END
+        >>> enter('15 DEF FNA(Y)', '35 FNEND', '40 PRINT "CALL": PRINT FNA(1)')
+        >>> program.run()
+        START
+        CALL
+        BODY
+        0
+        END
+        '''
+        
+        cached = self.previous.get(line_num)
+        if cached != None and cached[0] is tokenlist and \
+                self.open_function == None:
+            self.cache[line_num] = cached
+            self.add_facts(line_num, cached[2])
+            return cached[1]
+        
+        reusable = self.open_function == None and \
+                not any(token.cat in structured for token in tokenlist)
+        
+        # Collect the line's jump targets and notes separately, to keep 
+        # with it
+        targets, dynamic_jumps, compiled = self.targets, self.dynamic_jumps, \
+                self.compiled
+        self.targets = set()
+        self.dynamic_jumps = False
+        self.compiled = dict.fromkeys(superinstructions, 0)
+        notes = len(self.report)
+        
+        try:
+            code = self.compile_tokens(line_num, tokenlist)
+            facts = (self.targets, self.dynamic_jumps, self.compiled, 
+                    self.report[notes:], line_num in self.terminal_lines, 
+                    line_num in self.noop_lines, line_num in self.gosub_lines, 
+                    line_num in self.next_lines)
+        
+        finally:
+            self.targets, self.dynamic_jumps, self.compiled = targets, \
+                    dynamic_jumps, compiled
+            del self.report[notes:]
+        
+        self.add_facts(line_num, facts)
+        if reusable:
+            self.cache[line_num] = (tokenlist, code, facts)
+        
+        return code
+    
+    
+    def add_facts(self, line_num, facts):
+        '''Adds the facts found when compiling a line to those for the 
+        program.
+        '''
+        
+        targets, dynamic_jumps, compiled, notes, terminal, noop, gosub, \
+                next_line = facts
+        
+        self.targets.update(targets)
+        self.dynamic_jumps = self.dynamic_jumps or dynamic_jumps
+        for name, count in compiled.items():
+            self.compiled[name] += count
+        self.report.extend(notes)
+        
+        if terminal:
+            self.terminal_lines.add(line_num)
+        if noop:
+            self.noop_lines.add(line_num)
+        if gosub:
+            self.gosub_lines.add(line_num)
+        if next_line:
+            self.next_lines.add(line_num)
+    
+    
+    def compile_tokens(self, line_num, tokenlist):
+        '''Compiles the tokens of a program line.'''
+        
+        self.line_num = line_num
+        self.line_tokens = tokenlist
+        
+        if tokenlist[0].cat == Token.NEXT:
+            self.next_lines.add(line_num)
+        
+        function = self.open_function
+        if function != None:
+            self.function_lines.add(line_num)
+            self.multiline_functions[-1][1].append(line_num)
+        
+        try:
+            code, terminal = self.block(tokenlist, 0)
+        
+        except Exception:
+            # Leave the whole line to the parser
+            code, terminal = self.fallback(tokenlist)
+        
+        if function != None and tokenlist[0].cat == Token.FNEND:
+            self.open_function = None
+        
+        if terminal:
+            self.terminal_lines.add(line_num)
+        
+        if code == None:
+            self.noop_lines.add(line_num)
+            def code():
+                return None
+        
+        return code
+    
+    
+    def reachable(self, line_nums, flowing=None):
+        '''Given the sorted line numbers of the compiled program, returns
+        the line numbers that need to be executed.  Lines that cannot be
+        reached, and lines without executable statements that are not jump
+        targets, are left out.  If given, flowing is the set of lines that
+        the program's flow graph shows may be reached from its start, and
+        any other lines are left out too.
+        '''
+        
+        # A jump calculated at run time could land on any line
+        if self.dynamic_jumps or len(line_nums) == 0:
+            return list(line_nums)
+        
+        # Execution continues at the line following a subroutine call,
+        # the end of a loop when it is left, and CASE and END SELECT lines
+        targets = set(self.targets)
+        for index in range(len(line_nums) - 1):
+            if line_nums[index] in self.gosub_lines or \
+                    line_nums[index] in self.continue_lines:
+                targets.add(line_nums[index + 1])
+        
+        # Lines can only be reached from the previous line or by a jump
+        reached = []
+        unreachable = []
+        skipped = 0
+        live = True
+        for line_num in line_nums:
+            # Function bodies are not part of the main flow of the program
+            if line_num in self.function_lines:
+                continue
+            
+            if line_num in targets:
+                live = True
+            
+            if not live or (flowing != None and line_num not in flowing):
+                # NEXT statements are kept, as skipped loops search for them,
+                # as are the ends of loops and the lines of SELECT CASE, which
+                # are the targets of jumps
+                if line_num in self.next_lines or \
+                        line_num in self.continue_lines:
+                    reached.append(line_num)
+                elif line_num in self.noop_lines:
+                    skipped += 1
+                else:
+                    unreachable.append(line_num)
+                continue
+            
+            if line_num in self.noop_lines and line_num not in targets and \
+                    line_num not in self.continue_lines:
+                skipped += 1
+            else:
+                reached.append(line_num)
+            
+            if line_num in self.terminal_lines:
+                live = False
+        
+        for line_num in unreachable:
+            self.note(line_num, 'line can never be reached, removed')
+        
+        if skipped:
+            self.report.append(str(skipped) + ' line(s) without executable ' + \
+                    'statements skipped')
+        
+        return reached
+    
+    
+    def block(self, tokens, index):
+        '''Compiles the colon separated statements starting at the given
+        index.  As in Parser.parse(), an IF statement takes the rest of the
+        tokens and an ELSE (other than in an OPEN or CASE statement) ends the
+        block.
+        Returns the compiled closure (None if there is nothing to execute)
+        and whether the block always branches elsewhere.
+        '''
+        
+        statements = []
+        start = index
+        while index < len(tokens):
+            token = tokens[index]
+            if token.cat == Token.IF:
+                if index != start:
+                    raise SyntaxError('IF within statement')
+                statements.append(tokens[start:])
+                start = len(tokens)
+                break
+            
+            elif token.cat == Token.COLON:
+                statements.append(tokens[start:index])
+                start = index + 1
+            
+            elif token.cat == Token.ELSE and \
+                    tokens[start].cat not in (Token.OPEN, Token.CASE):
+                break
+            
+            index += 1
+        
+        if start < len(tokens):
+            statements.append(tokens[start:index])
+        
+        codes = []
+        terminal = False
+        for statement in statements:
+            if len(statement) == 0:
+                raise SyntaxError('Empty statement')
+            
+            if terminal:
+                self.note(self.line_num, 'statements following ' + \
+                        text(statements[len(codes)-1][:1]) + \
+                        'can never be executed, removed')
+                break
+            
+            code, terminal = self.statement(statement)
+            codes.append(code)
+        
+        codes = [code for code in codes if code != None]
+        if len(codes) == 0:
+            return None, terminal
+        
+        elif len(codes) == 1:
+            return codes[0], terminal
+        
+        def block():
+            for code in codes:
+                flow = code()
+                if flow:
+                    return flow
+        
+        return block, terminal
+    
+    
+    def statement(self, tokens):
+        '''Compiles a single statement.'''
+        
+        compile_stmt = self.stmt_compilers.get(tokens[0].cat)
+        if compile_stmt == None:
+            return self.fallback(tokens)
+        
+        self.tokens = tokens
+        self.tokenindex = 0
+        self.token = tokens[0]
+        self.folds = []
+        
+        try:
+            code, terminal = compile_stmt()
+            
+            if self.tokenindex < len(self.tokens):
+                raise SyntaxError('Unexpected tokens at end of statement')
+        
+        except Exception:
+            return self.fallback(tokens)
+        
+        # Report the largest folded expressions only
+        for start, end, value in self.folds:
+            if not any(s <= start and end <= e and (s, e) != (start, end) \
+                    for s, e, v in self.folds):
+                self.note(self.line_num, 'folded ' + \
+                        text(tokens[start:end]) + 'to ' + repr_value(value))
+        
+        return code, terminal
+    
+    
+    def fallback(self, tokens):
+        '''Leaves the statement to be processed by the parser at run time.'''
+        
+        parser = self.parser
+        line_num = self.line_num
+        
+        # Record any jump targets
+        cats = [token.cat for token in tokens]
+        if Token.GOSUB in cats:
+            self.gosub_lines.add(line_num)
+        
+        if cats[0] == Token.OPEN and Token.ELSE in cats:
+            target = tokens[cats.index(Token.ELSE) + 1:]
+            if len(target) > 0 and target[0].cat == Token.GOTO:
+                target = target[1:]
+            
+            if len(target) == 1 and target[0].cat == Token.UNSIGNEDINT:
+                self.targets.add(int(target[0].val))
+            else:
+                self.dynamic_jumps = True
+        
+        elif any(cat in cats for cat in (Token.GOTO, Token.GOSUB, Token.THEN,
+                Token.ELSE)):
+            self.dynamic_jumps = True
+        
+        def interpret():
+            return parser.parse(line_num, tokens)
+        
+        return interpret, cats[0] == Token.STOP
+    
+    
+    def note(self, line_num, description):
+        self.report.append('Line ' + str(line_num) + ': ' + description)
+    
+    
+    def fuse(self, name, code):
+        '''Records the use of a superinstruction, a single closure that
+        replaces a common combination of operations.  When profiling, the
+        closure is wrapped so that its executions are counted.
+        '''
+        
+        self.compiled[name] += 1
+        if not self.profile:
+            return code
+        
+        executed = self.executed
+        def counted():
+            executed[name] += 1
+            return code()
+        return counted
+    
+    
+    def advance(self):
+        '''Advances to the next token.'''
+        
+        self.tokenindex += 1
+        if self.tokenindex < len(self.tokens):
+            self.token = self.tokens[self.tokenindex]
+        else:
+            self.token = Token(None, Token.EOF, '')
+    
+    
+    def consume(self, expected_cat):
+        '''Consumes a token from the list.'''
+        
+        if self.token.cat == expected_cat:
+            self.advance()
+        else:
+            raise SyntaxError('Expecting ' + Token.catnames[expected_cat])
+    
+    
+    def jump(self, node, jump_type=Msg.SIMPLE_JUMP):
+        '''Returns a closure which returns a jump message for the target
+        line given by the compiled expression.
+        '''
+        
+        if node.is_const():
+            self.targets.add(node.value)
+            msg = Msg(target=node.value, type=jump_type)
+            def jump():
+                return msg
+            return jump
+        
+        self.dynamic_jumps = True
+        target = node.fn
+        def jump():
+            return jump_msg(target(), jump_type)
+        return jump
+    
+    
+    def remstmt(self):
+        '''Compiles REM and DATA statements, which do nothing when executed.'''
+        
+        self.tokenindex = len(self.tokens)
+        return None, False
+    
+    
+    def defstmt(self):
+        '''Compiles a DEF FN statement.  The function is defined now, so
+        that it can be called from anywhere in the program, and the
+        statement does nothing when executed.  A single line function is
+        given by an expression:
+        
+        DEF FNA(X, Y) = X * X + Y [CACHE [size]]
+        
+        A multi-line function takes the following lines up to FNEND, and
+        returns the value last assigned to its name:
+        
+        DEF FNA(X, Y) [CACHE [size]]
+        '''
+        
+        self.advance()  # Advance past DEF
+        
+        name = self.token.val
+        self.consume(Token.FN)
+        
+        params = []
+        if self.token.cat == Token.LEFTPAREN:
+            self.advance()  # Advance past left paren
+            params.append(self.token.val)
+            self.consume(Token.NAME)
+            
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                params.append(self.token.val)
+                self.consume(Token.NAME)
+            
+            self.consume(Token.RIGHTPAREN)
+        
+        body = None
+        if self.token.cat == Token.ASSIGNOP:
+            self.advance()  # Advance past =
+            node = self.logexpr()
+            if node.kind != None and \
+                    (node.kind == 'str') != name.endswith('$'):
+                raise SyntaxError('Type mismatch')
+            body = node.closure()
+        
+        cache_size = None
+        if self.token.cat == Token.CACHE:
+            self.advance()  # Advance past CACHE
+            cache_size = default_cache_size
+            if self.token.cat == Token.UNSIGNEDINT:
+                cache_size = int(self.token.val)
+                self.advance()
+            
+            if name.endswith('$'):
+                raise SyntaxError('CACHE is only allowed for numeric functions')
+        
+        if body != None:
+            self.parser.user_functions[name] = UserFunction(name, params,
+                    body, self.symbol_table, cache_size)
+            return None, False
+        
+        if self.open_function != None or \
+                len(self.tokens) != len(self.line_tokens) or \
+                self.tokenindex < len(self.tokens):
+            raise SyntaxError('Invalid multi-line function')
+        
+        # The body is attached by the program once compiled
+        self.open_function = UserFunction(name, params, None,
+                self.symbol_table, cache_size, multiline=True)
+        self.parser.user_functions[name] = self.open_function
+        self.multiline_functions.append((self.open_function, []))
+        return None, False
+    
+    
+    def fnendstmt(self):
+        '''Compiles the FNEND statement ending a multi-line function.'''
+        
+        if self.open_function == None:
+            raise SyntaxError('FNEND without DEF FN')
+        
+        self.advance()  # Advance past FNEND
+        return None, False
+    
+    
+    def letstmt(self):
+        '''Compiles a LET statement.'''
+        
+        self.advance()  # Advance past LET
+        return self.assignmentstmt()
+    
+    
+    def assignmentstmt(self):
+        '''Compiles an assignment to a simple variable, or an array or map
+        element.
+        '''
+        
+        left = self.token.val
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        self.advance()  # Advance past variable name
+        
+        if self.token.cat == Token.LEFTPAREN:
+            return self.arrayassignmentstmt(left)
+        
+        if self.token.cat == Token.LEFTBRACE:
+            return self.mapassignmentstmt(left)
+        
+        self.consume(Token.ASSIGNOP)
+        node = self.logexpr()
+        right = node.closure()
+        
+        # Leave assignments known to be of the wrong type to the parser,
+        # which will report the error when the statement is executed
+        if node.kind != None and (node.kind == 'str') != left.endswith('$'):
+            raise SyntaxError('Type mismatch')
+        
+        # I = I + K and I = I - K update the variable in place
+        if node.op in (Token.PLUS, Token.MINUS) and \
+                node.args[0].name == left and node.kind in numeric and \
+                node.args[1].is_const() and \
+                (node.kind == 'int' or not left.endswith('%')):
+            value = node.args[1].value
+            if node.op == Token.MINUS:
+                value = -value
+            
+            def increment():
+                try:
+                    symbol_table[left] += value
+                
+                except KeyError:
+                    raise RuntimeError('Name ' + left + ' is not defined' + \
+                            ' in line ' + str(line_num))
+            
+            return self.fuse('increment', increment), False
+        
+        # A$ = A$ + B$ extends the string in place
+        suffixes = appended(left, node)
+        if suffixes != None:
+            return self.fuse('string append',
+                    self.append(left, suffixes)), False
+        
+        if left.endswith('%'):
+            node = self.integer(node, 'variable')
+            right = node.closure()
+        
+        if node.is_const():
+            value = node.value
+            def assignment():
+                symbol_table[left] = value
+        
+        elif node.kind != None:
+            def assignment():
+                symbol_table[left] = right()
+        
+        elif left.endswith('$'):
+            def assignment():
+                value = right()
+                if not isinstance(value, str):
+                    raise SyntaxError('Syntax error: Attempt to assign ' + \
+                            'non-string to string variable in line ' + \
+                            str(line_num))
+                symbol_table[left] = value
+        
+        else:
+            def assignment():
+                value = right()
+                if isinstance(value, str):
+                    raise SyntaxError('Syntax error: Attempt to assign ' + \
+                            'string to numeric variable in line ' + \
+                            str(line_num))
+                symbol_table[left] = value
+        
+        return assignment, False
+    
+    
+    def integer(self, node, what):
+        '''Returns the expression converted for storage in an integer (%)
+        variable, array or map.  Expressions known to give integers need no
+        conversion, so are returned unchanged.
+        '''
+        
+        line_num = self.line_num
+        
+        if node.kind == 'int':
+            return node
+        
+        if node.is_const():
+            return Node(value=to_integer(line_num, node.value))
+        
+        fn = node.fn
+        def integer():
+            value = fn()
+            if isinstance(value, str):
+                raise SyntaxError('Attempt to assign string to numeric ' + \
+                        what + ' in line ' + str(line_num))
+            return to_integer(line_num, value)
+        
+        return Node(fn=integer, kind='int')
+    
+    
+    def append(self, name, suffixes):
+        '''Returns a closure appending the values of the suffix closures to
+        the string variable.  The string is removed from the symbol table
+        while it is extended, so that, holding the only reference to it,
+        CPython can resize it in place rather than copying it.  Building a
+        string by repeated appends then takes linear rather than quadratic
+        time.  The variable is put back even if the append fails.
+        
+        >>> from parser import Parser
+        >>> from program import BASICData
+        >>> from scanner import Scanner
+        >>> compiler = Compiler(Parser(BASICData()))
+        >>> append = compiler.compile_line(10, 
+        ...         Scanner().tokenise('A$ = A$ + "X"'))
+        >>> compiler.symbol_table['A$'] = 5
+        >>> append()
+        Traceback (most recent call last):
+            ...
+        TypeError: unsupported operand type(s) for +=: 'int' and 'str'
+        >>> compiler.symbol_table['A$']
+        5
+        '''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        
+        if len(suffixes) == 1:
+            suffix = suffixes[0]
+        else:
+            def suffix():
+                return ''.join([part() for part in suffixes])
+        
+        def append():
+            # The suffix may refer to the variable, so is calculated first
+            tail = suffix()
+            
+            try:
+                value = symbol_table.pop(name)
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+            
+            try:
+                value += tail
+            
+            finally:
+                symbol_table[name] = value
+        
+        return append
+    
+    
+    def midassignmentstmt(self):
+        '''Compiles assignment to MID$, e.g. MID$(A$, 3, 2) = "XY", which
+        replaces characters of a string variable.
+        '''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        
+        self.advance()  # Advance past MID$
+        self.consume(Token.LEFTPAREN)
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME or not name.endswith('$'):
+            raise SyntaxError('Expecting string variable')
+        self.advance()  # Advance past variable name
+        self.consume(Token.COMMA)
+        
+        start = self.expr().closure()
+        chars = None
+        if self.token.cat == Token.COMMA:
+            self.advance()  # Advance past comma
+            chars = self.expr().closure()
+        
+        self.consume(Token.RIGHTPAREN)
+        self.consume(Token.ASSIGNOP)
+        replacement = self.logexpr().closure()
+        
+        def midassignment():
+            startval = start()
+            charsval = chars() if chars != None else None
+            value = replacement()
+            
+            try:
+                instring = symbol_table[name]
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+            
+            symbol_table[name] = mid_replace(line_num, instring, startval,
+                    charsval, value)
+        
+        return midassignment, False
+    
+    
+    def arrayassignmentstmt(self, name):
+        '''Compiles an assignment to an array element.'''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        arrayname = name + '_array'
+        
+        self.consume(Token.LEFTPAREN)
+        indices = self.indices()
+        self.consume(Token.RIGHTPAREN)
+        self.consume(Token.ASSIGNOP)
+        node = self.logexpr()
+        right = node.closure()
+        
+        is_string = name.endswith('$')
+        dims = len(indices)
+        
+        if node.kind != None and (node.kind == 'str') != is_string:
+            raise SyntaxError('Type mismatch')
+        
+        # A(I) = A(I) + K and A(I) = A(I) - K update the element in place
+        if dims == 1 and node.op in (Token.PLUS, Token.MINUS) and \
+                node.kind in numeric and node.args[1].is_const() and \
+                node.args[0].element != None and \
+                node.args[0].element == (name, reference(indices[0])) and \
+                (node.kind == 'int' or not name.endswith('%')):
+            return self.fuse('array accumulate',
+                    self.accumulate(name, indices[0], node)), False
+        
+        if name.endswith('%'):
+            node = self.integer(node, 'array')
+            right = node.closure()
+        
+        indices = [index.closure() for index in indices]
+        
+        proven = node.kind != None
+        
+        def arrayassignment():
+            indexvars = [index() for index in indices]
+            
+            try:
+                BASICarray = symbol_table[arrayname]
+            
+            except KeyError:
+                raise KeyError('Array could not be found in line ' + \
+                        str(line_num))
+            
+            if BASICarray.dims != dims:
+                raise IndexError('Incorrect number of indices applied to ' + \
+                        'array in line ' + str(line_num))
+            
+            value = right()
+            if proven:
+                pass
+            
+            elif is_string and not isinstance(value, str):
+                raise SyntaxError('Attempt to assign non-string to string ' + \
+                        'array in line ' + str(line_num))
+            
+            elif not is_string and isinstance(value, str):
+                raise SyntaxError('Attempt to assign string to numeric ' + \
+                        'array in line ' + str(line_num))
+            
+            try:
+                if dims == 1:
+                    BASICarray.data[indexvars[0]] = value
+                
+                elif dims == 2:
+                    BASICarray.data[indexvars[0]][indexvars[1]] = value
+                
+                elif dims == 3:
+                    BASICarray.data[indexvars[0]][indexvars[1]][indexvars[2]] \
+                            = value
+            
+            except IndexError:
+                raise IndexError('Array index out of range in line ' + \
+                        str(line_num))
+            
+            except OverflowError:
+                raise OverflowError('Integer overflow in line ' + \
+                        str(line_num))
+        
+        return arrayassignment, False
+    
+    
+    def mapassignmentstmt(self, name):
+        '''Compiles an assignment to a map element.'''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        mapname = name + '_map'
+        
+        self.consume(Token.LEFTBRACE)
+        key = self.expr().closure()
+        self.consume(Token.RIGHTBRACE)
+        self.consume(Token.ASSIGNOP)
+        node = self.logexpr()
+        right = node.closure()
+        
+        is_string = name.endswith('$')
+        if node.kind != None and (node.kind == 'str') != is_string:
+            raise SyntaxError('Type mismatch')
+        
+        if name.endswith('%'):
+            node = self.integer(node, 'map')
+            right = node.closure()
+        
+        proven = node.kind != None
+        
+        def mapassignment():
+            try:
+                BASICmap = symbol_table[mapname]
+            
+            except KeyError:
+                raise KeyError('Map could not be found in line ' + \
+                        str(line_num))
+            
+            keyval = key()
+            value = right()
+            if proven:
+                pass
+            
+            elif is_string and not isinstance(value, str):
+                raise SyntaxError('Attempt to assign non-string to string ' + \
+                        'map in line ' + str(line_num))
+            
+            elif not is_string and isinstance(value, str):
+                raise SyntaxError('Attempt to assign string to numeric ' + \
+                        'map in line ' + str(line_num))
+            
+            try:
+                BASICmap[keyval] = value
+            
+            except TypeError:
+                raise TypeError('Invalid map key in line ' + str(line_num))
+        
+        return mapassignment, False
+    
+    
+    def accumulate(self, name, index, node):
+        '''Returns a closure adding a constant to a numeric array element.'''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        arrayname = name + '_array'
+        index = index.closure()
+        
+        value = node.args[1].value
+        if node.op == Token.MINUS:
+            value = -value
+        
+        def accumulate():
+            indexvar = index()
+            
+            try:
+                BASICarray = symbol_table[arrayname]
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+            
+            if BASICarray.dims != 1:
+                raise IndexError('Incorrect number of indices applied to ' + \
+                        'array in line ' + str(line_num))
+            
+            try:
+                BASICarray.data[indexvar] += value
+            
+            except IndexError:
+                raise IndexError('Array index out of range in line ' + \
+                        str(line_num))
+            
+            except OverflowError:
+                raise OverflowError('Integer overflow in line ' + \
+                        str(line_num))
+        
+        return accumulate
+    
+    
+    def printstmt(self):
+        '''Compiles a PRINT statement.'''
+        
+        parser = self.parser
+        line_num = self.line_num
+        
+        self.advance()  # Advance past PRINT
+        
+        filenum = None
+        if self.token.cat == Token.HASH:
+            self.consume(Token.HASH)
+            filenum = self.expr().closure()
+            
+            if self.tokenindex < len(self.tokens) and \
+                    self.token.cat != Token.COLON:
+                self.consume(Token.COMMA)
+        
+        # Items to be printed, each with a flag showing whether it is a TAB
+        items = []
+        nodes = []
+        newline = True
+        if self.tokenindex < len(self.tokens):
+            items.append((self.token.cat == Token.TAB,
+                    self.logexpr().closure()))
+            
+            while self.token.cat == Token.SEMICOLON:
+                if self.tokenindex == len(self.tokens) - 1:
+                    # If semicolon at end of line, don't print a newline
+                    self.advance()
+                    newline = False
+                    break
+                
+                self.advance()
+                items.append((self.token.cat == Token.TAB,
+                        self.logexpr().closure()))
+        
+        # PRINT A$; writes the string directly
+        if filenum == None and not newline and len(items) == 1 and \
+                self.tokens[1].cat == Token.NAME and len(self.tokens) == 3 \
+                and self.tokens[1].val.endswith('$'):
+            name = self.tokens[1].val
+            symbol_table = self.symbol_table
+            def printstring():
+                try:
+                    text = symbol_table[name]
+                
+                except KeyError:
+                    raise RuntimeError('Name ' + name + ' is not defined' + \
+                            ' in line ' + str(line_num))
+                
+                parser.prnt_column += len(text)
+                print(text, end='')
+            
+            return self.fuse('print string', printstring), False
+        
+        def printstmt():
+            outfile = None
+            if filenum:
+                number = filenum()
+                outfile = parser.file_handles.get(number)
+                if outfile == None:
+                    raise RuntimeError('PRINT: file #' + str(number) + \
+                            ' not open in line ' + str(line_num))
+            
+            for prntTab, item in items:
+                parser.print_item(item(), prntTab, outfile)
+            
+            if newline:
+                parser.print_text('\n', outfile)
+                parser.prnt_column = 0
+        
+        return printstmt, False
+    
+    
+    def gotostmt(self):
+        '''Compiles a GOTO statement.'''
+        
+        self.advance()  # Advance past GOTO
+        return self.jump(self.expr()), True
+    
+    
+    def gosubstmt(self):
+        '''Compiles a GOSUB statement.'''
+        
+        self.advance()  # Advance past GOSUB
+        self.gosub_lines.add(self.line_num)
+        return self.jump(self.expr(), Msg.GOSUB), False
+    
+    
+    def returnstmt(self):
+        '''Compiles a RETURN statement.'''
+        
+        self.tokenindex = len(self.tokens)
+        def returnstmt():
+            return return_msg
+        return returnstmt, True
+    
+    
+    def ifstmt(self):
+        '''Compiles an IF statement, including the THEN and ELSE blocks,
+        which take the remainder of the line.
+        '''
+        
+        tokens = self.tokens
+        
+        self.advance()  # Advance past IF
+        condition = self.logexpr()
+        self.consume(Token.THEN)
+        then_index = self.tokenindex
+        
+        # When the condition is false the parser looks for the first ELSE
+        else_index = None
+        for index in range(then_index, len(tokens)):
+            if tokens[index].cat == Token.ELSE:
+                else_index = index + 1
+                break
+        
+        # THEN and ELSE may be followed by a line number or statements
+        if self.token.cat == Token.UNSIGNEDINT:
+            then_jump = self.expr()
+        
+        if else_index != None:
+            if else_index >= len(tokens):
+                raise SyntaxError('Missing ELSE block')
+            
+            if tokens[else_index].cat == Token.UNSIGNEDINT:
+                self.tokenindex = else_index
+                self.token = tokens[else_index]
+                else_jump = self.expr()
+        
+        folds = self.folds
+        
+        # Dead branches are not compiled
+        if condition.is_const():
+            if condition.value:
+                self.note(self.line_num, 'condition is always true, ' + \
+                        'ELSE branch removed')
+            else:
+                self.note(self.line_num, 'condition is always false, ' + \
+                        'THEN branch removed')
+        
+        then_code = else_code = None
+        then_terminal = else_terminal = False
+        
+        if not condition.is_const() or condition.value:
+            if tokens[then_index].cat == Token.UNSIGNEDINT:
+                then_code, then_terminal = self.jump(then_jump), True
+            else:
+                then_code, then_terminal = self.block(tokens, then_index)
+        
+        if else_index != None and \
+                (not condition.is_const() or not condition.value):
+            if tokens[else_index].cat == Token.UNSIGNEDINT:
+                else_code, else_terminal = self.jump(else_jump), True
+            else:
+                else_code, else_terminal = self.block(tokens, else_index)
+        
+        # Restore the state overwritten by compiling the blocks
+        self.tokens = tokens
+        self.tokenindex = len(tokens)
+        self.folds = folds
+        
+        if condition.is_const():
+            if condition.value:
+                return then_code, then_terminal
+            return else_code, else_terminal
+        
+        # IF X = K THEN GOTO n compares and branches in one step
+        left, right = condition.args or (None, None)
+        if condition.op in comparisons and else_index == None and \
+                left.name and right.is_const() and \
+                (left.kind == 'str') == (right.kind == 'str') and \
+                is_goto(tokens[then_index:]):
+            return self.fuse('compare and branch', self.branch(condition,
+                    int(tokens[-1].val))), False
+        
+        test = condition.fn
+        if then_code == None:
+            then_code = noop
+        
+        if else_code == None:
+            def ifstmt():
+                if test():
+                    return then_code()
+        
+        else:
+            def ifstmt():
+                if test():
+                    return then_code()
+                return else_code()
+        
+        return ifstmt, then_terminal and else_terminal
+    
+    
+    def branch(self, condition, target):
+        '''Returns a closure which jumps to the target line if a variable
+        compares as required with a constant.
+        '''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        compare = comparisons[condition.op]
+        name = condition.args[0].name
+        value = condition.args[1].value
+        msg = Msg(target=target, type=Msg.SIMPLE_JUMP)
+        
+        def branch():
+            try:
+                if compare(symbol_table[name], value):
+                    return msg
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+        
+        return branch
+    
+    
+    def forstmt(self):
+        '''Compiles the FOR statement of a loop.'''
+        
+        parser = self.parser
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        
+        self.advance()  # Advance past FOR
+        
+        loop_variable = self.token.val
+        if loop_variable.endswith('$'):
+            raise SyntaxError('Loop variable is not numeric')
+        
+        self.advance()  # Advance past loop variable
+        self.consume(Token.ASSIGNOP)
+        start = self.expr()
+        if start.kind not in numeric:
+            raise SyntaxError('Type mismatch')
+        
+        integer = loop_variable.endswith('%')
+        if integer:
+            start = self.integer(start, 'variable')
+        
+        start = start.closure()
+        self.consume(Token.TO)
+        end = self.expr().closure()
+        
+        step = Node(value=1)
+        if self.tokenindex < len(self.tokens):
+            self.consume(Token.STEP)
+            step = self.expr()
+            if integer:
+                step = self.integer(step, 'variable')
+            if step.is_const() and step.value == 0:
+                raise SyntaxError('Zero step value')
+        
+        skip = Msg(type=Msg.LOOP_SKIP, target=loop_variable)
+        begin = Msg(type=Msg.LOOP_BEGIN, loop_var=loop_variable)
+        
+        step_is_const = step.is_const()
+        increment = step.value >= 0 if step_is_const else None
+        step = step.closure()
+        
+        def forstmt():
+            start_val = start()
+            end_val = end()
+            step_val = step()
+            
+            if step_is_const:
+                increases = increment
+            elif step_val == 0:
+                raise IndexError('Zero step value supplied for loop' + \
+                        ' in line ' + str(line_num))
+            else:
+                increases = step_val >= 0
+            
+            # Initialise the loop variable unless returning from the NEXT
+            last_msg = parser.last_msg
+            if last_msg and last_msg.type == Msg.LOOP_REPEAT:
+                symbol_table[loop_variable] += step_val
+            else:
+                symbol_table[loop_variable] = start_val
+            
+            if increases:
+                if symbol_table[loop_variable] > end_val:
+                    return skip
+            elif symbol_table[loop_variable] < end_val:
+                return skip
+            
+            return begin
+        
+        return forstmt, False
+    
+    
+    def alone(self):
+        '''Raises an error unless the statement being compiled, which must
+        have been fully consumed, is the only one on its line.
+        '''
+        
+        if len(self.tokens) != len(self.line_tokens) or \
+                self.tokenindex < len(self.tokens):
+            raise SyntaxError('Statement must be on a line of its own')
+    
+    
+    def openloop(self, keyword):
+        '''Records the start of a WHILE or DO loop, which must be the only
+        statement on its line, as the whole line is executed again each
+        time the loop is repeated.  Returns the messages which begin and
+        leave the loop.  The loop is identified by its line number.
+        '''
+        
+        self.alone()
+        
+        key = self.line_num
+        begin = Msg(type=Msg.LOOP_BEGIN, loop_var=key)
+        
+        # The target is set when the end of the loop is compiled
+        leave = Msg(target=key, type=Msg.LOOP_EXIT, loop_var=key)
+        
+        self.loops.append((keyword, key, leave))
+        return begin, leave
+    
+    
+    def closeloop(self, keyword):
+        '''Records the end of the innermost WHILE or DO loop, which must
+        be the only statement on its line.  Returns the messages which
+        repeat and leave the loop.
+        '''
+        
+        self.alone()
+        
+        if len(self.loops) == 0 or self.loops[-1][0] != keyword:
+            raise SyntaxError('Loop end without matching start')
+        
+        if len(self.selects) > 0 and self.selects[-1].depth >= len(self.loops):
+            raise SyntaxError('Loop end within SELECT CASE')
+        
+        keyword, key, leave = self.loops.pop()
+        leave.target = self.line_num
+        self.continue_lines.add(self.line_num)
+        
+        return Msg(type=Msg.LOOP_REPEAT, loop_var=key), leave
+    
+    
+    def whilestmt(self):
+        '''Compiles the WHILE statement beginning a loop, which is repeated
+        until the matching WEND for as long as the condition is true.
+        '''
+        
+        self.advance()  # Advance past WHILE
+        condition = self.logexpr().closure()
+        begin, leave = self.openloop(Token.WHILE)
+        
+        def whilestmt():
+            if condition():
+                return begin
+            return leave
+        
+        return whilestmt, False
+    
+    
+    def wendstmt(self):
+        '''Compiles the WEND statement ending a WHILE loop.'''
+        
+        self.advance()  # Advance past WEND
+        repeat, leave = self.closeloop(Token.WHILE)
+        
+        def wendstmt():
+            return repeat
+        
+        return wendstmt, False
+    
+    
+    def dostmt(self):
+        '''Compiles the DO statement beginning a loop, with an optional
+        WHILE or UNTIL condition tested before each repetition.
+        '''
+        
+        self.advance()  # Advance past DO
+        test = self.token.cat
+        if test in (Token.WHILE, Token.UNTIL):
+            self.advance()  # Advance past WHILE or UNTIL
+            condition = self.logexpr().closure()
+        
+        begin, leave = self.openloop(Token.DO)
+        
+        if test == Token.WHILE:
+            def dostmt():
+                if condition():
+                    return begin
+                return leave
+        
+        elif test == Token.UNTIL:
+            def dostmt():
+                if condition():
+                    return leave
+                return begin
+        
+        else:
+            def dostmt():
+                return begin
+        
+        return dostmt, False
+    
+    
+    def loopstmt(self):
+        '''Compiles the LOOP statement ending a DO loop, with an optional
+        WHILE or UNTIL condition tested after each repetition.
+        '''
+        
+        self.advance()  # Advance past LOOP
+        test = self.token.cat
+        if test in (Token.WHILE, Token.UNTIL):
+            self.advance()  # Advance past WHILE or UNTIL
+            condition = self.logexpr().closure()
+        
+        repeat, leave = self.closeloop(Token.DO)
+        
+        if test == Token.WHILE:
+            def loopstmt():
+                if condition():
+                    return repeat
+                return leave
+        
+        elif test == Token.UNTIL:
+            def loopstmt():
+                if condition():
+                    return leave
+                return repeat
+        
+        else:
+            def loopstmt():
+                return repeat
+        
+        return loopstmt, False
+    
+    
+    def exitstmt(self):
+        '''Compiles EXIT DO and EXIT WHILE, which leave the innermost loop
+        of that kind.
+        '''
+        
+        self.advance()  # Advance past EXIT
+        keyword = self.token.cat
+        if keyword not in (Token.DO, Token.WHILE):
+            raise SyntaxError('Expecting DO or WHILE')
+        
+        self.advance()  # Advance past DO or WHILE
+        
+        for loop_keyword, key, leave in reversed(self.loops):
+            if loop_keyword == keyword:
+                break
+        else:
+            raise SyntaxError('EXIT outside loop')
+        
+        def exitstmt():
+            return leave
+        
+        return exitstmt, True
+    
+    
+    def selectstmt(self):
+        '''Compiles the SELECT CASE statement, which jumps to the block
+        following the first CASE matching the value of the expression, to
+        CASE ELSE if none match, or otherwise past the END SELECT.  Each
+        SELECT CASE, CASE and END SELECT must be on a line of its own.
+        '''
+        
+        self.advance()  # Advance past SELECT
+        self.consume(Token.CASE)
+        subject = self.logexpr().closure()
+        self.alone()
+        
+        selection = Selection(self.line_num, len(self.loops))
+        self.selects.append(selection)
+        table = selection.table
+        tests = selection.tests
+        
+        def selectstmt():
+            value = subject()
+            found = table.get(value)
+            
+            if tests:
+                for position, test, msg in tests:
+                    if found != None and found[0] < position:
+                        break
+                    if test(value):
+                        return msg
+            
+            if found != None:
+                return found[1]
+            
+            return selection.otherwise
+        
+        return selectstmt, True
+    
+    
+    def casestmt(self):
+        '''Compiles a CASE statement, adding its values to the innermost
+        SELECT CASE.  A value may be a range, e.g. CASE 1, 5 TO 9.  When
+        the CASE is reached from the end of the previous block, the SELECT
+        is left.
+        '''
+        
+        self.advance()  # Advance past CASE
+        
+        if len(self.selects) == 0 or \
+                self.selects[-1].depth != len(self.loops):
+            raise SyntaxError('CASE outside SELECT CASE')
+        
+        selection = self.selects[-1]
+        if selection.default != None:
+            raise SyntaxError('CASE following CASE ELSE')
+        
+        # The block starts on the line after this one
+        enter = Msg(target=self.line_num, type=Msg.JUMP_PAST)
+        
+        if self.token.cat == Token.ELSE:
+            self.advance()  # Advance past ELSE
+            self.alone()
+            selection.default = enter
+            selection.otherwise = enter
+        
+        else:
+            values = [self.casevalue()]
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                values.append(self.casevalue())
+            
+            self.alone()
+            for value, test in values:
+                position = selection.positions
+                selection.positions += 1
+                
+                if test == None:
+                    # Earlier cases take precedence
+                    selection.table.setdefault(value, (position, enter))
+                else:
+                    selection.tests.append((position, test, enter))
+        
+        self.continue_lines.add(self.line_num)
+        leave = selection.leave
+        
+        def casestmt():
+            return leave
+        
+        return casestmt, True
+    
+    
+    def casevalue(self):
+        '''Compiles a value of a CASE statement, returning the constant
+        value and None, or None and a closure testing a value against a
+        range or a value calculated at run time.
+        '''
+        
+        line_num = self.line_num
+        low = self.logexpr()
+        
+        if self.token.cat != Token.TO:
+            if low.is_const():
+                return low.value, None
+            
+            value_of = low.fn
+            def equals(value):
+                return value == value_of()
+            return None, equals
+        
+        self.advance()  # Advance past TO
+        low = low.closure()
+        high = self.logexpr().closure()
+        
+        def within(value):
+            try:
+                return low() <= value <= high()
+            
+            except TypeError:
+                raise TypeError('Type mismatch in CASE in line ' + \
+                        str(line_num))
+        
+        return None, within
+    
+    
+    def stopstmt(self):
+        '''Compiles END SELECT, which ends the innermost SELECT CASE.  STOP
+        and END statements are left to the parser.
+        '''
+        
+        self.advance()  # Advance past STOP
+        if self.token.cat != Token.SELECT:
+            self.tokenindex = len(self.tokens)
+            return self.fallback(self.tokens)
+        
+        self.advance()  # Advance past SELECT
+        self.alone()
+        
+        if len(self.selects) == 0 or \
+                self.selects[-1].depth != len(self.loops):
+            raise SyntaxError('END SELECT without SELECT CASE')
+        
+        selection = self.selects.pop()
+        selection.leave.target = self.line_num
+        self.continue_lines.add(self.line_num)
+        
+        return None, False
+    
+    
+    def nextstmt(self):
+        '''Compiles the NEXT statement of a loop.'''
+        
+        self.advance()  # Advance past NEXT
+        
+        loop_variable = self.token.val
+        if self.token.cat != Token.NAME or loop_variable.endswith('$'):
+            raise SyntaxError('Invalid loop variable')
+        
+        self.tokenindex = len(self.tokens)
+        msg = Msg(type=Msg.LOOP_REPEAT, loop_var=loop_variable)
+        def nextstmt():
+            return msg
+        return nextstmt, False
+    
+    
+    def ongosubstmt(self):
+        '''Compiles ON-GOTO and ON-GOSUB statements.'''
+        
+        self.advance()  # Advance past ON
+        selector = self.expr().closure()
+        
+        if self.token.cat == Token.GOTO:
+            self.consume(Token.GOTO)
+            jump_type = Msg.SIMPLE_JUMP
+        else:
+            self.consume(Token.GOSUB)
+            jump_type = Msg.GOSUB
+            self.gosub_lines.add(self.line_num)
+        
+        branches = []
+        if self.tokenindex < len(self.tokens):
+            branches.append(self.jump(self.expr(), jump_type))
+            
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                branches.append(self.jump(self.expr(), jump_type))
+        
+        def ongosubstmt():
+            saveval = selector()
+            
+            # Only the branch taken is evaluated
+            if saveval < 1 or saveval > len(branches):
+                return None
+            return branches[saveval - 1]()
+        
+        return ongosubstmt, False
+    
+    
+    def indices(self):
+        '''Compiles a comma separated list of array indices.'''
+        
+        indices = []
+        if self.tokenindex < len(self.tokens):
+            indices.append(self.expr())
+            
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                indices.append(self.expr())
+        
+        return indices
+    
+    
+    def fold(self, start, value):
+        '''Returns a constant node for an expression that has been evaluated
+        at compile time, recording the tokens it replaced.
+        '''
+        
+        if self.tokenindex - start > 1:
+            self.folds.append((start, self.tokenindex, value))
+        return Node(value=value)
+    
+    
+    def binary(self, start, cat, left, right):
+        '''Compiles a binary operation, folding it if both operands are
+        constant.
+        '''
+        
+        if left.is_const() and right.is_const():
+            try:
+                return self.fold(start, operations[cat](left.value,
+                        right.value))
+            
+            except Exception:
+                # Leave errors to be reported at run time
+                pass
+        
+        fn = binary_closure(cat, left, right, self.symbol_table,
+                self.line_num)
+        node = Node(fn=fn, kind=result_kind(cat, left.kind, right.kind))
+        node.op = cat
+        node.args = (left, right)
+        return node
+    
+    
+    def logexpr(self):
+        '''Compiles a logical expression.'''
+        
+        start = self.tokenindex
+        left = self.notexpr()
+        
+        while self.token.cat in (Token.OR, Token.AND):
+            savecat = self.token.cat
+            self.advance()
+            right = self.notexpr()
+            left = self.binary(start, savecat, left, right)
+        
+        return left
+    
+    
+    def notexpr(self):
+        '''Compiles a logical not expression.'''
+        
+        start = self.tokenindex
+        if self.token.cat == Token.NOT:
+            self.advance()
+            right = self.relexpr()
+            
+            if right.is_const():
+                return self.fold(start, not right.value)
+            
+            fn = right.fn
+            def notexpr():
+                return not fn()
+            return Node(fn=notexpr, kind='num')
+        
+        return self.relexpr()
+    
+    
+    def relexpr(self):
+        '''Compiles a relational expression.'''
+        
+        start = self.tokenindex
+        left = self.expr()
+        
+        if self.token.cat in relational:
+            savecat = self.token.cat
+            if savecat == Token.ASSIGNOP:
+                savecat = Token.EQUAL
+            
+            self.advance()
+            right = self.expr()
+            left = self.binary(start, savecat, left, right)
+        
+        return left
+    
+    
+    def expr(self):
+        '''Compiles an expression consisting of terms being added or
+        subtracted.
+        '''
+        
+        start = self.tokenindex
+        left = self.term()
+        
+        while self.token.cat in (Token.PLUS, Token.MINUS):
+            savecat = self.token.cat
+            self.advance()
+            right = self.term()
+            left = self.binary(start, savecat, left, right)
+        
+        return left
+    
+    
+    def term(self):
+        '''Compiles an expression consisting of factors being multiplied or
+        divided.
+        '''
+        
+        start = self.tokenindex
+        left = self.factor(1)
+        
+        while self.token.cat in (Token.TIMES, Token.DIVIDE, Token.MODULO):
+            savecat = self.token.cat
+            self.advance()
+            right = self.factor(1)
+            left = self.binary(start, savecat, left, right)
+        
+        return left
+    
+    
+    def factor(self, sign):
+        '''Compiles a factor, i.e. a constant, variable, function call or
+        an expression in parentheses, with an optional unary sign.
+        '''
+        
+        start = self.tokenindex
+        
+        if self.token.cat == Token.PLUS:
+            self.advance()
+            return self.factor(sign)
+        
+        elif self.token.cat == Token.MINUS:
+            self.advance()
+            node = self.factor(-sign)
+            if node.is_const() and self.tokenindex - start > 2:
+                # Record the sign as part of the folded expression
+                return self.fold(start, node.value)
+            return node
+        
+        elif self.token.cat == Token.UNSIGNEDINT:
+            value = sign * int(self.token.val)
+            self.advance()
+            return Node(value=value)
+        
+        elif self.token.cat == Token.UNSIGNEDFLOAT:
+            value = sign * float(self.token.val)
+            self.advance()
+            return Node(value=value)
+        
+        elif self.token.cat == Token.STRING:
+            value = self.token.val
+            self.advance()
+            return Node(value=value)
+        
+        elif self.token.cat == Token.NAME:
+            name = self.token.val
+            self.advance()  # Advance past the name
+            
+            if self.token.cat == Token.LEFTPAREN:
+                node = self.arrayelement(name)
+            elif self.token.cat == Token.LEFTBRACE:
+                node = self.mapelement(name)
+            else:
+                node = self.variable(name)
+        
+        elif self.token.cat == Token.LEFTPAREN:
+            self.advance()
+            node = self.logexpr()
+            self.consume(Token.RIGHTPAREN)
+            
+            if node.is_const() and sign == -1:
+                return self.fold(start, -node.value)
+        
+        elif self.token.cat == Token.FN:
+            node = self.userfunction()
+        
+        elif self.token.cat in Token.functions:
+            node = self.function()
+            
+            if node.is_const():
+                if sign == -1:
+                    return self.fold(start, -node.value)
+                return node
+        
+        else:
+            raise SyntaxError('Expecting factor in numeric expression')
+        
+        if sign == -1:
+            fn = node.closure()
+            def negate():
+                return -fn()
+            return Node(fn=negate,
+                    kind=node.kind if node.kind in numeric else None)
+        
+        return node
+    
+    
+    def variable(self, name):
+        '''Compiles a reference to a simple variable.'''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        
+        def variable():
+            try:
+                return symbol_table[name]
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+        
+        return Node(fn=variable, kind=name_kind(name), name=name)
+    
+    
+    def arrayelement(self, name):
+        '''Compiles a reference to an array element.'''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        arrayname = name + '_array'
+        
+        self.consume(Token.LEFTPAREN)
+        indices = self.indices()
+        self.consume(Token.RIGHTPAREN)
+        
+        dims = len(indices)
+        element = (name, reference(indices[0])) if dims == 1 else None
+        indices = [index.closure() for index in indices]
+        
+        if dims == 1:
+            index = indices[0]
+            def arrayelement():
+                indexvar = index()
+                
+                try:
+                    BASICarray = symbol_table[arrayname]
+                
+                except KeyError:
+                    raise RuntimeError('Name ' + name + ' is not defined' + \
+                            ' in line ' + str(line_num))
+                
+                if BASICarray.dims != 1:
+                    raise IndexError('Incorrect number of indices applied ' + \
+                            'to array in line ' + str(line_num))
+                
+                try:
+                    return BASICarray.data[indexvar]
+                
+                except IndexError:
+                    raise IndexError('Array index out of range in line ' + \
+                            str(line_num))
+            
+            node = Node(fn=arrayelement, kind=name_kind(name))
+            if element[1] != None:
+                node.element = element
+            return node
+        
+        def arrayelement():
+            indexvars = [index() for index in indices]
+            
+            try:
+                BASICarray = symbol_table[arrayname]
+            
+            except KeyError:
+                raise RuntimeError('Name ' + name + ' is not defined' + \
+                        ' in line ' + str(line_num))
+            
+            if BASICarray.dims != dims:
+                raise IndexError('Incorrect number of indices applied to ' + \
+                        'array in line ' + str(line_num))
+            
+            try:
+                if dims == 1:
+                    return BASICarray.data[indexvars[0]]
+                
+                elif dims == 2:
+                    return BASICarray.data[indexvars[0]][indexvars[1]]
+                
+                return BASICarray.data[indexvars[0]][indexvars[1]] \
+                        [indexvars[2]]
+            
+            except IndexError:
+                raise IndexError('Array index out of range in line ' + \
+                        str(line_num))
+        
+        return Node(fn=arrayelement, kind=name_kind(name))
+    
+    
+    def mapelement(self, name):
+        '''Compiles a reference to a map element, or to the whole map if no
+        key is given, e.g. LEN(M{}).
+        '''
+        
+        line_num = self.line_num
+        symbol_table = self.symbol_table
+        mapname = name + '_map'
+        
+        self.consume(Token.LEFTBRACE)
+        if self.token.cat == Token.RIGHTBRACE:
+            self.advance()  # Advance past right brace
+            
+            def wholemap():
+                try:
+                    return symbol_table[mapname]
+                
+                except KeyError:
+                    raise KeyError('Map could not be found in line ' + \
+                            str(line_num))
+            
+            return Node(fn=wholemap)
+        
+        key = self.expr().closure()
+        self.consume(Token.RIGHTBRACE)
+        
+        def mapelement():
+            try:
+                BASICmap = symbol_table[mapname]
+            
+            except KeyError:
+                raise KeyError('Map could not be found in line ' + \
+                        str(line_num))
+            
+            keyval = key()
+            try:
+                return BASICmap[keyval]
+            
+            except (KeyError, TypeError):
+                raise KeyError('Key ' + str(keyval) + ' not found in map ' + \
+                        'in line ' + str(line_num))
+        
+        return Node(fn=mapelement, kind=name_kind(name))
+    
+    
+    def userfunction(self):
+        '''Compiles a call to a function defined by DEF FN.  The function
+        is looked up when called, as it may be defined later in the program.
+        '''
+        
+        line_num = self.line_num
+        user_functions = self.parser.user_functions
+        name = self.token.val
+        
+        self.advance()  # Advance past function name
+        
+        args = []
+        if self.token.cat == Token.LEFTPAREN:
+            self.advance()  # Advance past left paren
+            
+            if self.token.cat != Token.RIGHTPAREN:
+                args.append(self.logexpr().closure())
+                
+                while self.token.cat == Token.COMMA:
+                    self.advance()  # Advance past comma
+                    args.append(self.logexpr().closure())
+            
+            self.consume(Token.RIGHTPAREN)
+        
+        else:
+            symbol_table = self.symbol_table
+            def userfunction():
+                # Within a multi-line function, its name without arguments
+                # refers to the result
+                if name in symbol_table:
+                    return symbol_table[name]
+                
+                try:
+                    function = user_functions[name]
+                
+                except KeyError:
+                    raise RuntimeError('Function ' + name + ' is not ' + \
+                            'defined in line ' + str(line_num))
+                
+                return function.call(line_num, [])
+            
+            return Node(fn=userfunction, kind=name_kind(name))
+        
+        def userfunction():
+            try:
+                function = user_functions[name]
+            
+            except KeyError:
+                raise RuntimeError('Function ' + name + ' is not defined ' + \
+                        'in line ' + str(line_num))
+            
+            return function.call(line_num, [arg() for arg in args])
+        
+        return Node(fn=userfunction, kind=name_kind(name))
+    
+    
+    def function(self):
+        '''Compiles a function call.  The function is looked up in the
+        function table and its arguments checked now, so that at run time
+        its implementation is called directly.  Calls to pure functions
+        with constant arguments are evaluated now.
+        '''
+        
+        line_num = self.line_num
+        start = self.tokenindex
+        cat = self.token.cat
+        function = function_table[cat]
+        
+        self.advance()  # Advance past function name
+        
+        args = []
+        if function.max_args != 0:
+            self.consume(Token.LEFTPAREN)
+            
+            if cat == Token.TERNARY:
+                args.append(self.logexpr())
+            else:
+                args.append(self.expr())
+            
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                args.append(self.expr())
+            
+            self.consume(Token.RIGHTPAREN)
+        
+        function.check_args(len(args), line_num)
+        
+        # Work out the kind of the result
+        kind = function.kind
+        if kind == 'args':
+            if cat == Token.TERNARY:
+                kind = common_kind([arg.kind for arg in args[1:]])
+            else:
+                kind = common_kind([arg.kind for arg in args])
+            if cat == Token.ABS and kind not in numeric:
+                kind = None
+        
+        if function.pure and all(arg.is_const() for arg in args):
+            try:
+                return self.fold(start, function.fn(line_num,
+                        *[arg.value for arg in args]))
+            
+            except Exception:
+                # Leave errors to be reported at run time
+                pass
+        
+        args = [arg.closure() for arg in args]
+        if (cat, len(args)) in specialised_functions:
+            fn = specialised_functions[(cat, len(args))](line_num, *args)
+        else:
+            fn = call_closure(function.fn, line_num, args)
+        
+        return Node(fn=fn, kind=kind)
+
+
+def noop():
+    return None
+
+
+# Names of the superinstructions, which fuse common combinations of
+# operations into a single closure
+superinstructions = ('increment', 'compare and branch', 'array accumulate',
+    'print string', 'string append')
+
+
+# Statements whose compiled form depends on the lines they are matched with
+structured = (Token.DEF, Token.FNEND, Token.WHILE, Token.WEND, Token.DO,
+    Token.LOOP, Token.EXIT, Token.SELECT, Token.CASE)
+
+
+# Comparisons that can be fused with a branch
+comparisons = {
+    Token.ASSIGNOP: operator.eq,
+    Token.EQUAL: operator.eq,
+    Token.NOTEQUAL: operator.ne,
+    Token.LESSER: operator.lt,
+    Token.GREATER: operator.gt,
+    Token.LESSEQUAL: operator.le,
+    Token.GREATEQUAL: operator.ge,
+    }
+
+
+def is_goto(tokens):
+    '''Returns whether the tokens are just a jump to a line number,
+    i.e. n or GOTO n.
+    '''
+    
+    if len(tokens) > 0 and tokens[0].cat == Token.GOTO:
+        tokens = tokens[1:]
+    
+    return len(tokens) == 1 and tokens[0].cat == Token.UNSIGNEDINT
+
+
+def reference(node):
+    '''Returns a key identifying the value of a simple variable or a
+    constant, used to recognise the same array element, or None.
+    '''
+    
+    if node.name:
+        return node.name
+    
+    elif node.is_const():
+        return repr(node.value)
+    
+    return None
+
+
+def call_closure(fn, line_num, args):
+    '''Returns a closure calling a function's implementation with the
+    values of its compiled arguments.
+    '''
+    
+    if len(args) == 0:
+        def call():
+            return fn(line_num)
+    
+    elif len(args) == 1:
+        arg = args[0]
+        def call():
+            return fn(line_num, arg())
+    
+    elif len(args) == 2:
+        arg1, arg2 = args
+        def call():
+            return fn(line_num, arg1(), arg2())
+    
+    else:
+        def call():
+            return fn(line_num, *[arg() for arg in args])
+    
+    return call
+
+
+def left_closure(line_num, string, chars):
+    '''Returns a closure for LEFT$(A$, n).'''
+    
+    def left():
+        instring = string()
+        count = chars()
+        
+        try:
+            return instring[:count]
+        
+        except TypeError:
+            raise TypeError('Invalid type supplied to LEFT$ in line ' + \
+                    str(line_num))
+    
+    return left
+
+
+def mid_closure(line_num, string, start, chars=None):
+    '''Returns a closure for MID$(A$, i) and MID$(A$, i, n).'''
+    
+    if chars == None:
+        def mid():
+            instring = string()
+            first = start()
+            
+            try:
+                return instring[first-1:]
+            
+            except TypeError:
+                raise TypeError('Invalid type supplied to MID$ in line ' + \
+                        str(line_num))
+        
+        return mid
+    
+    def mid():
+        instring = string()
+        first = start()
+        count = chars()
+        
+        try:
+            if count:
+                return instring[first-1:first-1+count]
+            return instring[first-1:]
+        
+        except TypeError:
+            raise TypeError('Invalid type supplied to MID$ in line ' + \
+                    str(line_num))
+    
+    return mid
+
+
+def instr_closure(line_num, haystack, needle):
+    '''Returns a closure for INSTR(A$, B$).'''
+    
+    def instr():
+        haystackstring = haystack()
+        if not isinstance(haystackstring, str):
+            raise TypeError('Invalid type supplied to INSTR in line ' + \
+                    str(line_num))
+        
+        needlestring = needle()
+        
+        try:
+            return haystackstring.find(needlestring) + 1
+        
+        except TypeError:
+            raise TypeError('Invalid type supplied to INSTR in line ' + \
+                    str(line_num))
+    
+    return instr
+
+
+# Closures for the most used string functions, by function and number of
+# arguments, which avoid the general call to the function's implementation
+specialised_functions = {
+    (Token.LEFT, 2): left_closure,
+    (Token.MID, 2): mid_closure,
+    (Token.MID, 3): mid_closure,
+    (Token.INSTR, 2): instr_closure,
+    }
+
+
+# Operations used for constant folding
+operations = {
+    Token.PLUS: lambda left, right: left + right,
+    Token.MINUS: lambda left, right: left - right,
+    Token.TIMES: lambda left, right: left * right,
+    Token.DIVIDE: lambda left, right: left / right,
+    Token.MODULO: lambda left, right: left % right,
+    Token.EQUAL: lambda left, right: left == right,
+    Token.NOTEQUAL: lambda left, right: left != right,
+    Token.LESSER: lambda left, right: left < right,
+    Token.GREATER: lambda left, right: left > right,
+    Token.LESSEQUAL: lambda left, right: left <= right,
+    Token.GREATEQUAL: lambda left, right: left >= right,
+    Token.AND: lambda left, right: left and right,
+    Token.OR: lambda left, right: left or right,
+    }
+
+
+# Operations whose result is unchanged if an integer operand is converted
+# to a float, when the other operand is a float
+float_operations = (Token.PLUS, Token.MINUS, Token.TIMES, Token.DIVIDE,
+    Token.MODULO, Token.EQUAL, Token.NOTEQUAL, Token.LESSER, Token.GREATER,
+    Token.LESSEQUAL, Token.GREATEQUAL)
+
+
+def binary_closure(cat, left, right, symbol_table, line_num):
+    '''Returns a closure for a binary operation.  Where one operand is
+    constant its value is used directly, saving a call.  Numeric variables
+    compared with or combined with a numeric constant are read directly
+    from the symbol table.  An integer constant combined with an 
+    expression of kind 'float' is converted to a float, so that CPython 
+    operates on two floats, which it does more quickly than on a float 
+    and an integer.
+    '''
+    
+    operation = operations[cat]
+    
+    if left.kind == 'float' and right.is_const():
+        right = float_constant(cat, right)
+    elif right.kind == 'float' and left.is_const():
+        left = float_constant(cat, left)
+    
+    if left.name and left.kind in numeric and right.kind in numeric and \
+            right.is_const() and cat in variable_operations:
+        return variable_operations[cat](left.name, right.value, symbol_table,
+                line_num)
+    
+    if right.is_const():
+        lf = left.closure()
+        value = right.value
+        if cat == Token.PLUS:
+            def binary():
+                return lf() + value
+        elif cat == Token.MINUS:
+            def binary():
+                return lf() - value
+        elif cat == Token.TIMES:
+            def binary():
+                return lf() * value
+        elif cat == Token.EQUAL:
+            def binary():
+                return lf() == value
+        elif cat == Token.LESSER:
+            def binary():
+                return lf() < value
+        elif cat == Token.GREATER:
+            def binary():
+                return lf() > value
+        else:
+            def binary():
+                return operation(lf(), value)
+        return binary
+    
+    lf = left.closure()
+    rf = right.fn
+    if cat == Token.PLUS:
+        def binary():
+            return lf() + rf()
+    elif cat == Token.MINUS:
+        def binary():
+            return lf() - rf()
+    elif cat == Token.TIMES:
+        def binary():
+            return lf() * rf()
+    elif cat == Token.DIVIDE:
+        def binary():
+            return lf() / rf()
+    else:
+        def binary():
+            return operation(lf(), rf())
+    return binary
+
+
+def variable_plus(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] + value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+def variable_minus(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] - value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+def variable_times(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] * value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+def variable_equal(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] == value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+def variable_lesser(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] < value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+def variable_greater(name, value, symbol_table, line_num):
+    def binary():
+        try:
+            return symbol_table[name] > value
+        
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(line_num))
+    
+    return binary
+
+
+# Closure builders for operations between a numeric variable and a constant
+variable_operations = {
+    Token.PLUS: variable_plus,
+    Token.MINUS: variable_minus,
+    Token.TIMES: variable_times,
+    Token.EQUAL: variable_equal,
+    Token.LESSER: variable_lesser,
+    Token.GREATER: variable_greater,
+    }
+
+
+def float_constant(cat, node):
+    '''Returns a constant operand of an operation with a float as a
+    float, if it is an integer that converts to a float exactly and the
+    result of the operation is unchanged.  Otherwise returns the operand.
+    '''
+    
+    value = node.value
+    if type(value) is int and -(1 << 53) <= value <= 1 << 53 and \
+            cat in float_operations:
+        return Node(value=float(value))
+    
+    return node
+
+
+def kind_of(value):
+    '''Returns the kind of a constant value.'''
+    
+    if isinstance(value, str):
+        return 'str'
+    
+    elif isinstance(value, bool):
+        return 'num'
+    
+    elif isinstance(value, int):
+        return 'int'
+    
+    elif isinstance(value, float):
+        return 'float'
+    
+    return None
+
+
+def name_kind(name):
+    '''Returns the kind of value held by a variable or array.'''
+    
+    if name.endswith('$'):
+        return 'str'
+    
+    if name.endswith('%'):
+        return 'int'
+    
+    return 'num'
+
+
+def common_kind(kinds):
+    '''Returns the kind shared by all the given kinds.  Numeric kinds
+    which differ have the kind 'num'.
+    '''
+    
+    if not kinds or None in kinds:
+        return None
+    
+    if all(kind == kinds[0] for kind in kinds):
+        return kinds[0]
+    
+    if all(kind in numeric for kind in kinds):
+        return 'num'
+    
+    return None
+
+
+def result_kind(cat, left, right):
+    '''Returns the kind of the result of a binary operation on values
+    of the given kinds.
+    '''
+    
+    if cat in relational:
+        return 'num'
+    
+    if cat in (Token.AND, Token.OR):
+        return common_kind([left, right])
+    
+    if left in numeric and right in numeric:
+        if cat == Token.DIVIDE or 'float' in (left, right):
+            return 'float'
+        
+        elif left == 'int' and right == 'int':
+            return 'int'
+        
+        return 'num'
+    
+    if cat == Token.PLUS and left == 'str' and right == 'str':
+        return 'str'
+    
+    if cat == Token.TIMES and sorted((left, right)) == ['int', 'str']:
+        return 'str'
+    
+    return None
+
+
+def appended(name, node):
+    '''If the expression adds one or more strings to the end of the named
+    string variable, e.g. A$ + B$ + "!", returns closures calculating the
+    strings added, in order.  Otherwise returns None.
+    '''
+    
+    suffixes = []
+    while node.op == Token.PLUS and node.kind == 'str':
+        suffixes.append(node.args[1].closure())
+        node = node.args[0]
+    
+    if node.name != name or len(suffixes) == 0:
+        return None
+    
+    suffixes.reverse()
+    return suffixes
+
+
+def text(tokens):
+    '''Returns the BASIC text of a list of tokens.'''
+    
+    line_text = ''
+    for token in tokens:
+        if token.cat == Token.STRING:
+            line_text += '"' + token.val + '" '
+        else:
+            line_text += token.val + ' '
+    return line_text
+
+
+def repr_value(value):
+    '''Returns the BASIC text for a constant value.'''
+    
+    if isinstance(value, str):
+        return '"' + value + '"'
+    return str(value)
+
+
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,171 @@
+from tokens import Token
+from scanner import Scanner
+from sys import stderr
+
+
+class Debugger:
+    '''Breakpoints, single stepping, watched variables and tracing for a
+    program.  While none of these is in use the program's lines are run
+    without any checks.  Otherwise each run of the program's lines uses an
+    instrumented version of Program.execute(), which checks them around
+    each line.
+    '''
+    
+    def __init__(self, program, prompt=input):
+        self.program = program
+        self.prompt = prompt     # Reads a command while stopped
+        self.scanner = Scanner()
+        
+        self.breakpoints = set() # Lines to stop before
+        self.watches = {}        # Last value of each watched variable
+        self.tracing = False     # Whether to print each line number
+        self.stepping = False    # Whether to stop before the next line
+    
+    
+    def active(self):
+        '''Returns whether the program's lines need to be instrumented.'''
+        
+        return self.tracing or self.stepping or \
+                len(self.breakpoints) > 0 or len(self.watches) > 0
+    
+    
+    def instrument(self, execute):
+        '''Returns a version of the given execute method which traces the
+        line, stops before it if there is a breakpoint or the program is
+        being stepped through, and reports changes to watched variables.
+        '''
+        
+        def instrumented(line_num):
+            if self.tracing:
+                print('[' + str(line_num) + ']', end=' ', flush=True)
+            
+            if self.stepping or line_num in self.breakpoints:
+                self.pause(line_num)
+            
+            msg = execute(line_num)
+            
+            if len(self.watches) > 0:
+                self.check_watches(line_num)
+            
+            return msg
+        
+        return instrumented
+    
+    
+    def value(self, name):
+        '''Returns the value of a variable, or None if it is not set.'''
+        
+        parser = self.program.parser
+        if parser == None:
+            return None
+        
+        return parser.symbol_table.get(name)
+    
+    
+    def check_watches(self, line_num):
+        '''Prints the watched variables whose values were changed by the
+        given line.
+        '''
+        
+        for name, last in self.watches.items():
+            value = self.value(name)
+            if value != last:
+                self.watches[name] = value
+                print(name + ' = ' + str(value) + ' in line ' +
+                        str(line_num), flush=True)
+    
+    
+    def pause(self, line_num):
+        '''Stops before the given line, showing where the program is, and
+        carries out commands until told to continue with CONT, or to run
+        the line with STEP.  Other statements, e.g. PRINT to look at
+        variables or LET to change them, are executed immediately.
+        '''
+        
+        program = self.program
+        self.stepping = False
+        
+        print('Break in line ' + str(line_num), flush=True)
+        if len(program.return_stack) > 0:
+            print('GOSUB returns to ' +
+                    ' '.join(map(str, reversed(program.return_stack))))
+        
+        while True:
+            try:
+                tokenlist = self.scanner.tokenise(self.prompt('>> '))
+                if len(tokenlist) == 0:
+                    continue
+                
+                if tokenlist[0].cat == Token.CONT:
+                    return
+                
+                if tokenlist[0].cat == Token.STEP:
+                    self.stepping = True
+                    return
+                
+                if not self.command(tokenlist):
+                    parser = program.parser
+                    try:
+                        if parser.parse(line_num, tokenlist) != None:
+                            print('Cannot branch while stopped',
+                                    file=stderr, flush=True)
+                    
+                    finally:
+                        # The statement is not kept for reuse
+                        parser.plans.pop(id(tokenlist), None)
+                    
+                    # Changes made while stopped are not reported as made
+                    # by the line
+                    for name in self.watches:
+                        self.watches[name] = self.value(name)
+            
+            except EOFError:
+                raise
+            
+            except Exception as err:
+                print(err, file=stderr, flush=True)
+    
+    
+    def command(self, tokenlist):
+        '''Carries out a BREAK, WATCH or TRACE command, given its tokens.
+        Returns whether the tokens were one of these commands.
+        '''
+        
+        cat = tokenlist[0].cat
+        args = [token.val for token in tokenlist[1:]]
+        
+        if cat == Token.BREAK:
+            if len(args) == 0:
+                print('Breakpoints: ' +
+                        ' '.join(map(str, sorted(self.breakpoints))))
+            elif args[0] == 'OFF':
+                if len(args) == 1:
+                    self.breakpoints.clear()
+                else:
+                    self.breakpoints.discard(int(args[1]))
+            elif int(args[0]) not in self.program.program:
+                raise KeyError('Line number does not exist')
+            else:
+                self.breakpoints.add(int(args[0]))
+        
+        elif cat == Token.WATCH:
+            if len(args) == 0:
+                for name in self.watches:
+                    print(name + ' = ' + str(self.value(name)))
+            elif args[0] == 'OFF':
+                if len(args) == 1:
+                    self.watches.clear()
+                else:
+                    self.watches.pop(args[1], None)
+            else:
+                self.watches[args[0]] = self.value(args[0])
+        
+        elif cat == Token.TRACE:
+            if args not in (['ON'], ['OFF']):
+                raise SyntaxError('Expecting TRACE ON or TRACE OFF')
+            self.tracing = args[0] == 'ON'
+        
+        else:
+            return False
+        
+        return True
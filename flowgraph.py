@@ -0,0 +1,445 @@
+from tokens import Token
+from bisect import bisect_left, bisect_right, insort
+
+
+class LineFlow:
+    '''The control flow facts about a single program line, found from its
+    tokens.
+    '''
+    
+    def __init__(self):
+        # The (token index, line number) of each token holding a line
+        # number (jump targets and RESTORE lines), indexed so that the
+        # tokens can be changed when the program is renumbered
+        self.refs = []
+        
+        # Line numbers that the line may jump to, including subroutines
+        self.targets = []
+        
+        # Set when a jump target is only calculated at run time
+        self.dynamic = False
+        
+        # Whether execution may continue with the following line
+        self.falls_through = True
+        
+        # Set for lines that may be entered from somewhere other than the
+        # previous line or a jump, i.e. DEF lines, as a multi-line function
+        # is run when it is called
+        self.entry = False
+        
+        # Set for lines after which execution may continue following a
+        # jump, i.e. a subroutine's RETURN, or a jump past part of a
+        # structured statement, e.g. WEND or CASE
+        self.resumes = False
+        
+        # Set for lines starting a FOR, WHILE or DO loop, which the end of
+        # the loop jumps back to
+        self.loop_start = False
+        
+        # The loop variable, if the line starts with NEXT
+        self.next_var = None
+
+
+def analyse(tokens):
+    '''Returns the LineFlow of a line, given its tokens (without the line
+    number).  Statements start at the beginning of the line, after a colon
+    and after the THEN or ELSE of an IF statement, where a line number on
+    its own is a jump.
+    
+    >>> from scanner import Scanner
+    >>> def flow_of(line):
+    ...     flow = analyse(Scanner().tokenise(line)[1:])
+    ...     return flow.refs, flow.targets, flow.dynamic
+    >>> flow_of('10 OPEN "F" FOR INPUT AS #1 ELSE 90')
+    ([(8, 90)], [90], False)
+    >>> flow_of('10 OPEN "F" FOR INPUT AS #1 ELSE GOTO 90')
+    ([(9, 90)], [90], False)
+    '''
+    
+    flow = LineFlow()
+    if len(tokens) == 0:
+        return flow
+    
+    if tokens[0].cat == Token.NEXT and len(tokens) > 1:
+        flow.next_var = tokens[1].val
+    
+    conditional = False  # Within an IF statement
+    start = True
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        cat = token.cat
+        index += 1
+        
+        if cat == Token.COLON or \
+                (conditional and cat in (Token.THEN, Token.ELSE)):
+            start = True
+            continue
+        
+        if not start and not (conditional and
+                cat in (Token.GOTO, Token.GOSUB)):
+            continue
+        
+        start = False
+        
+        if cat == Token.IF:
+            conditional = True
+        
+        elif cat == Token.UNSIGNEDINT:
+            # A line number after THEN or ELSE
+            jump_target(flow, tokens, index - 1)
+        
+        elif cat in (Token.GOTO, Token.GOSUB):
+            jump_target(flow, tokens, index)
+            if cat == Token.GOSUB:
+                # A subroutine returns to the following line
+                flow.resumes = True
+            elif not conditional:
+                flow.falls_through = False
+        
+        elif cat == Token.RESTORE:
+            line_num = line_number(tokens, index)
+            if line_num != None:
+                flow.refs.append((index, line_num))
+        
+        elif cat == Token.ON:
+            while index < len(tokens) and \
+                    tokens[index].cat not in (Token.GOTO, Token.GOSUB):
+                index += 1
+            if index < len(tokens) and tokens[index].cat == Token.GOSUB:
+                flow.resumes = True
+            index += 1  # Advance past GOTO or GOSUB
+            while index < len(tokens) and \
+                    tokens[index].cat in (Token.UNSIGNEDINT, Token.COMMA):
+                if tokens[index].cat == Token.UNSIGNEDINT:
+                    line_num = int(tokens[index].val)
+                    flow.refs.append((index, line_num))
+                    flow.targets.append(line_num)
+                index += 1
+        
+        elif cat == Token.OPEN:
+            # Branches to the line after ELSE, or ELSE GOTO, if the file 
+            # cannot be opened
+            while index < len(tokens) and tokens[index].cat != Token.COLON:
+                if tokens[index].cat == Token.ELSE:
+                    target = index + 1
+                    if target < len(tokens) and \
+                            tokens[target].cat == Token.GOTO:
+                        target += 1
+                    jump_target(flow, tokens, target)
+                index += 1
+        
+        elif cat == Token.STOP:
+            if index < len(tokens) and tokens[index].cat == Token.SELECT:
+                flow.resumes = True  # END SELECT
+            elif not conditional:
+                flow.falls_through = False
+        
+        elif cat in (Token.RETURN, Token.CHAIN, Token.EXIT, Token.SELECT,
+                Token.CASE):
+            # SELECT jumps past a CASE or END SELECT, as does a CASE reached
+            # from the end of the previous case, and EXIT past the end of
+            # its loop
+            if not conditional:
+                flow.falls_through = False
+            if cat == Token.CASE:
+                flow.resumes = True
+        
+        elif cat in (Token.NEXT, Token.WEND, Token.LOOP, Token.FNEND):
+            flow.resumes = True
+        
+        elif cat in (Token.FOR, Token.WHILE, Token.DO):
+            flow.loop_start = True
+        
+        elif cat == Token.DEF:
+            flow.entry = True
+    
+    return flow
+
+
+def line_number(tokens, index):
+    '''Returns the line number held by the token at the given index if it
+    is a line number on its own, rather than the start of an expression,
+    or None.
+    '''
+    
+    if index < len(tokens) and tokens[index].cat == Token.UNSIGNEDINT and \
+            (index + 1 == len(tokens) or
+            tokens[index + 1].cat in (Token.COLON, Token.ELSE)):
+        return int(tokens[index].val)
+    
+    return None
+
+
+def jump_target(flow, tokens, index):
+    '''Records the jump whose target expression starts at the given index.
+    The target is only known before the program is run if it is a line
+    number on its own.
+    '''
+    
+    line_num = line_number(tokens, index)
+    if line_num != None:
+        flow.refs.append((index, line_num))
+        flow.targets.append(line_num)
+    else:
+        flow.dynamic = True
+
+
+class FlowGraph:
+    '''A control flow graph of a program, shared by the parts of the
+    interpreter that need to know how control passes between its lines:
+    renumbering, finding undefined jump targets, removing unreachable lines
+    and pairing FOR loops with their NEXT statements.
+    
+    Each line is analysed once, when it is added, and the graph is updated
+    as lines are added and deleted, so editing a line in a large program
+    does not mean analysing all of it again.  The basic blocks, runs of
+    lines which are entered only at the first and left only at the last,
+    are found again when next needed after a change.
+    '''
+    
+    def __init__(self):
+        self.flows = {}        # LineFlow of each line
+        self.line_nums = []    # Sorted line numbers
+        self.referrers = {}    # Lines referring to each line number
+        self.next_lines = {}   # Sorted NEXT lines of each loop variable
+        self.dynamic = set()   # Lines with jumps calculated at run time
+        
+        # Starting line of each basic block, found when needed
+        self.leaders = None
+    
+    
+    def clear(self):
+        '''Removes every line.'''
+        
+        self.flows.clear()
+        self.line_nums.clear()
+        self.referrers.clear()
+        self.next_lines.clear()
+        self.dynamic.clear()
+        self.leaders = None
+    
+    
+    def add_line(self, line_num, tokens):
+        '''Adds a line given its tokens (without the line number),
+        replacing any line with the same number.
+        '''
+        
+        if line_num in self.flows:
+            self.unlink(line_num)
+        else:
+            insort(self.line_nums, line_num)
+        
+        flow = analyse(tokens)
+        self.flows[line_num] = flow
+        
+        for index, target in flow.refs:
+            self.referrers.setdefault(target, set()).add(line_num)
+        
+        if flow.next_var != None:
+            insort(self.next_lines.setdefault(flow.next_var, []), line_num)
+        
+        if flow.dynamic:
+            self.dynamic.add(line_num)
+        
+        self.leaders = None
+    
+    
+    def remove_line(self, line_num):
+        '''Removes a line, if present.'''
+        
+        if line_num in self.flows:
+            self.unlink(line_num)
+            del self.flows[line_num]
+            del self.line_nums[bisect_right(self.line_nums, line_num) - 1]
+            self.leaders = None
+    
+    
+    def unlink(self, line_num):
+        '''Removes the entries for a line from the indexes.'''
+        
+        flow = self.flows[line_num]
+        for index, target in flow.refs:
+            referrers = self.referrers.get(target)
+            if referrers != None:
+                referrers.discard(line_num)
+                if len(referrers) == 0:
+                    del self.referrers[target]
+        
+        if flow.next_var != None:
+            next_lines = self.next_lines[flow.next_var]
+            next_lines.remove(line_num)
+            if len(next_lines) == 0:
+                del self.next_lines[flow.next_var]
+        
+        self.dynamic.discard(line_num)
+    
+    
+    def renumber(self, match):
+        '''Changes line numbers, given a dict of the new number of each of
+        a run of consecutive lines, which must keep the lines in order.
+        The references to the renumbered lines are changed to match, found
+        from the index of the lines referring to each line, so that the
+        lines are not analysed again.
+        '''
+        
+        def renumbered(line_num):
+            return match.get(line_num, line_num)
+        
+        # The references held by the lines referring to renumbered lines
+        referring = set()
+        for line_num in match:
+            referring.update(self.referrers.get(line_num, ()))
+        
+        for line_num in referring:
+            flow = self.flows[line_num]
+            flow.refs = [(index, renumbered(target))
+                    for index, target in flow.refs]
+            flow.targets = [renumbered(target) for target in flow.targets]
+        
+        self.referrers = {renumbered(target): set(map(renumbered, referrers))
+                for target, referrers in self.referrers.items()}
+        
+        # Renumbered lines may take numbers other renumbered lines had, so
+        # they are all removed before any is added back
+        flows = [(match[line_num], self.flows.pop(line_num))
+                for line_num in match]
+        self.flows.update(flows)
+        
+        if len(match) > 0:
+            start = bisect_left(self.line_nums, min(match))
+            end = start + len(match)
+            self.line_nums[start:end] = sorted(match.values())
+        
+        self.next_lines = {loop_var: list(map(renumbered, next_lines))
+                for loop_var, next_lines in self.next_lines.items()}
+        self.dynamic = set(map(renumbered, self.dynamic))
+        self.leaders = None
+    
+    
+    def references(self, line_num):
+        '''Returns the sorted numbers of the lines referring to a line.'''
+        
+        return sorted(self.referrers.get(line_num, ()))
+    
+    
+    def undefined(self):
+        '''Returns the references to lines that do not exist, as a sorted
+        list of (referring line number, missing line number).
+        '''
+        
+        missing = []
+        for target, referrers in self.referrers.items():
+            if target not in self.flows:
+                for line_num in referrers:
+                    missing.append((line_num, target))
+        
+        return sorted(missing)
+    
+    
+    def loop_end(self, line_num, loop_var):
+        '''Returns the number of the first line after the given one that
+        starts with NEXT for the loop variable, or None.
+        '''
+        
+        next_lines = self.next_lines.get(loop_var)
+        if next_lines != None:
+            index = bisect_right(next_lines, line_num)
+            if index < len(next_lines):
+                return next_lines[index]
+        
+        return None
+    
+    
+    def blocks(self):
+        '''Returns the basic blocks of the program, as a list of (first line
+        number, last line number).
+        '''
+        
+        leaders = self.find_leaders()
+        ends = [self.line_nums[bisect_right(self.line_nums, leader) - 2]
+                for leader in leaders[1:]]
+        if len(leaders) > 0:
+            ends.append(self.line_nums[-1])
+        
+        return list(zip(leaders, ends))
+    
+    
+    def find_leaders(self):
+        '''Returns the sorted first lines of the basic blocks.'''
+        
+        if self.leaders != None:
+            return self.leaders
+        
+        flows = self.flows
+        leaders = set(self.line_nums[:1])
+        ends_block = False
+        for line_num in self.line_nums:
+            flow = flows[line_num]
+            if ends_block or flow.entry or flow.loop_start:
+                leaders.add(line_num)
+            
+            ends_block = len(flow.targets) > 0 or flow.dynamic or \
+                    flow.resumes or not flow.falls_through
+            
+            leaders.update(target for target in flow.targets
+                    if target in flows)
+        
+        self.leaders = sorted(leaders)
+        return self.leaders
+    
+    
+    def reachable(self):
+        '''Returns the set of line numbers that may be executed when the
+        program is run, found by following the edges between the basic
+        blocks from the first line, and from the lines that structured
+        statements can continue at.
+        '''
+        
+        if len(self.dynamic) > 0:
+            return set(self.line_nums)
+        
+        line_nums = self.line_nums
+        flows = self.flows
+        blocks = self.blocks()
+        first_lines = {first: index for index, (first, last) in
+                enumerate(blocks)}
+        
+        # Blocks where execution can start other than by a jump or from the
+        # previous block
+        pending = [0] if len(blocks) > 0 else []
+        for index in range(1, len(blocks)):
+            first = blocks[index][0]
+            previous = blocks[index - 1][1]
+            if flows[first].entry or flows[previous].resumes:
+                pending.append(index)
+        
+        seen = set(pending)
+        while len(pending) > 0:
+            index = pending.pop()
+            last = blocks[index][1]
+            flow = flows[last]
+            
+            successors = [first_lines[target] for target in flow.targets
+                    if target in flows]
+            if flow.falls_through and index + 1 < len(blocks):
+                successors.append(index + 1)
+            
+            for successor in successors:
+                if successor not in seen:
+                    seen.add(successor)
+                    pending.append(successor)
+        
+        reached = set()
+        for index in seen:
+            first, last = blocks[index]
+            start = bisect_right(line_nums, first) - 1
+            end = bisect_right(line_nums, last)
+            reached.update(line_nums[start:end])
+        
+        return reached
+
+
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,544 @@
+from tokens import Token
+from math import pi, sqrt, atan, cos, exp, floor, log, sin, tan
+from random import Random
+from functools import lru_cache
+import random as random_module
+
+
+class Function:
+    '''Describes a BASIC function: the Python function that implements it,
+    the number of arguments it takes and the kind of value it returns.
+    
+    The implementation is called with the line number of the statement
+    being executed, for use in error messages, followed by the values of
+    the arguments.
+    '''
+    
+    def __init__(self, name, fn, min_args, max_args=None, kind=None,
+            pure=True):
+        self.name = name          # Name of the function as used in BASIC
+        self.fn = fn              # Implementation of the function
+        self.min_args = min_args  # Fewest arguments accepted
+        self.max_args = max_args  # Most arguments accepted, None if no limit
+        
+        # Kind of value returned: 'int', 'float', 'num' (either int or float),
+        # 'str', 'args' if the same kind as the arguments, or None if unknown
+        self.kind = kind
+        
+        # Whether the result depends only on the arguments, so that the
+        # function can be evaluated when the program is compiled if the
+        # arguments are constant
+        self.pure = pure
+    
+    
+    def check_args(self, num_args, line_num):
+        '''Raises an error if the function cannot take the given number
+        of arguments.
+        '''
+        
+        if num_args < self.min_args or \
+                (self.max_args != None and num_args > self.max_args):
+            raise SyntaxError('Wrong number of arguments supplied to ' + \
+                    self.name + ' in line ' + str(line_num))
+
+
+class UserFunction:
+    '''A function defined in the BASIC program with DEF FN.  The body is a
+    closure that calculates the value of the function, which is called
+    with the parameters bound to the arguments in the symbol table.  The
+    previous values of the parameters are restored after the call, so the
+    parameters are local to the function.
+    
+    The body of a multi-line function (DEF FN ... FNEND) sets the result
+    by assigning to the function name, which is therefore also local.
+    
+    If a cache size is given, results are memoised in a least recently
+    used cache of that size.  This is only correct if the result depends
+    on nothing but the arguments.
+    '''
+    
+    def __init__(self, name, params, body, symbol_table, cache_size=None,
+            multiline=False):
+        self.name = name                  # Function name, e.g. FNA
+        self.params = params              # Parameter names
+        self.body = body                  # Closure calculating the value
+        self.symbol_table = symbol_table
+        
+        # Whether any parameter is an integer (%) variable
+        self.integer_params = any(param.endswith('%') for param in params)
+        
+        # Variables local to the function
+        self.local_names = list(params)
+        if multiline:
+            self.local_names.append(name)
+        
+        self.evaluate = self.bind
+        if cache_size != None:
+            self.evaluate = lru_cache(maxsize=cache_size, typed=True)(self.bind)
+    
+    
+    def call(self, line_num, args):
+        '''Calls the function with the given argument values.'''
+        
+        if len(args) != len(self.params):
+            raise RuntimeError('Wrong number of arguments supplied to ' + \
+                    self.name + ' in line ' + str(line_num))
+        
+        for param, arg in zip(self.params, args):
+            if param.endswith('$') != isinstance(arg, str):
+                raise TypeError('Invalid type supplied to ' + self.name + \
+                        ' in line ' + str(line_num))
+        
+        if self.integer_params:
+            args = [to_integer(line_num, arg) if param.endswith('%') else arg
+                    for param, arg in zip(self.params, args)]
+        
+        result = self.evaluate(*args)
+        if self.name.endswith('$') != isinstance(result, str):
+            raise TypeError('Invalid type returned by ' + self.name + \
+                    ' in line ' + str(line_num))
+        
+        if self.name.endswith('%'):
+            return to_integer(line_num, result)
+        
+        return result
+    
+    
+    def bind(self, *args):
+        '''Evaluates the body with the parameters bound to the arguments.'''
+        
+        symbol_table = self.symbol_table
+        saved = [symbol_table.get(name, unbound) for name in self.local_names]
+        
+        for param, arg in zip(self.params, args):
+            symbol_table[param] = arg
+        
+        try:
+            return self.body()
+        
+        finally:
+            for name, value in zip(self.local_names, saved):
+                if value is unbound:
+                    symbol_table.pop(name, None)
+                else:
+                    symbol_table[name] = value
+
+
+def to_integer(line_num, value):
+    '''Converts a numeric value for storage in an integer (%) variable or
+    array, rounding it to the nearest integer (halves to even, as QBASIC
+    does).
+    '''
+    
+    if isinstance(value, int):
+        return int(value)
+    
+    try:
+        return round(value)
+    
+    except TypeError:
+        raise TypeError('Attempt to assign string to integer variable ' + \
+                'in line ' + str(line_num))
+    
+    except (ValueError, OverflowError):
+        raise ValueError('Invalid value for integer variable in line ' + \
+                str(line_num))
+
+
+class RandomSource:
+    '''The generator of the random numbers used by RND, RNDINT, MAT ... =
+    RND and RANDOMIZE.  It has a generator of its own, so the values that
+    follow RANDOMIZE with a seed are the same every time the program is
+    run, whatever else in the process uses the random module.
+    
+    Programs that depend on the values given for a seed by earlier
+    versions, which used the random module's shared generator, can use
+    RANDOMIZE LEGACY to use that generator again for the rest of the run.
+    Calling use_legacy(True) uses it for every run.
+    '''
+    
+    def __init__(self, legacy=False):
+        self.use_legacy(legacy)
+    
+    
+    def use_legacy(self, legacy):
+        '''Chooses between a generator of its own and, for compatibility,
+        the shared generator of the random module, for every run.
+        '''
+        
+        self.default_legacy = legacy
+        self.select(legacy)
+    
+    
+    def restore(self):
+        '''Chooses the generator given to use_legacy() again, as a program
+        starts to run.  The generator of its own is kept if already in use,
+        rather than replaced.
+        '''
+        
+        if self.legacy != self.default_legacy:
+            self.select(self.default_legacy)
+    
+    
+    def select(self, legacy):
+        '''Chooses between the generators for the rest of the run.'''
+        
+        self.legacy = legacy
+        self.generator = random_module if legacy else Random()
+        
+        # Bound directly, as RND is called in tight loops
+        self.random = self.generator.random
+        self.seed = self.generator.seed
+    
+    
+    def randint(self, lo, hi):
+        '''Returns a random integer N, where lo <= N <= hi.'''
+        
+        # Scaling a random float is several times quicker than randint(),
+        # and uniform while the range is within the float's precision
+        if not self.legacy and type(lo) is int and type(hi) is int and \
+                0 <= hi - lo < 1 << 53:
+            return lo + int(self.random() * (hi - lo + 1))
+        
+        return self.generator.randint(lo, hi)
+    
+    
+    def fill(self, count):
+        '''Returns a list of count random numbers N, where 0 <= N < 1.'''
+        
+        random = self.random
+        return [random() for _ in range(count)]
+    
+    
+    def fill_int(self, lo, hi, count):
+        '''Returns a list of count random integers N, where lo <= N <= hi.'''
+        
+        randint = self.randint
+        return [randint(lo, hi) for _ in range(count)]
+
+
+# The random number generator used by programs
+random_source = RandomSource()
+
+
+# Marks a local variable which had no value before a function call
+unbound = object()
+
+
+# Number of results kept by DEF FN ... CACHE if no size is given
+default_cache_size = 128
+
+
+def fn_rnd(line_num, arg):
+    # Old BASIC would return the same value if given 0 (zero) as
+    # argument.  This is not implemented.
+    # A negative argument would reseed the generator.
+    # Otherwise returns a random value between 0 and 1.
+    if arg < 0:
+        random_source.seed(arg)
+    
+    return random_source.random()
+
+
+def fn_rndint(line_num, lo, hi):
+    try:
+        return random_source.randint(lo, hi)
+    
+    except ValueError:
+        raise ValueError('Invalid value supplied to RNDINT in line ' + \
+                str(line_num))
+
+
+def fn_pi(line_num):
+    return pi
+
+
+def fn_max(line_num, *value_list):
+    try:
+        return max(*value_list)
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to MAX in line ' + \
+                str(line_num))
+
+
+def fn_min(line_num, *value_list):
+    try:
+        return min(*value_list)
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to MIN in line ' + \
+                str(line_num))
+
+
+def fn_pow(line_num, base, exponent):
+    try:
+        return base ** exponent
+    
+    except ValueError:
+        raise ValueError('Invalid value supplied to POW in line ' + \
+                str(line_num))
+
+
+def fn_ternary(line_num, condition, whentrue, whenfalse):
+    return whentrue if condition else whenfalse
+
+
+def fn_left(line_num, instring, chars):
+    try:
+        return instring[:chars]
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to LEFT$ in line ' + \
+                str(line_num))
+
+
+def fn_right(line_num, instring, chars):
+    try:
+        return instring[-chars:]
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to RIGHT$ in line ' + \
+                str(line_num))
+
+
+def fn_mid(line_num, instring, start, chars=None):
+    try:
+        # Old BASIC dialects were always one-based
+        start -= 1
+        
+        if chars:
+            return instring[start:start+chars]
+        else:
+            return instring[start:]
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to MID$ in line ' + \
+                str(line_num))
+
+
+def mid_replace(line_num, instring, start, chars, replacement):
+    '''Returns the string with its characters from the one-based start
+    position replaced, as by MID$(A$, start, chars) = replacement.  At
+    most chars characters are replaced, and never more than the length of
+    the replacement, so the length of the string is unchanged.
+    '''
+    
+    if not isinstance(instring, str) or not isinstance(replacement, str) \
+            or not isinstance(start, int) or \
+            (chars != None and not isinstance(chars, int)):
+        raise TypeError('Invalid type supplied to MID$ in line ' + \
+                str(line_num))
+    
+    if start < 1 or start > len(instring) or (chars != None and chars < 0):
+        raise ValueError('Invalid value supplied to MID$ in line ' + \
+                str(line_num))
+    
+    # Old BASIC dialects were always one-based
+    start -= 1
+    
+    count = len(replacement)
+    if chars != None:
+        count = min(count, chars)
+    count = min(count, len(instring) - start)
+    
+    return instring[:start] + replacement[:count] + instring[start+count:]
+
+
+def fn_instr(line_num, haystackstring, needlestring, start=None, end=None):
+    if not isinstance(haystackstring, str):
+        raise TypeError('Invalid type supplied to INSTR in line ' + \
+                str(line_num))
+    
+    try:
+        # Old BASIC dialects were always one-based
+        if start != None:
+            start -= 1
+        
+        if end != None:
+            end -= 1
+        
+        # Old BASIC dialects are one-based, so the return value needs
+        # to be incremented by one.  ALSO, this moves the -1 not found
+        # value to 0 (this indicated not found in most dialects).
+        return haystackstring.find(needlestring, start, end) + 1
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to INSTR in line ' + \
+                str(line_num))
+
+
+def math_function(name, fn, exception=ValueError):
+    '''Returns the implementation of a function of one argument which
+    reports the given exception with the function name and line number.
+    '''
+    
+    if exception == ValueError:
+        problem = 'value'
+    else:
+        problem = 'type'
+    
+    def function(line_num, value):
+        try:
+            return fn(value)
+        
+        except exception:
+            raise exception('Invalid ' + problem + ' supplied to ' + name + \
+                    ' in line ' + str(line_num))
+    
+    return function
+
+
+def fn_chr(line_num, value):
+    try:
+        return chr(value)
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to CHR$ in line ' + \
+                str(line_num))
+    
+    except ValueError:
+        raise ValueError('Invalid value supplied to CHR$ in line ' + \
+                str(line_num))
+
+
+def fn_asc(line_num, value):
+    try:
+        return ord(value)
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to ASC in line ' + \
+                str(line_num))
+    
+    except ValueError:
+        raise ValueError('Invalid value supplied to ASC in line ' + \
+                str(line_num))
+
+
+def fn_str(line_num, value):
+    return str(value)
+
+
+def fn_val(line_num, value):
+    try:
+        numeric = float(value)
+        if int(numeric) == numeric:
+            return int(numeric)
+        return numeric
+    
+    # BASIC returns zero for non-numeric argument
+    except ValueError:
+        return 0
+
+
+def fn_len(line_num, value):
+    try:
+        return len(value)
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to LEN in line ' + \
+                str(line_num))
+
+
+def fn_upper(line_num, value):
+    if not isinstance(value, str):
+        raise TypeError('Invalid type supplied to UPPER$ in line ' + \
+                str(line_num))
+    
+    return value.upper()
+
+
+def fn_lower(line_num, value):
+    if not isinstance(value, str):
+        raise TypeError('Invalid type supplied to LOWER$ in line ' + \
+                str(line_num))
+    
+    return value.lower()
+
+
+def fn_tab(line_num, value):
+    if isinstance(value, int):
+        return ' ' * value
+    
+    else:
+        raise TypeError('Invalid type supplied to TAB in line ' + \
+                str(line_num))
+
+
+def fn_exists(line_num, BASICmap, key):
+    if not isinstance(BASICmap, dict):
+        raise TypeError('Invalid type supplied to EXISTS in line ' + \
+                str(line_num))
+    
+    try:
+        return key in BASICmap
+    
+    except TypeError:
+        raise TypeError('Invalid type supplied to EXISTS in line ' + \
+                str(line_num))
+
+
+# Dispatch table giving the function for each function token
+function_table = {
+    Token.RND: Function('RND', fn_rnd, 1, 1, 'float', pure=False),
+    Token.RNDINT: Function('RNDINT', fn_rndint, 2, 2, 'int', pure=False),
+    Token.PI: Function('PI', fn_pi, 0, 0, 'float'),
+    Token.MAX: Function('MAX', fn_max, 1, None, 'args'),
+    Token.MIN: Function('MIN', fn_min, 1, None, 'args'),
+    Token.POW: Function('POW', fn_pow, 2, 2, 'num'),
+    Token.TERNARY: Function('IFF', fn_ternary, 3, 3, 'args'),
+    Token.LEFT: Function('LEFT$', fn_left, 2, 2, 'str'),
+    Token.RIGHT: Function('RIGHT$', fn_right, 2, 2, 'str'),
+    Token.MID: Function('MID$', fn_mid, 2, 3, 'str'),
+    Token.INSTR: Function('INSTR', fn_instr, 2, 4, 'int'),
+    Token.SQR: Function('SQR', math_function('SQR', sqrt), 1, 1, 'float'),
+    Token.ABS: Function('ABS', math_function('ABS', abs), 1, 1, 'args'),
+    Token.ATN: Function('ATN', math_function('ATN', atan), 1, 1, 'float'),
+    Token.COS: Function('COS', math_function('COS', cos), 1, 1, 'float'),
+    Token.EXP: Function('EXP', math_function('EXP', exp), 1, 1, 'float'),
+    Token.INT: Function('INT', math_function('INT', floor), 1, 1, 'int'),
+    Token.ROUND: Function('ROUND', math_function('ROUND', round, TypeError),
+            1, 1, 'int'),
+    Token.LOG: Function('LOG', math_function('LOG', log), 1, 1, 'float'),
+    Token.SIN: Function('SIN', math_function('SIN', sin), 1, 1, 'float'),
+    Token.TAN: Function('TAN', math_function('TAN', tan), 1, 1, 'float'),
+    Token.CHR: Function('CHR$', fn_chr, 1, 1, 'str'),
+    Token.ASC: Function('ASC', fn_asc, 1, 1, 'int'),
+    Token.STR: Function('STR$', fn_str, 1, 1, 'str'),
+    Token.VAL: Function('VAL', fn_val, 1, 1, 'num'),
+    Token.LEN: Function('LEN', fn_len, 1, 1, 'int'),
+    Token.UPPER: Function('UPPER$', fn_upper, 1, 1, 'str'),
+    Token.LOWER: Function('LOWER$', fn_lower, 1, 1, 'str'),
+    Token.TAB: Function('TAB', fn_tab, 1, 1, 'str'),
+    Token.EXISTS: Function('EXISTS', fn_exists, 2, 2, 'int', pure=False),
+    }
+
+
+def register_function(name, fn, min_args, max_args=None, kind=None,
+        pure=False):
+    '''Adds a native function, implemented in Python, to the language.
+    The function is called with the values of its arguments, and the name
+    becomes a reserved word.  For example:
+    
+    register_function('HYPOT', math.hypot, 2, 2, 'float', pure=True)
+    
+    allows PRINT HYPOT(3, 4) in a BASIC program.  The registration must be
+    made before any program using the function is entered or loaded.
+    '''
+    
+    name = name.upper()
+    if name in Token.keywords:
+        raise ValueError(name + ' is already a reserved word')
+    
+    def native(line_num, *args):
+        return fn(*args)
+    
+    # Allocate a new token category for the function
+    cat = len(Token.catnames)
+    Token.catnames += (name,)
+    Token.keywords[name] = cat
+    Token.functions += (cat,)
+    
+    function_table[cat] = Function(name, native, min_args, max_args, kind,
+            pure)
+    return cat
@@ -0,0 +1,56 @@
+from sys import getsizeof
+from array import array
+
+
+def size_of(value, seen):
+    '''Returns the memory used by a value, in bytes, as given by
+    sys.getsizeof() for the value and everything it holds: the items of
+    lists, tuples, sets and dicts, and the attributes of objects such as
+    a BASICArray or a Token.  Objects whose ids are in the seen set are
+    not counted again, so that objects shared, e.g. the zeros filling a
+    new array, are counted once.
+    
+    >>> size_of([1.5, 1.5], set()) == getsizeof([]) + 16 + getsizeof(1.5)
+    True
+    '''
+    
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    
+    size = getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += size_of(item, seen)
+    
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            size += size_of(key, seen) + size_of(item, seen)
+    
+    elif hasattr(value, '__dict__'):
+        size += size_of(vars(value), seen)
+    
+    return size
+
+
+def compact_size(BASICarray):
+    '''Returns the memory that the elements of a numeric array would use
+    if each of its rows were held as an array of 64 bit floating point
+    numbers, array('d'), rather than as a list of Python numbers, 
+    including the lists holding the rows.
+    '''
+    
+    data = BASICarray.data
+    size = sum(getsizeof(array('d')) + len(row) * 8 
+            for row in BASICarray.rows())
+    if BASICarray.dims > 1:
+        size += getsizeof(data)
+    if BASICarray.dims > 2:
+        size += sum(getsizeof(plane) for plane in data)
+    
+    return size
+
+
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
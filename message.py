@@ -52,7 +52,29 @@ class Msg:
     
     # Indication that a conditional result block should be executed.
     EXECUTE = 7
-
+    
+    # A structured loop (WHILE or DO) is to be left, either because its 
+    # condition has failed or because of an EXIT statement.  The target 
+    # should be the line number of the end of the loop (WEND or LOOP), 
+    # execution continuing with the following line, and the loop_var is 
+    # the key of the loop.
+    LOOP_EXIT = 8
+    
+    # Execution is to continue with the line following the target line, 
+    # used by SELECT CASE to enter the block after the matching CASE and 
+    # to leave the SELECT after its END SELECT.
+    JUMP_PAST = 9
+    
+    # The program is to be replaced by the one in another file, which is 
+    # then run, as the result of a CHAIN statement.  The target should be 
+    # the file name.
+    CHAIN = 10
+    
+    # Printable names for each type
+    typenames = ('SIMPLE_JUMP', 'GOSUB', 'LOOP_BEGIN', 'LOOP_REPEAT', 
+        'LOOP_SKIP', 'RETURN', 'STOP', 'EXECUTE', 'LOOP_EXIT', 'JUMP_PAST', 
+        'CHAIN')
+    
     def __init__(self, target=None, type=SIMPLE_JUMP, loop_var=None):
         '''Creates a new Msg for a branch.  If the jump target is supplied, 
         then the branch is assumed to be either a GOTO or conditional branch 
@@ -64,11 +86,12 @@ class Msg:
         
         if type not in (self.GOSUB, self.SIMPLE_JUMP, self.LOOP_BEGIN, 
                 self.LOOP_REPEAT, self.RETURN, self.LOOP_SKIP, self.STOP, 
-                self.EXECUTE):
+                self.EXECUTE, self.LOOP_EXIT, self.JUMP_PAST, self.CHAIN):
             raise TypeError('Invalid Msg type supplied: ' + str(type))
         
         if target == None and \
-                type in [self.SIMPLE_JUMP, self.GOSUB, self.LOOP_SKIP]:
+                type in [self.SIMPLE_JUMP, self.GOSUB, self.LOOP_SKIP, 
+                self.LOOP_EXIT, self.JUMP_PAST, self.CHAIN]:
             raise TypeError('Invalid jump target supplied Msg type: ' + str(target))
         
         if target != None and \
@@ -80,3 +103,29 @@ class Msg:
         self.type = type
         self.loop_var = loop_var
 
+
+# Messages without a target or loop variable are never changed once created,
+# so one of each is shared rather than a new one being created for every
+# statement that returns one
+return_msg = Msg(type=Msg.RETURN)
+stop_msg = Msg(type=Msg.STOP)
+execute_msg = Msg(type=Msg.EXECUTE)
+
+
+# Shared jump messages, by type and then target
+jump_msgs = {Msg.SIMPLE_JUMP: {}, Msg.GOSUB: {}}
+
+
+def jump_msg(target, type=Msg.SIMPLE_JUMP):
+    '''Returns a message for a jump (SIMPLE_JUMP or GOSUB) to the target
+    line, shared with the other jumps of the same type to the same line,
+    for jumps whose target is only known when they are executed.
+    '''
+    
+    msgs = jump_msgs[type]
+    msg = msgs.get(target)
+    if msg == None:
+        msg = Msg(target=target, type=type)
+        msgs[target] = msg
+    
+    return msg
@@ -0,0 +1,67 @@
+from os import replace
+
+
+# Metrics which only ever increase during a run, exported as counters
+counters = ('statements', 'jumps', 'bytes_read', 'bytes_written',
+        'data_values_read', 'arrays_allocated', 'block_executions')
+
+# Label of the samples of each metric whose value is a dict, if not type
+labels = {'block_executions': 'block'}
+
+
+def prometheus_text(metrics, prefix='basic_'):
+    '''Returns the metrics in the Prometheus text exposition format.  A
+    metric whose value is a dict, e.g. the jumps of each type, is written
+    as one sample per key, labelled with the key as its type (or, for the
+    block executions, its block).  Values which are not numbers are left 
+    out.
+    
+    >>> print(prometheus_text({'statements': 5, 'jumps': {'GOSUB': 2}}), end='')
+    # TYPE basic_statements_total counter
+    basic_statements_total 5
+    # TYPE basic_jumps_total counter
+    basic_jumps_total{type="GOSUB"} 2
+    '''
+    
+    lines = []
+    for key, value in metrics.items():
+        name = prefix + key
+        if key in counters:
+            name += '_total'
+            kind = 'counter'
+        else:
+            kind = 'gauge'
+        
+        if isinstance(value, dict):
+            label_name = labels.get(key, 'type')
+            samples = [(name + '{' + label_name + '="' + str(label) + '"}', 
+                    sample) for label, sample in value.items()]
+        else:
+            samples = [(name, value)]
+        
+        samples = [(series, sample) for series, sample in samples
+                if isinstance(sample, (int, float)) and
+                not isinstance(sample, bool)]
+        if len(samples) > 0:
+            lines.append('# TYPE ' + name + ' ' + kind + '\n')
+            lines.extend(series + ' ' + str(sample) + '\n'
+                    for series, sample in samples)
+    
+    return ''.join(lines)
+
+
+def write_prometheus(path, metrics):
+    '''Writes the metrics to a file in the Prometheus text format.  The
+    file is replaced in one step, so that a collector reading it never
+    sees it half written.
+    '''
+    
+    with open(path + '.tmp', 'w') as outfile:
+        outfile.write(prometheus_text(metrics))
+    
+    replace(path + '.tmp', path)
+
+
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
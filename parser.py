@@ -1,8 +1,34 @@
 from tokens import Token
-from message import Msg
-from math import pi, sqrt, atan, cos, exp, floor, log, sin, tan
-from random import random, randint, seed
+from message import Msg, jump_msg, return_msg, stop_msg, execute_msg
+from functions import function_table, UserFunction, default_cache_size, \
+        mid_replace, to_integer, random_source
+from array import array
+from bisect import bisect_left
 from time import monotonic
+from struct import Struct
+from sys import byteorder
+from csv import reader
+from io import StringIO
+
+
+# The header of a file written by BSAVE: a signature, the type code of the
+# elements ('q' for 64 bit integers or 'd' for floating point numbers), the
+# byte order of the elements ('<' or '>'), the number of dimensions and the
+# size of each
+bsave_header = Struct('<4sccB3I')
+bsave_signature = b'BSAV'
+native_order = b'<' if byteorder == 'little' else b'>'
+
+
+def elem_type(name):
+    '''Returns the type of the elements of an array, given its name.'''
+    
+    if name.endswith('$'):
+        return 'str'
+    elif name.endswith('%'):
+        return 'int'
+    else:
+        return 'num'
 
 
 class BASICArray:
@@ -14,7 +40,9 @@ class BASICArray:
         '''Initialises an array object with the given number of dimensions; 
         maximum is three.
         Variable 'dimensions' is a list of dimension sizes.
-        Variable 'elem_type' indicates the item type, either 'str' or 'num'.
+        Variable 'elem_type' indicates the item type, either 'str', 'num' 
+        or 'int'.  The elements of an integer array are held as 64 bit 
+        integers in an array('q') for each row.
         '''
         
         self.dims = min(3, len(dimensions))
@@ -35,21 +63,28 @@ class BASICArray:
         # the last item at index = size
         if self.dims == 1:
             xd = dimensions[0] + 1
-            if elem_type == 'num':
+            if elem_type == 'int':
+                self.data = array('q', [0]) * xd
+            elif elem_type == 'num':
                 self.data = [0 for x in range(xd)]
             else:
                 self.data = ['' for x in range(xd)]
         elif self.dims == 2:
             xd, yd  = dimensions
             xd += 1; yd += 1
-            if elem_type == 'num':
+            if elem_type == 'int':
+                self.data = [ array('q', [0]) * yd for x in range(xd) ]
+            elif elem_type == 'num':
                 self.data = [ [0 for y in range(yd)] for x in range(xd) ]
             else:
                 self.data = [ ['' for y in range(yd)] for x in range(xd) ]
         else:
             xd, yd, zd = dimensions
             xd += 1; yd += 1; zd += 1
-            if elem_type == 'num':
+            if elem_type == 'int':
+                self.data = [ [ array('q', [0]) * zd for y in range(yd) ] 
+                        for x in range(xd) ]
+            elif elem_type == 'num':
                 self.data = [ [ [0 for z in range(zd)] for y in range(yd) ] 
                         for x in range(xd) ]
             else:
@@ -57,6 +92,119 @@ class BASICArray:
                         for x in range(xd) ]
     
     
+    def replace(self, values, start=0):
+        '''Replaces the elements of a one dimensional array from the given 
+        index onwards with the given values, keeping the kind of storage.
+        '''
+        
+        if isinstance(self.data, array):
+            self.data[start:] = array(self.data.typecode, values)
+        else:
+            self.data[start:] = values
+    
+    
+    def fill(self, generate):
+        '''Sets every element of the array, including those with a zero 
+        index, to values from generate(count), which returns a list of 
+        count values.  The values are produced a row at a time.
+        '''
+        
+        if self.dims == 1:
+            self.replace(generate(len(self.data)))
+        else:
+            for row in self.rows():
+                values = generate(len(row))
+                if isinstance(row, array):
+                    values = array(row.typecode, values)
+                row[:] = values
+    
+    
+    def rows(self):
+        '''Returns a list of the innermost rows holding the elements.'''
+        
+        if self.dims == 1:
+            return [self.data]
+        elif self.dims == 2:
+            return self.data
+        else:
+            return [row for plane in self.data for row in plane]
+    
+    
+    def sizes(self):
+        '''Returns the size of each dimension, as given to DIM.'''
+        
+        sizes = []
+        data = self.data
+        for dim in range(self.dims):
+            sizes.append(len(data) - 1)
+            data = data[0]
+        
+        return sizes
+    
+    
+    def tofile(self, outfile):
+        '''Writes the elements of a numeric array to a binary file, after 
+        a header giving their type, byte order and dimensions.  Each row is 
+        written with array.tofile(), so a one dimensional array is written 
+        at once.  The elements are written as 64 bit integers if they all 
+        are integers, and as floating point numbers otherwise.
+        '''
+        
+        rows = self.rows()
+        try:
+            rows = [row if isinstance(row, array) else array('q', row) 
+                    for row in rows]
+        
+        except (TypeError, OverflowError):
+            rows = [array('d', row) for row in rows]
+        
+        sizes = self.sizes() + [0] * (3 - self.dims)
+        outfile.write(bsave_header.pack(bsave_signature, 
+                rows[0].typecode.encode(), native_order, self.dims, *sizes))
+        for row in rows:
+            row.tofile(outfile)
+    
+    
+    @classmethod
+    def fromfile(cls, infile, elem_type):
+        '''Returns a numeric array read from a binary file written by 
+        tofile(), with the given element type, 'num' or 'int'.  An integer 
+        array can only be read from a file of integers.
+        '''
+        
+        header = infile.read(bsave_header.size)
+        if len(header) == bsave_header.size:
+            signature, typecode, order, dims, *sizes = \
+                    bsave_header.unpack(header)
+        
+        if len(header) != bsave_header.size or \
+                signature != bsave_signature or \
+                typecode not in (b'q', b'd') or dims not in (1, 2, 3):
+            raise ValueError('Not a BSAVE file')
+        
+        if elem_type == 'int' and typecode != b'q':
+            raise TypeError('Non-integer values for integer array')
+        
+        BASICarray = cls(sizes[:dims], elem_type)
+        for row in BASICarray.rows():
+            values = array(typecode.decode())
+            try:
+                values.fromfile(infile, len(row))
+            
+            except EOFError:
+                raise EOFError('BSAVE file is incomplete')
+            
+            if order != native_order:
+                values.byteswap()
+            
+            if isinstance(row, array):
+                row[:] = values
+            else:
+                row[:] = values.tolist()
+        
+        return BASICarray
+    
+    
     def __str__(self):
         return str(self.data)
 
@@ -79,8 +227,11 @@ class Parser:
         self.data_values = []
         
         # To be initialised as required for each statement
+        self.line_num = None
         self.tokenlist = []
         self.tokenindex = None
+        self.token = None
+        self.sign = 1
         
         # Previous message (msg) (determines initializion of loop variable
         self.last_msg = None
@@ -90,89 +241,124 @@ class Parser:
         
         # File handle list
         self.file_handles = {}
+        
+        # Functions defined with DEF FN, by name
+        self.user_functions = {}
+        
+        # Names of the variables declared by COMMON, which are kept when 
+        # another program is run by CHAIN
+        self.common = set()
+        
+        # The statements of each line parsed, by the id of its token list, 
+        # as (token list, {start index: statements})
+        self.plans = {}
+        
+        # Counts of file and DATA use, reported by Program.metrics()
+        self.reset_counts()
+    
+    
+    def reset(self):
+        '''Returns the parser to its initial state, ready for the program 
+        to be run again.  The symbol table is cleared rather than replaced, 
+        as compiled statements refer to it.
+        '''
+        
+        self.symbol_table.clear()
+        self.operand_stack.clear()
+        self.data_values.clear()
+        self.line_num = None
+        self.tokenlist = []
+        self.tokenindex = None
+        self.token = None
+        self.sign = 1
+        self.last_msg = None
+        self.prnt_column = 0
+        
+        for handle in self.file_handles.values():
+            handle.close()
+        self.file_handles.clear()
+        
+        self.user_functions.clear()
+        self.common.clear()
+        self.plans.clear()
+        self.reset_counts()
+    
+    
+    def reset_counts(self):
+        '''Zeroes the counts of the characters read from and written to 
+        files (bytes, for ASCII text), the DATA values read and the arrays 
+        allocated.
+        '''
+        
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.data_values_read = 0
+        self.arrays_allocated = 0
     
     
-    def parse(self, line_num, tokenlist):
+    def parse(self, line_num, tokenlist, start=0):
         '''Must be initialised with a list of tokens to be processed.  
         These tokens represent a BASIC statement without the line number.
         The line number is passed separately.  This method returns None 
         or a message object to indicate any branching necessary.
+        Parsing begins with the token at the start index, which is used 
+        for the THEN and ELSE blocks of IF statements.
         '''
         
         # Remember the line number to aid error reporting
         self.line_num = line_num
-        self.tokenlist = []
-        self.tokenindex = 0
-        linetokenindex = 0
-        for token in tokenlist:
-            # IF statements will always be the last statement processed on 
-            # a line so any colons found after an IF are part of the 
-            # conditionally executed statements and will be processed in 
-            # the recursive call to parse.
-            if token.cat == token.IF:
-                # Process IF statement to move tokenidex to the code block
-                # of the THEN or ELSE and then call PARSE recursively to 
-                # process that code block.
-                # This will terminate the token loop by RETURNing to 
-                # the calling module.
+        
+        # The statements are split out of the line once and kept, rather 
+        # than every time the line is executed
+        plans = self.plans.get(id(tokenlist))
+        if plans == None or plans[0] is not tokenlist:
+            plans = (tokenlist, {})
+            self.plans[id(tokenlist)] = plans
+        
+        statements = plans[1].get(start)
+        if statements == None:
+            statements = split_statements(tokenlist, start)
+            plans[1][start] = statements
+        
+        for statement, position in statements:
+            self.tokenlist = statement
+            self.tokenindex = 0
+            
+            # Assign the first token
+            self.token = statement[0]
+            
+            flow = self.stmt()
+            if position == None:
+                if flow:
+                    return flow
+            
+            elif flow and (flow.type == Msg.EXECUTE):
+                # IF statements will always be the last statement processed 
+                # on a line, so any colons found after an IF are part of 
+                # the conditionally executed statements and will be 
+                # processed in the recursive call to parse, which starts 
+                # with the THEN or ELSE block.
                 #
                 # **Warning** if an IF stmt is used in the THEN code block 
                 # or multiple IF statement are used in a THEN or ELSE block, 
                 # the block grouping is ambiguous and logical processing 
                 # may not function as expected.  There is no ambiguity when 
                 # single IF statements are placed within ELSE blocks.
-                linetokenindex += self.tokenindex
-                self.tokenindex = 0
-                self.tokenlist = tokenlist[linetokenindex:]
-                
-                # Assign the first token
-                self.token = self.tokenlist[0]
-                flow = self.stmt()  # process IF statement
-                if flow and (flow.type == Msg.EXECUTE):
-                    # Recursive call to process THEN / ELSE block
-                    try:
-                        return self.parse(line_num, tokenlist[linetokenindex + \
-                                self.tokenindex:])
-                    except RuntimeError as err:
-                        raise RuntimeError(str(err) + ' in line ' + \
-                                str(self.line_num))
-                else:
-                    # Branch on original syntax 'IF cond THEN lineno [ELSE lineno]'
-                    # In this syntax the then or else code block is not 
-                    # a legal basic statement so recursive processing can't 
-                    # be used
-                    return flow
-            elif token.cat == token.COLON:
-                # Found a COLON, process tokens found to this point
-                linetokenindex += self.tokenindex
-                self.tokenindex = 0
-                
-                # Assign the first token
-                self.token = self.tokenlist[self.tokenindex]
-                
-                flow = self.stmt()
-                if flow:
-                    return flow
-                
-                linetokenindex += 1
-                self.tokenlist = []
-            elif token.cat == token.ELSE and self.tokenlist[0].cat != token.OPEN:
-                # If we find an ELSE and we are not processing an OPEN 
-                # statement, we must be in a recursive call and processing 
-                # a THEN block.  Since we're processing the THEN block we are 
-                # done if we hit an ELSE.
-                break
+                try:
+                    return self.parse(line_num, tokenlist, 
+                            position + self.tokenindex)
+                except RuntimeError as err:
+                    raise RuntimeError(str(err) + ' in line ' + \
+                            str(self.line_num))
+            
             else:
-                self.tokenlist.append(token)
-        
-        # Reached end of statement, process tokens collected since last COLON 
-        # (or from start if no COLONs)
-        linetokenindex += self.tokenindex
-        self.tokenindex = 0
-        # Assign the first token
-        self.token = self.tokenlist[self.tokenindex]
+                # Branch on original syntax 'IF cond THEN lineno [ELSE lineno]'
+                # In this syntax the then or else code block is not 
+                # a legal basic statement so recursive processing can't 
+                # be used
+                return flow
         
-        return self.stmt()
+        return None
     
     
     def advance(self):
@@ -222,12 +408,16 @@ class Parser:
     def simplestmt(self):
         '''Parses simple statements, i.e. non-compound statements.'''
         
-        if self.token.cat == Token.NAME:
+        if self.token.cat in (Token.NAME, Token.FN):
+            # A multi-line function sets its result by assigning to its name
             self.assignmentstmt()
             return None
         if self.token.cat == Token.PRINT:
             self.printstmt()
             return None
+        if self.token.cat == Token.MID:
+            self.midassignmentstmt()
+            return None
         if self.token.cat == Token.LET:
             self.letstmt()
             return None
@@ -265,6 +455,53 @@ class Parser:
         if self.token.cat == Token.FSEEK:
             self.fseekstmt()
             return None
+        if self.token.cat == Token.DEF:
+            self.defstmt()
+            return None
+        if self.token.cat == Token.DELETE:
+            self.deletestmt()
+            return None
+        if self.token.cat == Token.KEYS:
+            self.keysstmt()
+            return None
+        if self.token.cat == Token.COMMON:
+            self.commonstmt()
+            return None
+        if self.token.cat == Token.CHAIN:
+            return self.chainstmt()
+        if self.token.cat == Token.SORT:
+            self.sortstmt()
+            return None
+        if self.token.cat == Token.SEARCH:
+            self.searchstmt()
+            return None
+        if self.token.cat == Token.MAT:
+            self.matstmt()
+            return None
+        if self.token.cat == Token.ERASE:
+            self.erasestmt()
+            return None
+        if self.token.cat == Token.BSAVE:
+            self.bsavestmt()
+            return None
+        if self.token.cat == Token.BLOAD:
+            self.bloadstmt()
+            return None
+        if self.token.cat == Token.LINE:
+            self.lineinputstmt()
+            return None
+        if self.token.cat == Token.READCSV:
+            self.readcsvstmt()
+            return None
+        if self.token.cat == Token.FNEND:
+            raise SyntaxError('FNEND without DEF FN in line ' + \
+                    str(self.line_num))
+        if self.token.cat in (Token.WHILE, Token.WEND, Token.DO, Token.LOOP, 
+                Token.EXIT, Token.SELECT, Token.CASE):
+            # Structured loops and SELECT CASE are matched up when the 
+            # program is compiled
+            raise SyntaxError('Unmatched or misplaced ' + self.token.val + \
+                    ' in line ' + str(self.line_num))
         # Ignore comments, but raise an error for anything else
         if self.token.cat != Token.REM:
             raise RuntimeError('Expecting program statement in line ' + \
@@ -278,10 +515,8 @@ class Parser:
         
         self.advance()   # Advance past PRINT
         
-        fileIO = False
+        outfile = None
         if self.token.cat == Token.HASH:
-            fileIO = True
-            
             # Process the # keyword
             self.consume(Token.HASH)
             
@@ -289,7 +524,8 @@ class Parser:
             self.expr()
             filenum = self.operand_stack.pop()
             
-            if self.file_handles.get(filenum) == None:
+            outfile = self.file_handles.get(filenum)
+            if outfile == None:
                 raise RuntimeError('PRINT: file #' + str(filenum) + \
                         ' not open in line ' + str(self.line_num))
             
@@ -302,28 +538,7 @@ class Parser:
         if not self.tokenindex >= len(self.tokenlist):
             prntTab = (self.token.cat == Token.TAB)
             self.logexpr()
-            
-            if prntTab:
-                if self.prnt_column >= len(self.operand_stack[-1]):
-                    if fileIO:
-                        self.file_handles[filenum].write('\n')
-                    else:
-                        print()
-                    self.prnt_column = 0
-                
-                current_pr_column = len(self.operand_stack[-1]) - self.prnt_column
-                self.prnt_column = len(self.operand_stack.pop()) - 1
-                if current_pr_column > 1:
-                    if fileIO:
-                        self.file_handles[filenum].write(' ' * (current_pr_column-1))
-                    else:
-                        print(' ' * (current_pr_column-1), end='')
-            else:
-                self.prnt_column += len(str(self.operand_stack[-1]))
-                if fileIO:
-                    self.file_handles[filenum].write(str(self.operand_stack.pop()))
-                else:
-                    print(self.operand_stack.pop(), end='')
+            self.print_item(self.operand_stack.pop(), prntTab, outfile)
             
             while self.token.cat == Token.SEMICOLON:
                 if self.tokenindex == len(self.tokenlist) - 1:
@@ -333,35 +548,44 @@ class Parser:
                 self.advance()
                 prntTab = (self.token.cat == Token.TAB)
                 self.logexpr()
-                
-                if prntTab:
-                    if self.prnt_column >= len(self.operand_stack[-1]):
-                        if fileIO:
-                            self.file_handles[filenum].write('\n')
-                        else:
-                            print()
-                        self.prnt_column = 0
-                    current_pr_column = len(self.operand_stack[-1]) - self.prnt_column
-                    if fileIO:
-                        self.file_handles[filenum].write(' ' * (current_pr_column-1))
-                    else:
-                        print(' ' * (current_pr_column-1), end='')
-                    self.prnt_column = len(self.operand_stack.pop()) - 1
-                else:
-                    self.prnt_column += len(str(self.operand_stack[-1]))
-                    if fileIO:
-                        self.file_handles[filenum].write(str(self.operand_stack.pop()))
-                    else:
-                        print(self.operand_stack.pop(), end='')
+                self.print_item(self.operand_stack.pop(), prntTab, outfile)
         
         # Final newline
-        if fileIO:
-            self.file_handles[filenum].write('\n')
-        else:
-            print()
+        self.print_text('\n', outfile)
         self.prnt_column = 0
     
     
+    def print_item(self, value, prntTab, outfile=None):
+        '''Prints a single item of a PRINT statement to the screen, or to 
+        the given file, keeping track of the print position.  If the item 
+        is a TAB, the print position is moved to the required column.
+        '''
+        
+        if prntTab:
+            if self.prnt_column >= len(value):
+                self.print_text('\n', outfile)
+                self.prnt_column = 0
+            
+            current_pr_column = len(value) - self.prnt_column
+            self.prnt_column = len(value) - 1
+            if current_pr_column > 1:
+                self.print_text(' ' * (current_pr_column-1), outfile)
+        else:
+            text = str(value)
+            self.prnt_column += len(text)
+            self.print_text(text, outfile)
+    
+    
+    def print_text(self, text, outfile=None):
+        '''Writes text to the screen, or to the given file.'''
+        
+        if outfile:
+            outfile.write(text)
+            self.bytes_written += len(text)
+        else:
+            print(text, end='')
+    
+    
     def letstmt(self):
         '''Parses LET statement, i.e. consumes the LET token.'''
         
@@ -378,7 +602,7 @@ class Parser:
         self.expr()
         
         # Set up and return message
-        return Msg(target=self.operand_stack.pop())
+        return jump_msg(self.operand_stack.pop())
     
     
     def gosubstmt(self):
@@ -390,7 +614,7 @@ class Parser:
         self.expr()
         
         # Set up and return message
-        return Msg(target=self.operand_stack.pop(), type=Msg.GOSUB)
+        return jump_msg(self.operand_stack.pop(), Msg.GOSUB)
     
     
     def returnstmt(self):
@@ -399,7 +623,7 @@ class Parser:
         self.advance()  # Advance past RETURN
         
         # Set up and return message
-        return Msg(type=Msg.RETURN)
+        return return_msg
     
     
     def stopstmt(self):
@@ -407,11 +631,15 @@ class Parser:
         
         self.advance()  # Advance past STOP
         
+        if self.token.cat == Token.SELECT:
+            raise SyntaxError('Unmatched or misplaced END SELECT in line ' + \
+                    str(self.line_num))
+        
         for handle in self.file_handles:
             self.file_handles[handle].close()
         self.file_handles.clear()
         
-        return Msg(type=Msg.STOP)
+        return stop_msg
     
     
     def assignmentstmt(self):
@@ -425,6 +653,9 @@ class Parser:
         if self.token.cat == Token.LEFTPAREN:
             self.arrayassignmentstmt(left)  # Assigning to an array
         
+        elif self.token.cat == Token.LEFTBRACE:
+            self.mapassignmentstmt(left)  # Assigning to a map
+        
         else:  # Assigning to a simple variable
             self.consume(Token.ASSIGNOP)
             self.logexpr()
@@ -440,6 +671,9 @@ class Parser:
                 raise SyntaxError('Syntax error: Attempt to assign string to ' \
                         + 'numeric variable in line ' + str(self.line_num))
             
+            if left.endswith('%'):
+                right = to_integer(self.line_num, right)
+            
             self.symbol_table[left] = right
     
     
@@ -487,6 +721,9 @@ class Parser:
             raise SyntaxError('Attempt to assign string to numeric array' + \
                     ' in line ' + str(self.line_num))
         
+        if name.endswith('%'):
+            right = to_integer(self.line_num, right)
+        
         # Assign to the specified array index
         try:
             if len(indexvars) == 1:
@@ -501,138 +738,657 @@ class Parser:
         except IndexError:
             raise IndexError('Array index out of range in line ' + \
                     str(self.line_num))
-    
-    
-    def dimstmt(self):
-        '''Parses DIM statement and creates a symbol table entry with 
-        appropriate dimensions.
-        '''
-        
-        self.advance()  # Advance past DIM keyword
         
-        # Allow dims of multiple arrays delimited by commas
-        while True:
-            # Get array name, append a suffix so we can distinguish 
-            # from simple variables
-            name = self.token.val + '_array'
-            self.advance()  # Advance past array name
-            
-            self.consume(Token.LEFTPAREN)
-            
-            # Get dimensions
-            dimensions = []
-            if not self.tokenindex >= len(self.tokenlist):
-                self.expr()
-                dimensions.append(self.operand_stack.pop())
-                
-                while self.token.cat == Token.COMMA:
-                    self.advance()  # Advance past comma
-                    self.expr()
-                    dimensions.append(self.operand_stack.pop())
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            if len(dimensions) > 3:
-                raise SyntaxError('Maximum number of array dimensions is ' + \
-                'three in line ' + str(self.line_num))
-            
-            # Ensure array is initialised with correct values
-            if name.endswith('$_array'):
-                self.symbol_table[name] = BASICArray(dimensions, 'str')
-            else:
-                self.symbol_table[name] = BASICArray(dimensions, 'num')
-            
-            if self.tokenindex == len(self.tokenlist):  # All tokens parsed
-                return
-            else:
-                self.consume(Token.COMMA)
+        except OverflowError:
+            raise OverflowError('Integer overflow in line ' + \
+                    str(self.line_num))
     
     
-    def openstmt(self):
-        '''Parses an open statement.  
-        Opens the given file and paces the file handle in the handle table.
+    def midassignmentstmt(self):
+        '''Parses assignment to MID$, e.g. MID$(A$, 3, 2) = "XY", which
+        replaces characters of a string variable without changing its 
+        length.
         '''
         
-        self.advance()  # Advance past OPEN
-        
-        # Get file name
-        self.logexpr()
-        filename = self.operand_stack.pop()
-        
-        # Process the FOR keyword
-        self.consume(Token.FOR)
+        self.advance()  # Advance past MID$
+        self.consume(Token.LEFTPAREN)
         
-        if self.token.cat == Token.INPUT:
-            accessMode = 'r'
-        elif self.token.cat == Token.APPEND:
-            accessMode = 'a'
-        elif self.token.cat == Token.OUTPUT:
-            accessMode = 'w'
-        else:
-            raise SyntaxError('Invalid Open access mode in line ' + \
+        name = self.token.val
+        if self.token.cat != Token.NAME or not name.endswith('$'):
+            raise SyntaxError('Expecting string variable in line ' + \
                     str(self.line_num))
+        self.advance()  # Advance past variable name
+        self.consume(Token.COMMA)
         
-        self.advance()  # Advance past access type
-        
-        if self.token.val != "AS":
-            raise SyntaxError('Expecting AS in line ' + str(self.line_num))
-        
-        self.advance()  # Advance past AS keyword
-        
-        # Process the # keyword
-        self.consume(Token.HASH)
-        
-        # Acquire the file number
         self.expr()
-        filenum = self.operand_stack.pop()
+        start = self.operand_stack.pop()
         
-        branchOnError = False
-        if self.token.cat == Token.ELSE:
-            branchOnError = True
-            self.advance()  # Advance past ELSE
-            
-            if self.token.cat == Token.GOTO:
-                self.advance()  # Advance past optional GOTO
-            
+        chars = None
+        if self.token.cat == Token.COMMA:
+            self.advance()  # Advance past comma
             self.expr()
+            chars = self.operand_stack.pop()
         
-        if self.file_handles.get(filenum) != None:
-            if branchOnError:
-                return Msg(target=self.operand_stack.pop())
-            else:
-                raise RuntimeError('File #', filenum, ' already opened in line ' + \
-                        str(self.line_num))
+        self.consume(Token.RIGHTPAREN)
+        self.consume(Token.ASSIGNOP)
         
-        try:
-            self.file_handles[filenum] = open(filename, accessMode)
+        self.logexpr()
+        replacement = self.operand_stack.pop()
         
-        except:
-            if branchOnError:
-                return Msg(target=self.operand_stack.pop())
-            else:
-                raise RuntimeError('File ' + filename + ' could not be ' + \
-                        'opened in line ' + str(self.line_num))
+        try:
+            instring = self.symbol_table[name]
         
-        if accessMode == 'a':
-            self.file_handles[filenum].seek(0)
-            filelen = 0
-            for lines in self.file_handles[filenum]:
-                filelen += len(lines)+1
-            
-            self.file_handles[filenum].seek(filelen)
+        except KeyError:
+            raise RuntimeError('Name ' + name + ' is not defined' + \
+                    ' in line ' + str(self.line_num))
         
-        return None
+        self.symbol_table[name] = mid_replace(self.line_num, instring, start, 
+                chars, replacement)
     
     
-    def closestmt(self):
-        '''Parses a close.  
-        Closes the file and removes file handle from handle table.
+    def mapassignmentstmt(self, name):
+        '''Parses assignment to a map element, adding the key to the map
+        if it is not already present.
         '''
         
-        self.advance() # Advance past CLOSE
-        
-        # Process the # keyword
-        self.consume(Token.HASH)
+        BASICmap = self.get_map(name)
+        
+        self.consume(Token.LEFTBRACE)
+        self.expr()
+        key = self.operand_stack.pop()
+        self.consume(Token.RIGHTBRACE)
+        self.consume(Token.ASSIGNOP)
+        
+        self.logexpr()
+        
+        # Check that we are using the correct variable name format
+        right = self.operand_stack.pop()
+        
+        if name.endswith('$') and not isinstance(right, str):
+            raise SyntaxError('Attempt to assign non-string to string map' + \
+                    ' in line ' + str(self.line_num))
+        
+        elif not name.endswith('$') and isinstance(right, str):
+            raise SyntaxError('Attempt to assign string to numeric map' + \
+                    ' in line ' + str(self.line_num))
+        
+        if name.endswith('%'):
+            right = to_integer(self.line_num, right)
+        
+        try:
+            BASICmap[key] = right
+        
+        except TypeError:
+            raise TypeError('Invalid map key in line ' + str(self.line_num))
+    
+    
+    def get_map(self, name):
+        '''Returns the map with the given name, as created by DIM.'''
+        
+        try:
+            return self.symbol_table[name + '_map']
+        
+        except KeyError:
+            raise KeyError('Map could not be found in line ' + \
+                    str(self.line_num))
+    
+    
+    def deletestmt(self):
+        '''Parses a DELETE statement, which removes a key from a map.  A key
+        that is not present is ignored, and DELETE M{} removes every key.
+        '''
+        
+        self.advance()  # Advance past DELETE
+        
+        BASICmap = self.get_map(self.token.val)
+        self.advance()  # Advance past map name
+        self.consume(Token.LEFTBRACE)
+        
+        if self.token.cat == Token.RIGHTBRACE:
+            BASICmap.clear()
+        
+        else:
+            self.expr()
+            try:
+                BASICmap.pop(self.operand_stack.pop(), None)
+            
+            except TypeError:
+                raise TypeError('Invalid map key in line ' + \
+                        str(self.line_num))
+        
+        self.consume(Token.RIGHTBRACE)
+    
+    
+    def erasestmt(self):
+        '''Parses an ERASE statement, e.g. ERASE A, B$, M{}, which removes 
+        arrays, and maps named with empty braces, releasing their memory.  
+        They may then be dimensioned again.
+        '''
+        
+        self.advance()  # Advance past ERASE
+        
+        while True:
+            if self.token.cat != Token.NAME:
+                raise SyntaxError('Expecting array name in line ' + \
+                        str(self.line_num))
+            name = self.token.val
+            self.advance()  # Advance past name
+            
+            if self.tokenindex < len(self.tokenlist) and \
+                    self.token.cat == Token.LEFTBRACE:
+                self.get_map(name)  # Checks the map exists
+                del self.symbol_table[name + '_map']
+                self.consume(Token.LEFTBRACE)
+                self.consume(Token.RIGHTBRACE)
+            
+            elif self.symbol_table.pop(name + '_array', None) == None:
+                raise KeyError('Array could not be found in line ' + \
+                        str(self.line_num))
+            
+            if self.tokenindex >= len(self.tokenlist):  # All tokens parsed
+                return
+            self.consume(Token.COMMA)
+    
+    
+    def array_file(self):
+        '''Parses the file name and the numeric array name of a BSAVE or 
+        BLOAD statement, returning both.
+        '''
+        
+        self.advance()  # Advance past BSAVE or BLOAD
+        
+        # Get file name
+        self.logexpr()
+        filename = self.operand_stack.pop()
+        self.consume(Token.COMMA)
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME:
+            raise SyntaxError('Expecting array name in line ' + \
+                    str(self.line_num))
+        if name.endswith('$'):
+            raise TypeError('Expecting numeric array in line ' + \
+                    str(self.line_num))
+        self.advance()  # Advance past array name
+        
+        return str(filename), name
+    
+    
+    def bsavestmt(self):
+        '''Parses a BSAVE statement, e.g. BSAVE "TABLE.BIN", A, which 
+        writes the elements of a numeric array to a binary file, to be 
+        read back by BLOAD.
+        '''
+        
+        filename, name = self.array_file()
+        try:
+            BASICarray = self.symbol_table[name + '_array']
+        
+        except KeyError:
+            raise KeyError('Array could not be found in line ' + \
+                    str(self.line_num))
+        
+        try:
+            with open(filename, 'wb') as outfile:
+                BASICarray.tofile(outfile)
+                self.bytes_written += outfile.tell()
+        
+        except OSError:
+            raise OSError('Could not write file ' + filename + \
+                    ' in line ' + str(self.line_num))
+    
+    
+    def bloadstmt(self):
+        '''Parses a BLOAD statement, e.g. BLOAD "TABLE.BIN", A, which 
+        dimensions the array as it was when saved by BSAVE and reads its 
+        elements back from the file.
+        '''
+        
+        filename, name = self.array_file()
+        try:
+            with open(filename, 'rb') as infile:
+                BASICarray = BASICArray.fromfile(infile, 
+                        'int' if name.endswith('%') else 'num')
+                self.bytes_read += infile.tell()
+        
+        except OSError:
+            raise OSError('Could not read file ' + filename + \
+                    ' in line ' + str(self.line_num))
+        
+        except (ValueError, TypeError, EOFError) as err:
+            raise type(err)(str(err) + ' in line ' + str(self.line_num))
+        
+        self.symbol_table[name + '_array'] = BASICarray
+        self.arrays_allocated += 1
+    
+    
+    def keysstmt(self):
+        '''Parses a KEYS statement, e.g. KEYS M{}, K$, which dimensions the
+        array to hold the keys of the map, in the order in which they were
+        added, at indices 1 to LEN(M{}).
+        '''
+        
+        self.advance()  # Advance past KEYS
+        
+        BASICmap = self.get_map(self.token.val)
+        self.advance()  # Advance past map name
+        self.consume(Token.LEFTBRACE)
+        self.consume(Token.RIGHTBRACE)
+        self.consume(Token.COMMA)
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME:
+            raise SyntaxError('Expecting array name in line ' + \
+                    str(self.line_num))
+        self.advance()  # Advance past array name
+        
+        keys = list(BASICmap)
+        if any(isinstance(key, str) != name.endswith('$') for key in keys):
+            raise TypeError('Map keys do not match the type of array ' + \
+                    name + ' in line ' + str(self.line_num))
+        
+        if name.endswith('$'):
+            BASICarray = BASICArray([len(keys)], 'str')
+        elif name.endswith('%'):
+            BASICarray = BASICArray([len(keys)], 'int')
+            keys = [to_integer(self.line_num, key) for key in keys]
+        else:
+            BASICarray = BASICArray([len(keys)], 'num')
+        
+        BASICarray.replace(keys, 1)
+        self.symbol_table[name + '_array'] = BASICarray
+        self.arrays_allocated += 1
+    
+    
+    def commonstmt(self):
+        '''Parses a COMMON statement, which lists the variables to be kept 
+        when another program is run by CHAIN.  A name keeps the simple 
+        variable, array and map of that name, and array names may be 
+        followed by empty parentheses, e.g. COMMON A, B$, C().
+        '''
+        
+        self.advance()  # Advance past COMMON
+        
+        while True:
+            if self.token.cat != Token.NAME:
+                raise SyntaxError('Expecting variable name in line ' + \
+                        str(self.line_num))
+            
+            self.common.add(self.token.val)
+            self.advance()  # Advance past variable name
+            
+            if self.token.cat == Token.LEFTPAREN:
+                self.advance()  # Advance past left paren
+                self.consume(Token.RIGHTPAREN)
+            
+            if self.tokenindex == len(self.tokenlist):  # All tokens parsed
+                return
+            self.consume(Token.COMMA)
+    
+    
+    def chainstmt(self):
+        '''Parses a CHAIN statement, which replaces the program with the 
+        one in the given file and runs it.
+        '''
+        
+        self.advance()  # Advance past CHAIN
+        
+        self.logexpr()
+        file = self.operand_stack.pop()
+        if not isinstance(file, str):
+            raise TypeError('File name expected for CHAIN in line ' + \
+                    str(self.line_num))
+        
+        return Msg(target=file, type=Msg.CHAIN)
+    
+    
+    def get_vector(self, statement):
+        '''Returns the one dimensional array named by the current token, 
+        and advances past the name.
+        '''
+        
+        if self.token.cat != Token.NAME:
+            raise SyntaxError('Expecting array name in line ' + \
+                    str(self.line_num))
+        
+        try:
+            BASICarray = self.symbol_table[self.token.val + '_array']
+        
+        except KeyError:
+            raise KeyError('Array could not be found in line ' + \
+                    str(self.line_num))
+        
+        if BASICarray.dims != 1:
+            raise IndexError(statement + ' requires a one dimensional ' + \
+                    'array in line ' + str(self.line_num))
+        
+        self.advance()  # Advance past array name
+        return BASICarray
+    
+    
+    def sortstmt(self):
+        '''Parses a SORT statement, which sorts the elements of a one 
+        dimensional array from index 1 onwards, e.g. SORT A or 
+        SORT N$, DESC.  Element zero is left where it is.  SORT A BY B 
+        sorts B and moves the elements of A in step with it, so that 
+        parallel arrays stay matched.  Elements that are equal keep their 
+        order.
+        
+        >>> from program import Program
+        >>> from scanner import Scanner
+        >>> program = Program()
+        >>> for line in ('10 DIM A(4)', '20 A(1) = 5 : A(2) = -3', 
+        ...         '30 A(3) = 9 : A(4) = -1', '40 SORT A', '50 GOSUB 90', 
+        ...         '60 SORT A, DESC', '70 GOSUB 90', '80 END', 
+        ...         '90 PRINT A(0); " "; A(1); " "; A(2); " "; A(3); " "; A(4)', 
+        ...         '100 RETURN'):
+        ...     program.add_stmt(Scanner().tokenise(line))
+        >>> program.run()
+        0 -3 -1 5 9
+        0 9 5 -1 -3
+        '''
+        
+        self.advance()  # Advance past SORT
+        
+        BASICarray = self.get_vector('SORT')
+        keyarray = BASICarray
+        if self.token.cat == Token.BY:
+            self.advance()  # Advance past BY
+            keyarray = self.get_vector('SORT')
+        
+        descending = False
+        if self.token.cat == Token.COMMA:
+            self.advance()  # Advance past comma
+            self.consume(Token.DESC)
+            descending = True
+        
+        keys = keyarray.data
+        if len(keys) != len(BASICarray.data):
+            raise IndexError('Arrays of different sizes supplied to SORT ' + \
+                    'in line ' + str(self.line_num))
+        
+        try:
+            if keyarray is BASICarray:
+                BASICarray.replace(sorted(keys[1:], reverse=descending), 1)
+            
+            else:
+                order = sorted(range(1, len(keys)), key=keys.__getitem__, 
+                        reverse=descending)
+                values = [BASICarray.data[i] for i in order]
+                keyarray.replace([keys[i] for i in order], 1)
+                BASICarray.replace(values, 1)
+        
+        except TypeError:
+            raise TypeError('Invalid type supplied to SORT in line ' + \
+                    str(self.line_num))
+    
+    
+    def searchstmt(self):
+        '''Parses a SEARCH statement, e.g. SEARCH A, X, I, which finds a 
+        value in a one dimensional array, sorted in ascending order from 
+        index 1 onwards, by binary search.  The variable is set to the 
+        lowest index from 1 onwards holding the value, or -1 if it is not 
+        present.  Element zero is not searched.
+        
+        >>> from program import Program
+        >>> from scanner import Scanner
+        >>> program = Program()
+        >>> for line in ('10 DIM A(3)', '20 A(1) = 2 : A(2) = 4 : A(3) = 6', 
+        ...         '30 SEARCH A, 0, I', '40 SEARCH A, 4, J', '50 PRINT I; " "; J'):
+        ...     program.add_stmt(Scanner().tokenise(line))
+        >>> program.run()
+        -1 2
+        '''
+        
+        self.advance()  # Advance past SEARCH
+        
+        data = self.get_vector('SEARCH').data
+        self.consume(Token.COMMA)
+        
+        self.expr()
+        value = self.operand_stack.pop()
+        self.consume(Token.COMMA)
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME or name.endswith('$'):
+            raise SyntaxError('Expecting numeric variable in line ' + \
+                    str(self.line_num))
+        self.advance()  # Advance past variable name
+        
+        try:
+            index = bisect_left(data, value, 1)
+        
+        except TypeError:
+            raise TypeError('Invalid type supplied to SEARCH in line ' + \
+                    str(self.line_num))
+        
+        if index == len(data) or data[index] != value:
+            index = -1
+        
+        self.symbol_table[name] = index
+    
+    
+    def matstmt(self):
+        '''Parses a MAT statement, which fills every element of a numeric 
+        array, including those with a zero index, with random numbers, 
+        e.g. MAT A = RND or MAT D = RNDINT(1, 6).  The numbers are drawn 
+        a row at a time, which is much quicker than calling RND in a loop, 
+        and are the same numbers the loop would give after the same 
+        RANDOMIZE.
+        '''
+        
+        self.advance()  # Advance past MAT
+        
+        if self.token.cat == Token.INPUT:
+            self.matinputstmt()
+            return
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME:
+            raise SyntaxError('Expecting array name in line ' + \
+                    str(self.line_num))
+        
+        try:
+            BASICarray = self.symbol_table[name + '_array']
+        
+        except KeyError:
+            raise KeyError('Array could not be found in line ' + \
+                    str(self.line_num))
+        
+        if name.endswith('$'):
+            raise TypeError('Expecting numeric array in line ' + \
+                    str(self.line_num))
+        
+        self.advance()  # Advance past array name
+        self.consume(Token.ASSIGNOP)
+        
+        if self.token.cat == Token.RND:
+            self.advance()  # Advance past RND
+            generate = random_source.fill
+        
+        elif self.token.cat == Token.RNDINT:
+            self.advance()  # Advance past RNDINT
+            self.consume(Token.LEFTPAREN)
+            self.expr()
+            self.consume(Token.COMMA)
+            self.expr()
+            self.consume(Token.RIGHTPAREN)
+            hi = self.operand_stack.pop()
+            lo = self.operand_stack.pop()
+            
+            def generate(count):
+                try:
+                    return random_source.fill_int(lo, hi, count)
+                
+                except ValueError:
+                    raise ValueError('Invalid value supplied to RNDINT ' + \
+                            'in line ' + str(self.line_num))
+        
+        else:
+            raise SyntaxError('Expecting RND or RNDINT in line ' + \
+                    str(self.line_num))
+        
+        if name.endswith('%'):
+            line_num = self.line_num
+            fill = generate
+            generate = lambda count: [to_integer(line_num, value) 
+                    for value in fill(count)]
+        
+        try:
+            BASICarray.fill(generate)
+        
+        except OverflowError:
+            raise OverflowError('Integer overflow in line ' + \
+                    str(self.line_num))
+    
+    
+    def dimstmt(self):
+        '''Parses DIM statement and creates a symbol table entry with 
+        appropriate dimensions.  A map is dimensioned with empty braces, 
+        e.g. DIM M{}, and starts with no keys.
+        '''
+        
+        self.advance()  # Advance past DIM keyword
+        
+        # Allow dims of multiple arrays delimited by commas
+        while True:
+            if self.tokenindex + 1 < len(self.tokenlist) and \
+                    self.tokenlist[self.tokenindex + 1].cat == Token.LEFTBRACE:
+                name = self.token.val + '_map'
+                self.advance()  # Advance past map name
+                self.consume(Token.LEFTBRACE)
+                self.consume(Token.RIGHTBRACE)
+                self.symbol_table[name] = {}
+                
+                if self.tokenindex == len(self.tokenlist):  # All tokens parsed
+                    return
+                self.consume(Token.COMMA)
+                continue
+            
+            # Get array name, append a suffix so we can distinguish 
+            # from simple variables
+            name = self.token.val + '_array'
+            self.advance()  # Advance past array name
+            
+            self.consume(Token.LEFTPAREN)
+            
+            # Get dimensions
+            dimensions = []
+            if not self.tokenindex >= len(self.tokenlist):
+                self.expr()
+                dimensions.append(self.operand_stack.pop())
+                
+                while self.token.cat == Token.COMMA:
+                    self.advance()  # Advance past comma
+                    self.expr()
+                    dimensions.append(self.operand_stack.pop())
+            
+            self.consume(Token.RIGHTPAREN)
+            
+            if len(dimensions) > 3:
+                raise SyntaxError('Maximum number of array dimensions is ' + \
+                'three in line ' + str(self.line_num))
+            
+            # Ensure array is initialised with correct values
+            if name.endswith('$_array'):
+                self.symbol_table[name] = BASICArray(dimensions, 'str')
+            elif name.endswith('%_array'):
+                self.symbol_table[name] = BASICArray(dimensions, 'int')
+            else:
+                self.symbol_table[name] = BASICArray(dimensions, 'num')
+            self.arrays_allocated += 1
+            
+            if self.tokenindex == len(self.tokenlist):  # All tokens parsed
+                return
+            else:
+                self.consume(Token.COMMA)
+    
+    
+    def openstmt(self):
+        '''Parses an open statement.  
+        Opens the given file and paces the file handle in the handle table.
+        '''
+        
+        self.advance()  # Advance past OPEN
+        
+        # Get file name
+        self.logexpr()
+        filename = self.operand_stack.pop()
+        
+        # Process the FOR keyword
+        self.consume(Token.FOR)
+        
+        if self.token.cat == Token.INPUT:
+            accessMode = 'r'
+        elif self.token.cat == Token.APPEND:
+            accessMode = 'a'
+        elif self.token.cat == Token.OUTPUT:
+            accessMode = 'w'
+        else:
+            raise SyntaxError('Invalid Open access mode in line ' + \
+                    str(self.line_num))
+        
+        self.advance()  # Advance past access type
+        
+        if self.token.val != "AS":
+            raise SyntaxError('Expecting AS in line ' + str(self.line_num))
+        
+        self.advance()  # Advance past AS keyword
+        
+        # Process the # keyword
+        self.consume(Token.HASH)
+        
+        # Acquire the file number
+        self.expr()
+        filenum = self.operand_stack.pop()
+        
+        branchOnError = False
+        if self.token.cat == Token.ELSE:
+            branchOnError = True
+            self.advance()  # Advance past ELSE
+            
+            if self.token.cat == Token.GOTO:
+                self.advance()  # Advance past optional GOTO
+            
+            self.expr()
+        
+        if self.file_handles.get(filenum) != None:
+            if branchOnError:
+                return jump_msg(self.operand_stack.pop())
+            else:
+                raise RuntimeError('File #', filenum, ' already opened in line ' + \
+                        str(self.line_num))
+        
+        try:
+            self.file_handles[filenum] = open(filename, accessMode)
+        
+        except:
+            if branchOnError:
+                return jump_msg(self.operand_stack.pop())
+            else:
+                raise RuntimeError('File ' + filename + ' could not be ' + \
+                        'opened in line ' + str(self.line_num))
+        
+        if accessMode == 'a':
+            self.file_handles[filenum].seek(0)
+            filelen = 0
+            for lines in self.file_handles[filenum]:
+                filelen += len(lines)+1
+            
+            self.file_handles[filenum].seek(filelen)
+        
+        return None
+    
+    
+    def closestmt(self):
+        '''Parses a close.  
+        Closes the file and removes file handle from handle table.
+        '''
+        
+        self.advance() # Advance past CLOSE
+        
+        # Process the # keyword
+        self.consume(Token.HASH)
         
         # Get the file number
         self.expr()
@@ -725,8 +1481,9 @@ class Parser:
         while not valid_input:
             # Get input from the user and put into variables
             if fileIO:
-                inputvals = ((self.file_handles[filenum].readline()\
-                        .replace('\n','')).replace('\r',''))\
+                line = self.file_handles[filenum].readline()
+                self.bytes_read += len(line)
+                inputvals = ((line.replace('\n','')).replace('\r',''))\
                         .split(',', (len(variables)-1))
                 valid_input = True
             else:
@@ -744,7 +1501,12 @@ class Parser:
                     
                     elif not left.endswith('$'):
                         try:
-                            if '.' in right:
+                            if left.endswith('%'):
+                                self.symbol_table[left] = int(right) \
+                                        if '.' not in right else \
+                                        to_integer(self.line_num, float(right))
+                            
+                            elif '.' in right:
                                 self.symbol_table[left] = float(right)
                             
                             else:
@@ -767,6 +1529,171 @@ class Parser:
                     break
     
     
+    def input_file(self, statement):
+        '''Parses the #filenum and following comma of a statement reading 
+        from a file, returning the file.
+        '''
+        
+        self.consume(Token.HASH)
+        
+        # Get the file number
+        self.expr()
+        filenum = self.operand_stack.pop()
+        
+        infile = self.file_handles.get(filenum)
+        if infile == None:
+            raise RuntimeError(statement + ': file #' + str(filenum) + \
+                    ' is not open in line ' + str(self.line_num))
+        
+        self.consume(Token.COMMA)
+        return infile
+    
+    
+    def lineinputstmt(self):
+        '''Parses a LINE INPUT statement, e.g. LINE INPUT #1, A$, which 
+        reads a whole line into a string variable without splitting it at 
+        commas.  Without a file number the line is read from the user, 
+        after the prompt if one is given.
+        '''
+        
+        self.advance()  # Advance past LINE
+        self.consume(Token.INPUT)
+        
+        infile = None
+        prompt = '? '
+        if self.token.cat == Token.HASH:
+            infile = self.input_file('LINE INPUT')
+        
+        elif self.token.cat == Token.STRING:
+            self.logexpr()
+            prompt = self.operand_stack.pop()
+            self.consume(Token.SEMICOLON)
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME or not name.endswith('$'):
+            raise SyntaxError('Expecting string variable in line ' + \
+                    str(self.line_num))
+        self.advance()  # Advance past variable
+        
+        if infile != None:
+            line = infile.readline()
+            self.bytes_read += len(line)
+            self.symbol_table[name] = line.rstrip('\r\n')
+        else:
+            self.symbol_table[name] = input(prompt)
+    
+    
+    def read_csv(self, infile):
+        '''Returns the rest of a file of comma separated values as a list
+        of rows, each a list of fields, reading the file in one pass with 
+        the csv module.  Blank lines are skipped.
+        '''
+        
+        text = infile.read()
+        self.bytes_read += len(text)
+        return [row for row in reader(StringIO(text)) if len(row) > 0]
+    
+    
+    def convert_fields(self, fields, name):
+        '''Returns the fields read from a file converted for the array 
+        with the given name.  As for INPUT, a field of a numeric array is 
+        read as a floating point number if it contains a decimal point, 
+        and as an integer otherwise.
+        '''
+        
+        if name.endswith('$'):
+            return fields
+        
+        try:
+            if name.endswith('%'):
+                return [int(field) if '.' not in field else 
+                        to_integer(self.line_num, float(field)) 
+                        for field in fields]
+            
+            return [float(field) if '.' in field else int(field) 
+                    for field in fields]
+        
+        except ValueError:
+            raise ValueError('Non-numeric input provided to numeric ' + \
+                    'array ' + name + ' in line ' + str(self.line_num))
+    
+    
+    def input_array(self, name, values):
+        '''Dimensions a one dimensional array to hold the values at 
+        indices 1 onwards.
+        '''
+        
+        BASICarray = BASICArray([len(values)], elem_type(name))
+        BASICarray.replace(values, 1)
+        self.symbol_table[name + '_array'] = BASICarray
+        self.arrays_allocated += 1
+    
+    
+    def matinputstmt(self):
+        '''Parses a MAT INPUT statement, e.g. MAT INPUT #1, A, which reads 
+        the rest of a file of comma separated values into an array in one
+        pass.  A file with a single value on each line gives a one 
+        dimensional array, holding the values at indices 1 onwards.  
+        Otherwise line I of the file is held at A(I, 1) onwards, the array 
+        being dimensioned for the longest line.
+        '''
+        
+        self.advance()  # Advance past INPUT
+        infile = self.input_file('MAT INPUT')
+        
+        name = self.token.val
+        if self.token.cat != Token.NAME:
+            raise SyntaxError('Expecting array name in line ' + \
+                    str(self.line_num))
+        self.advance()  # Advance past array name
+        
+        rows = self.read_csv(infile)
+        width = max(map(len, rows), default=0)
+        if width <= 1:
+            self.input_array(name, self.convert_fields(
+                    [row[0] for row in rows], name))
+            return
+        
+        BASICarray = BASICArray([len(rows), width], elem_type(name))
+        for row, fields in zip(BASICarray.data[1:], rows):
+            values = self.convert_fields(fields, name)
+            if isinstance(row, array):
+                values = array(row.typecode, values)
+            row[1:len(values) + 1] = values
+        
+        self.symbol_table[name + '_array'] = BASICarray
+        self.arrays_allocated += 1
+    
+    
+    def readcsvstmt(self):
+        '''Parses a READCSV statement, e.g. READCSV #1, N$, AGE, which reads
+        the rest of a file of comma separated values in one pass, putting
+        each column into one of the arrays, at indices 1 onwards.  The 
+        arrays are dimensioned to hold one element for each line.
+        '''
+        
+        self.advance()  # Advance past READCSV
+        infile = self.input_file('READCSV')
+        
+        names = []
+        while True:
+            if self.token.cat != Token.NAME:
+                raise SyntaxError('Expecting array name in line ' + \
+                        str(self.line_num))
+            names.append(self.token.val)
+            self.advance()  # Advance past array name
+            
+            if self.tokenindex >= len(self.tokenlist):  # All tokens parsed
+                break
+            self.consume(Token.COMMA)
+        
+        rows = self.read_csv(infile)
+        for column, name in enumerate(names):
+            fields = [row[column] if column < len(row) else '' 
+                    for row in rows]
+            self.input_array(name, self.convert_fields(fields, name))
+    
+    
     def restorestmt(self):
         '''Parses RESTORE statement.'''
         
@@ -808,10 +1735,11 @@ class Parser:
             
             left = variable
             right = self.data_values.pop(0)
+            self.data_values_read += 1
             
             if left.endswith('$'):
                 # Python puts quotes around input data
-                if isinstance(right, int):
+                if not isinstance(right, str):
                     raise ValueError('Non-string input provided to a string ' + \
                             'variable in line ' + str(self.line_num))
                 
@@ -820,9 +1748,16 @@ class Parser:
             
             elif not left.endswith('$'):
                 try:
-                    numeric = float(right)
-                    if int(numeric) == numeric:
-                        numeric = int(numeric)
+                    # Integers need no conversion
+                    if isinstance(right, int):
+                        numeric = right
+                    else:
+                        numeric = float(right)
+                        if int(numeric) == numeric:
+                            numeric = int(numeric)
+                    
+                    if left.endswith('%'):
+                        numeric = to_integer(self.line_num, numeric)
                     self.symbol_table[left] = numeric
                 
                 except ValueError:
@@ -847,14 +1782,14 @@ class Parser:
         
         if self.token.cat != Token.UNSIGNEDINT:
             if saveval:
-                return Msg(type=Msg.EXECUTE)
+                return execute_msg
         else:
             self.expr()
             
             # Jump if the expression evaluated to True
             if saveval:
                 # Set up and return the message
-                return Msg(target=self.operand_stack.pop())
+                return jump_msg(self.operand_stack.pop())
         
         # Advance to ELSE
         while self.tokenindex < len(self.tokenlist) and self.token.cat != Token.ELSE:
@@ -865,13 +1800,13 @@ class Parser:
             self.advance()
             
             if self.token.cat != Token.UNSIGNEDINT:
-                return Msg(type=Msg.EXECUTE)
+                return execute_msg
             else:
                 
                 self.expr()
                 
                 # Set up and return message
-                return Msg(target=self.operand_stack.pop())
+                return jump_msg(self.operand_stack.pop())
         
         else:
             # No ELSE action
@@ -901,6 +1836,8 @@ class Parser:
         
         # Check using correct variable name format for numeric variables
         start_val = self.operand_stack.pop()
+        if loop_variable.endswith('%'):
+            start_val = to_integer(self.line_num, start_val)
         
         # Advance past the TO
         self.consume(Token.TO)
@@ -917,6 +1854,8 @@ class Parser:
             # Get the step value
             self.expr()
             step = self.operand_stack.pop()
+            if loop_variable.endswith('%'):
+                step = to_integer(self.line_num, step)
             
             # Check whether incrementing or decrementing
             if step == 0:
@@ -983,18 +1922,46 @@ class Parser:
     
     
     def randomizestmt(self):
-        '''Seeds the random number generator.'''
+        '''Seeds the random number generator.  RANDOMIZE LEGACY first 
+        selects the random module's shared generator, used by earlier 
+        versions, for programs that depend on the numbers it gives for a 
+        seed.  It stays selected until the program is next run.
+        
+        >>> from program import Program
+        >>> from scanner import Scanner
+        >>> import random
+        >>> program = Program()
+        >>> program.add_stmt(Scanner().tokenise(
+        ...         '10 RANDOMIZE LEGACY 100 : PRINT RNDINT(1, 1000)'))
+        >>> program.run()
+        150
+        >>> random.seed(100)
+        >>> random.randint(1, 1000)
+        150
+        >>> program.add_stmt(Scanner().tokenise(
+        ...         '10 RANDOMIZE 100 : PRINT RNDINT(1, 1000)'))
+        >>> program.run()
+        146
+        >>> random_source.use_legacy(True)
+        >>> program.run()
+        150
+        >>> random_source.use_legacy(False)
+        '''
         
         self.advance()  # Advance past RANDOMIZE
         
+        if self.token.cat == Token.LEGACY:
+            self.advance()  # Advance past LEGACY
+            random_source.select(True)
+        
         if not self.tokenindex >= len(self.tokenlist):
             self.expr()  # Process the seed
             new_seed = self.operand_stack.pop()
             
-            seed(new_seed)
+            random_source.seed(new_seed)
         
         else:
-            seed(int(monotonic()))
+            random_source.seed(int(monotonic()))
     
     
     def ongosubstmt(self):
@@ -1030,9 +1997,9 @@ class Parser:
         if saveval < 1 or saveval > len(branch_values) or len(branch_values) == 0:
             return None
         elif branchtype == 1:
-            return Msg(target=branch_values[saveval - 1])
+            return jump_msg(branch_values[saveval - 1])
         else:
-            return Msg(target=branch_values[saveval - 1], type=Msg.GOSUB)
+            return jump_msg(branch_values[saveval - 1], Msg.GOSUB)
     
     
     def logexpr(self):
@@ -1180,17 +2147,51 @@ class Parser:
         
         elif (self.token.cat == Token.NAME \
                 and self.token.cat not in Token.functions):
-            # Check if this is a simple or array variable.
+            # Check if this is a simple, array or map variable.
             # BASIC allows simple and complex variables to have the same id.
             # Not a good idea, but it can be used in programs, so check 
-            # whether if next token is parens.
-            if ((self.token.val + "_array") in self.symbol_table \
+            # whether if next token is parens or braces.
+            if (self.tokenindex < len(self.tokenlist) - 1 \
+                    and self.tokenlist[self.tokenindex + 1].cat == \
+                    Token.LEFTBRACE):
+                # Save sign because expr() calls term() which resets sign to 1
+                savesign = self.sign
+                
+                BASICmap = self.get_map(self.token.val)
+                self.advance()  # Advance past the map name
+                self.advance()  # Advance past the left brace
+                
+                if self.token.cat == Token.RIGHTBRACE:
+                    # The whole map, e.g. as the argument of LEN
+                    self.operand_stack.append(BASICmap)
+                
+                else:
+                    self.expr()
+                    key = self.operand_stack.pop()
+                    
+                    if self.token.cat != Token.RIGHTBRACE:
+                        raise SyntaxError('Expecting RIGHTBRACE in line ' + \
+                                str(self.line_num))
+                    
+                    try:
+                        mapval = BASICmap[key]
+                    
+                    except (KeyError, TypeError):
+                        raise KeyError('Key ' + str(key) + ' not found in ' + \
+                                'map in line ' + str(self.line_num))
+                    
+                    self.operand_stack.append(savesign * mapval)
+            
+            elif ((self.token.val + "_array") in self.symbol_table \
                     and self.tokenindex < len(self.tokenlist) - 1 \
                     and self.tokenlist[self.tokenindex + 1].cat == \
                     Token.LEFTPAREN):
                 # Get the current val
                 arrayname = self.token.val + '_array'
                 
+                # Save sign because expr() calls term() which resets sign to 1
+                savesign = self.sign
+                
                 # Array must be processed
                 # Capture the index variables
                 self.advance()  # Advance past the array name
@@ -1211,7 +2212,7 @@ class Parser:
                     arrayval = self.get_array_val(BASICarray, indexvars)
                     
                     if arrayval != None:
-                        self.operand_stack.append(self.sign * arrayval)
+                        self.operand_stack.append(savesign * arrayval)
                     
                     else:
                         raise IndexError('Empty array value returned in line ' \
@@ -1244,8 +2245,24 @@ class Parser:
             
             self.consume(Token.RIGHTPAREN)
         
+        elif self.token.cat == Token.FN:
+            # Save sign because the arguments are evaluated by logexpr()
+            savesign = self.sign
+            self.operand_stack.append(self.evaluate_user_function())
+            
+            if savesign == -1:
+                # Change sign of function result
+                self.operand_stack[-1] = -self.operand_stack[-1]
+        
         elif self.token.cat in Token.functions:
+            # Save sign because the arguments are evaluated by expr(), 
+            # which calls term() and resets sign to 1
+            savesign = self.sign
             self.operand_stack.append(self.evaluate_function(self.token.cat))
+            
+            if savesign == -1:
+                # Change sign of function result
+                self.operand_stack[-1] = -self.operand_stack[-1]
         
         else:
             raise RuntimeError('Expecting factor in numeric expression' + \
@@ -1279,395 +2296,219 @@ class Parser:
         return arrayval
     
     
-    def evaluate_function(self, cat):
-        '''Evaluate a function in a statement and return result.'''
-        
-        self.advance()  # Advance past function name
+    def defstmt(self):
+        '''Parses a single line DEF FN statement, which defines a function 
+        whose value is given by an expression, e.g.
         
-        # Process arguments according to function
-        if cat == Token.RND:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            arg = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            # Old BASIC would return the same value if given 0 (zero) as 
-            # argument.  This is not implemented.
-            # A negative argument would reseed the generator.
-            # Otherwise returns a random value between 0 and 1.
-            if arg < 0:
-                seed(arg)
-            
-            return random()
+        DEF FNA(X, Y) = X * X + Y [CACHE [size]]
         
-        if cat == Token.RNDINT:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            lo = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            hi = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return randint(lo, hi)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to RNDINT in line ' + \
-                        str(self.line_num))
+        Multi-line functions are handled by the compiler, as their bodies 
+        are made up of program lines.
+        '''
         
-        if cat == Token.PI:
-            return pi
+        self.advance()  # Advance past DEF
         
-        if cat == Token.MAX:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            value_list = [self.operand_stack.pop()]
-            
-            while self.token.cat == Token.COMMA:
-                self.advance()  # Advance past comma
-                self.expr()
-                value_list.append(self.operand_stack.pop())
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return max(*value_list)
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to MAX in line ' + \
-                        str(self.line_num))
+        name = self.token.val
+        self.consume(Token.FN)
         
-        if cat == Token.MIN:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            value_list = [self.operand_stack.pop()]
+        params = []
+        if self.token.cat == Token.LEFTPAREN:
+            self.advance()  # Advance past left paren
+            params.append(self.token.val)
+            self.consume(Token.NAME)
             
             while self.token.cat == Token.COMMA:
                 self.advance()  # Advance past comma
-                self.expr()
-                value_list.append(self.operand_stack.pop())
+                params.append(self.token.val)
+                self.consume(Token.NAME)
             
             self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return min(*value_list)
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to MIN in line ' + \
-                        str(self.line_num))
         
-        if cat == Token.POW:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            base = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            exponent = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return base ** exponent
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to POW in line ' + \
-                        str(self.line_num))
+        if self.tokenindex >= len(self.tokenlist) or \
+                self.token.cat != Token.ASSIGNOP:
+            raise SyntaxError('A multi-line DEF FN must be the only ' + \
+                    'statement on its line in line ' + str(self.line_num))
+        
+        self.advance()  # Advance past =
+        
+        # The body runs to the end of the statement, or to CACHE
+        start = self.tokenindex
+        end = len(self.tokenlist)
+        cache_size = None
+        for index in range(start, len(self.tokenlist)):
+            if self.tokenlist[index].cat == Token.CACHE:
+                end = index
+                cache_size = self.cachesize(index + 1)
+                break
         
-        if cat == Token.TERNARY:
-            self.consume(Token.LEFTPAREN)
-            
-            self.logexpr()
-            condition = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            whentrue = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            whenfalse = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            return whentrue if condition else whenfalse
+        if cache_size != None and name.endswith('$'):
+            raise SyntaxError('CACHE is only allowed for numeric functions ' + \
+                    'in line ' + str(self.line_num))
         
-        if cat == Token.LEFT:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            instring = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            chars = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return instring[:chars]
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to LEFT$ in line ' + \
-                        str(self.line_num))
+        body_tokens = self.tokenlist[start:end]
+        if len(body_tokens) == 0:
+            raise SyntaxError('Missing function body in line ' + \
+                    str(self.line_num))
         
-        if cat == Token.RIGHT:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            instring = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            chars = self.operand_stack.pop()
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                return instring[-chars:]
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to RIGHT$ in line ' + \
-                        str(self.line_num))
+        line_num = self.line_num
+        def body():
+            return self.evaluate_tokens(line_num, body_tokens)
         
-        if cat == Token.MID:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            instring = self.operand_stack.pop()
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            # Old BASIC dialects were always one-based
-            start = self.operand_stack.pop() - 1
-            
-            if self.token.cat == Token.COMMA:
-                self.advance()  # Advance past comma
-                self.expr()
-                chars = self.operand_stack.pop()
-            else:
-                chars = None
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                if chars:
-                    return instring[start:start+chars]
-                else:
-                    return instring[start:]
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to MID$ in line ' + \
-                        str(self.line_num))
+        self.user_functions[name] = UserFunction(name, params, body,
+                self.symbol_table, cache_size)
+        self.tokenindex = len(self.tokenlist)
+    
+    
+    def cachesize(self, index):
+        '''Returns the size of the cache given by the tokens following a 
+        CACHE keyword, starting at the given index.
+        '''
         
-        if cat == Token.INSTR:
-            self.consume(Token.LEFTPAREN)
-            
-            self.expr()
-            haystackstring = self.operand_stack.pop()
-            if not isinstance(haystackstring, str):
-                raise TypeError('Invalid type supplied to INSTR in line ' + \
-                        str(self.line_num))
-            
-            self.consume(Token.COMMA)
-            
-            self.expr()
-            needlestring = self.operand_stack.pop()
-            
-            start = end = None
-            if self.token.cat == Token.COMMA:
-                self.advance()  # Advance past comma
-                self.expr()
-                # Old BASIC dialects were always one-based
-                start = self.operand_stack.pop() - 1
-                
-                if self.token.cat == Token.COMMA:
-                    self.advance()  # Advance past comma
-                    self.expr()
-                    end = self.operand_stack.pop() - 1
-            
-            self.consume(Token.RIGHTPAREN)
-            
-            try:
-                # Old BASIC dialects are one-based, so the return value needs 
-                # to be incremented by one.  ALSO, this moves the -1 not found 
-                # value to 0 (this indicated not found in most dialects).
-                return haystackstring.find(needlestring, start, end) + 1
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to INSTR in line ' + \
-                        str(self.line_num))
+        if index == len(self.tokenlist):
+            return default_cache_size
         
-        self.consume(Token.LEFTPAREN)
+        if index == len(self.tokenlist) - 1 and \
+                self.tokenlist[index].cat == Token.UNSIGNEDINT:
+            return int(self.tokenlist[index].val)
         
-        self.expr()
-        value = self.operand_stack.pop()
+        raise SyntaxError('Invalid CACHE size in line ' + str(self.line_num))
+    
+    
+    def evaluate_tokens(self, line_num, tokens):
+        '''Evaluates an expression made up of the given tokens, preserving 
+        the state of any statement currently being parsed.  Used for the 
+        body of a function.
+        '''
         
-        self.consume(Token.RIGHTPAREN)
+        saved = (self.line_num, self.tokenlist, self.tokenindex, self.token, 
+                self.sign)
         
-        if cat == Token.SQR:
-            try:
-                return sqrt(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to SQR in line ' + \
-                        str(self.line_num))
+        self.line_num = line_num
+        self.tokenlist = tokens
+        self.tokenindex = 0
+        self.token = tokens[0]
         
-        if cat == Token.ABS:
-            try:
-                return abs(value)
+        try:
+            self.logexpr()
+            if self.tokenindex < len(tokens):
+                raise SyntaxError('Syntax error in function body in line ' + \
+                        str(line_num))
             
-            except ValueError:
-                raise ValueError('Invalid value supplied to ABS in line ' + \
-                        str(self.line_num))
+            return self.operand_stack.pop()
         
-        if cat == Token.ATN:
-            try:
-                return atan(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to ATN in line ' + \
-                        str(self.line_num))
+        finally:
+            self.line_num, self.tokenlist, self.tokenindex, self.token, \
+                    self.sign = saved
+    
+    
+    def evaluate_user_function(self):
+        '''Evaluates a call to a function defined by DEF FN.'''
         
-        if cat == Token.COS:
-            try:
-                return cos(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to COS in line ' + \
-                        str(self.line_num))
+        name = self.token.val
+        self.advance()  # Advance past function name
         
-        if cat == Token.EXP:
-            try:
-                return math.exp(value)
+        args = []
+        if self.tokenindex < len(self.tokenlist) and \
+                self.token.cat == Token.LEFTPAREN:
+            self.advance()  # Advance past left paren
             
-            except ValueError:
-                raise ValueError('Invalid value supplied to EXP in line ' + \
-                        str(self.line_num))
-        
-        if cat == Token.INT:
-            try:
-                return floor(value)
+            if self.token.cat != Token.RIGHTPAREN:
+                self.logexpr()
+                args.append(self.operand_stack.pop())
+                
+                while self.token.cat == Token.COMMA:
+                    self.advance()  # Advance past comma
+                    self.logexpr()
+                    args.append(self.operand_stack.pop())
             
-            except ValueError:
-                raise ValueError('Invalid value supplied to INT in line ' + \
-                        str(self.line_num))
+            self.consume(Token.RIGHTPAREN)
         
-        if cat == Token.ROUND:
-            try:
-                return round(value)
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to ROUND in line ' + \
-                        str(self.line_num))
+        elif name in self.symbol_table:
+            # Within a multi-line function, its name without arguments 
+            # refers to the result
+            return self.symbol_table[name]
         
-        if cat == Token.LOG:
-            try:
-                return log(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to LOG in line ' + \
-                        str(self.line_num))
+        function = self.user_functions.get(name)
+        if function == None:
+            raise RuntimeError('Function ' + name + ' is not defined ' + \
+                    'in line ' + str(self.line_num))
         
-        if cat == Token.SIN:
-            try:
-                return sin(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to SIN in line ' + \
-                        str(self.line_num))
+        return function.call(self.line_num, args)
+    
+    
+    def evaluate_function(self, cat):
+        '''Evaluate a function in a statement and return result.  The
+        function is looked up in the function table, which gives its 
+        implementation and the number of arguments it takes.
+        '''
         
-        if cat == Token.TAN:
-            try:
-                return tan(value)
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to TAN in line ' + \
-                        str(self.line_num))
+        self.advance()  # Advance past function name
         
-        if cat == Token.CHR:
-            try:
-                return chr(value)
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to CHR$ in line ' + \
-                        str(self.line_num))
-            
-            except ValueError:
-                raise ValueError('Invalid value supplied to CHR$ in line ' + \
-                        str(self.line_num))
+        function = function_table.get(cat)
+        if function == None:
+            raise SyntaxError('Unrecognised function in line ' + \
+                    str(self.line_num))
         
-        if cat == Token.ASC:
-            try:
-                return ord(value)
+        # Process arguments, which are enclosed in parentheses unless the 
+        # function takes none (e.g. PI)
+        args = []
+        if function.max_args != 0:
+            self.consume(Token.LEFTPAREN)
             
-            except TypeError:
-                raise TypeError('Invalid type supplied to ASC in line ' + \
-                        str(self.line_num))
+            # The first argument of the ternary function is a condition
+            if cat == Token.TERNARY:
+                self.logexpr()
+            else:
+                self.expr()
+            args.append(self.operand_stack.pop())
             
-            except ValueError:
-                raise ValueError('Invalid value supplied to ASC in line ' + \
-                        str(self.line_num))
-        
-        if cat == Token.STR:
-            return str(value)
-        
-        if cat == Token.VAL:
-            try:
-                numeric = float(value)
-                if int(numeric) == numeric:
-                    return int(numeric)
-                return numeric
+            while self.token.cat == Token.COMMA:
+                self.advance()  # Advance past comma
+                self.expr()
+                args.append(self.operand_stack.pop())
             
-            # BASIC returns zero for non-numeric argument
-            except ValueError:
-                return 0
+            self.consume(Token.RIGHTPAREN)
         
-        if cat == Token.LEN:
-            try:
-                return len(value)
-            
-            except TypeError:
-                raise TypeError('Invalid type supplied to LEN in line ' + \
-                        str(self.line_num))
+        function.check_args(len(args), self.line_num)
         
-        if cat == Token.UPPER:
-            if not isinstance(value, str):
-                raise TypeError('Invalid type supplied to UPPER$ in line ' + \
-                        str(self.line_num))
-            
-            return value.upper()
+        return function.fn(self.line_num, *args)
+
+
+def split_statements(tokenlist, start):
+    '''Splits the tokens of a line, from the start index, into the colon 
+    separated statements to be parsed.  An IF statement takes the rest of 
+    the tokens, as colons after it separate the statements of its THEN or 
+    ELSE block, and an ELSE (other than in an OPEN statement) ends a THEN 
+    block.  Returns a list of (statement tokens, position), where the 
+    position is the index of an IF statement in the line, or None for 
+    other statements.
+    '''
+    
+    statements = []
+    statement = []
+    for index in range(start, len(tokenlist)):
+        token = tokenlist[index]
+        if token.cat == Token.IF:
+            # The IF statement begins where the current statement began
+            position = index - len(statement)
+            statements.append((tokenlist[position:], position))
+            return statements
         
-        if cat == Token.LOWER:
-            if not isinstance(value, str):
-                raise TypeError('Invalid type supplied to LOWER$ in line ' + \
-                        str(self.line_num))
-            
-            return value.lower()
+        elif token.cat == Token.COLON:
+            statements.append((statement, None))
+            statement = []
         
-        if cat == Token.TAB:
-            if isinstance(value, int):
-                return ' ' * value
-            
-            else:
-                raise TypeError('Invalid type supplied to TAB in line ' + \
-                        str(self.line_num))
+        elif token.cat == Token.ELSE and (len(statement) == 0 or 
+                statement[0].cat != Token.OPEN):
+            break
         
-        raise SyntaxError('Unrecognised function in line ' + \
-                str(self.line_num))
+        else:
+            statement.append(token)
+    
+    statements.append((statement, None))
+    return statements
+
 
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
@@ -2,6 +2,35 @@ from tokens import Token
 from scanner import Scanner
 from message import Msg
 from parser import Parser
+from compiler import Compiler
+from flowgraph import FlowGraph
+from debugger import Debugger
+from metrics import write_prometheus
+from memory import size_of, compact_size
+from functions import random_source
+from time import perf_counter
+from os import stat, cpu_count
+import gc
+from bisect import bisect_left, bisect_right
+from os.path import abspath
+from itertools import count, islice
+from concurrent.futures import ProcessPoolExecutor
+
+
+# The statements executed are added to the metrics in batches of at least
+# this many, at which point the metrics may be reported
+metrics_batch = 100000
+
+# Program files are read and tokenised in batches of this many lines, and
+# files of at least parallel_size bytes are tokenised by a pool of worker
+# processes when there is more than one processor
+batch_lines = 4096
+parallel_size = 1 << 20
+
+# Number of program files whose tokenised lines are kept, the most recently
+# used being kept, so that programs CHAINing back and forth between two 
+# segments do not tokenise them each time
+cached_segments = 2
 
 
 class BASICData:
@@ -108,12 +137,59 @@ class Program:
         self.return_stack = []   # Stack for subroutine returns
         self.return_loop = {}    # Dict for loop returns
         self.data = BASICData()  # Setup DATA store
+        self.code = {}           # Dict of compiled lines
+        self.exec_lines = []     # Line numbers needing execution
+        self.flow = FlowGraph()  # Control flow graph of the program
+        
+        # Kept between runs, so that unchanged lines need not be compiled
+        # again
+        self.parser = None
+        self.compiler = None
+        
+        # Position of each line in exec_lines
+        self.positions = {}
+        
+        # Handler for each type of message returned by a statement
+        self.msg_handlers = {
+            Msg.SIMPLE_JUMP: self.jump_handler,
+            Msg.GOSUB: self.gosub_handler,
+            Msg.RETURN: self.return_handler,
+            Msg.STOP: self.stop_handler,
+            Msg.LOOP_BEGIN: self.loop_begin_handler,
+            Msg.LOOP_SKIP: self.loop_skip_handler,
+            Msg.LOOP_REPEAT: self.loop_repeat_handler,
+            Msg.LOOP_EXIT: self.jump_past_handler,
+            Msg.JUMP_PAST: self.jump_past_handler,
+            }
+        
+        # Tokenised lines of the program files most recently read, by path,
+        # with the modification time of each file when read, least recently
+        # used first
+        self.segments = {}
+        
+        # Breakpoints, watched variables and tracing
+        self.debugger = Debugger(self)
+        
+        # Functions called with the metrics whenever they are collected, 
+        # which may add metrics of their own
+        self.metrics_hooks = []
+        
+        # File the metrics are written to in the Prometheus text format 
+        # while the program runs, at most every metrics_interval seconds
+        self.metrics_file = None
+        self.metrics_interval = 10.0
+        
+        # Whether to count the runs of each basic block of the program's 
+        # flow graph, given by the metrics as block_executions
+        self.profile_blocks = False
+        self.reset_metrics()
     
     
     def delete(self):
         '''Deletes the program by clearing dicts.'''
         self.program.clear()
         self.data.delete()
+        self.flow.clear()
     
     
     def load(self, file):
@@ -121,19 +197,118 @@ class Program:
         
         # Delete any existing program
         self.delete()
+        self.merge(file)
+    
+    
+    def merge(self, file):
+        '''Adds the lines of a program file to the program, replacing any
+        lines with the same numbers.
+        '''
+        
+        self.add_lines(self.segment(file))
+    
+    
+    def add_lines(self, tokenlists):
+        '''Adds tokenised lines to the program, as loaded from a file.'''
+        
+        # Tokens never form reference cycles, so the cyclic garbage collector
+        # is paused rather than let it repeatedly scan the growing program
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for tokenlist in tokenlists:
+                self.add_stmt(tokenlist)
+        
+        finally:
+            if collecting:
+                gc.enable()
+    
+    
+    def segment(self, file):
+        '''Returns the tokenised lines of a program file.  The lines of the
+        last few files read are kept, and a file among them is only read
+        and tokenised again if it has changed, so that programs split into
+        segments which CHAIN to each other only pay to load a segment the
+        first time it is run.  Only cached_segments files are kept, so that
+        the memory held does not grow with the number of files loaded.
+        '''
         
         if not file.lower().endswith('.bas'):
             file += '.bas'
+        collecting = gc.isenabled()
         try:
-            scanner = Scanner()
-            with open(file) as infile:
-                for line in infile:
-                    line = line.replace('\r', '').replace('\n', '').strip()
-                    tokenlist = scanner.tokenise(line)
-                    self.add_stmt(tokenlist)
+            path = abspath(file)
+            info = stat(path)
+            modified = info.st_mtime_ns
+            
+            segment = self.segments.pop(path, None)
+            if segment != None and segment[0] == modified:
+                self.segments[path] = segment  # Now most recently used
+                return segment[1]
+            
+            # Paused for the same reason as in add_lines
+            gc.disable()
+            
+            tokenlists = []
+            with open(path, buffering=1 << 20) as infile:
+                batches = iter(lambda: list(islice(infile, batch_lines)), [])
+                firsts = count(1, batch_lines)
+                if info.st_size >= parallel_size and \
+                        (cpu_count() or 1) > 1:
+                    with ProcessPoolExecutor() as executor:
+                        for batch in executor.map(scan_lines, batches,
+                                firsts):
+                            tokenlists.extend([Token(*fields)
+                                    for fields in fields_list]
+                                    for fields_list in batch)
+                else:
+                    for batch, first in zip(batches, firsts):
+                        tokenlists.extend(tokenise_lines(batch, first))
         
         except OSError:
             raise OSError('Could not read file')
+        
+        finally:
+            if collecting:
+                gc.enable()
+        
+        self.segments[path] = (modified, tokenlists)
+        while len(self.segments) > cached_segments:
+            del self.segments[next(iter(self.segments))]
+        
+        return tokenlists
+    
+    
+    def chain(self, file, verbose=False):
+        '''Replaces the program with the one in the given file, as done by
+        CHAIN, and compiles it ready to be run.  Only the variables named
+        in COMMON statements are kept.  Returns the compiler.
+        '''
+        
+        parser = self.parser
+        tokenlists = self.segment(file)
+        
+        symbol_table = parser.symbol_table
+        kept = {}
+        for name in parser.common:
+            for key in (name, name + '_array', name + '_map'):
+                if key in symbol_table:
+                    kept[key] = symbol_table[key]
+        
+        self.delete()
+        self.add_lines(tokenlists)
+        
+        symbol_table.clear()
+        symbol_table.update(kept)
+        parser.common.clear()
+        parser.user_functions.clear()
+        parser.data_values.clear()
+        parser.last_msg = None
+        self.data.restore(0)
+        self.return_stack.clear()
+        self.return_loop = {}
+        
+        return self.compile(verbose)
     
     
     def add_stmt(self, tokenlist):
@@ -153,6 +328,8 @@ class Program:
             
             except TypeError as err:
                 raise TypeError('Invalid line number: ' + str(err))
+            
+            self.flow.add_line(line_num, self.program[line_num])
     
     
     def del_stmt(self, line_num):
@@ -163,104 +340,120 @@ class Program:
             del self.program[line_num]
         except KeyError:
             raise KeyError('Line number does not exist')
+        
+        self.flow.remove_line(line_num)
     
     
     def list(self, start_line=None, end_line=None):
-        '''Lists the program.'''
+        '''Lists the program, or the lines from start_line to end_line.'''
         
-        line_nums = self.line_numbers()
-        if not start_line:
-            start_line = int(line_nums[0])
-        if not end_line:
-            end_line = int(line_nums[-1])
+        print(''.join(map(self.str_stmt, 
+                self.line_range(start_line, end_line))), end='')
+    
+    
+    def line_range(self, start_line=None, end_line=None):
+        '''Returns the sorted line numbers from start_line to end_line, 
+        found by bisecting the sorted line numbers rather than checking 
+        every line.  The range is open ended if either is omitted.
+        '''
         
-        for line_num in line_nums:
-            if int(line_num) >= start_line and int(line_num) <= end_line:
-                print(self.str_stmt(line_num), end='')
+        line_nums = self.flow.line_nums
+        start = bisect_left(line_nums, start_line) if start_line else 0
+        end = bisect_right(line_nums, end_line) if end_line else \
+                len(line_nums)
+        return line_nums[start:end]
     
     
-    def renum(self, start_num=None, step=None):
-        '''Renumbers the program.'''
+    def renum(self, start_num=None, step=None, first=None, last=None):
+        '''Renumbers the program, or only its lines from first to last,
+        changing the line numbers referred to by its statements to match.
+        Only the lines referring to renumbered lines are changed, found
+        from the flow graph's index of references.  Renumbered lines must
+        stay between the lines either side of them.
         
-        line_nums = self.line_numbers()
+        >>> program = Program()
+        >>> for line in ('5 OPEN "NOFILE.XYZ" FOR INPUT AS #1 ELSE GOTO 17',
+        ...         '7 OPEN "NOFILE.XYZ" FOR INPUT AS #1 ELSE 17', 
+        ...         '10 END', '17 GOTO 10'):
+        ...     program.add_stmt(Scanner().tokenise(line))
+        >>> program.renum(50, 10)
+        >>> print(program.str_stmt(50), end='')
+        50 OPEN "NOFILE.XYZ" FOR INPUT AS # 1 ELSE GOTO 80 
+        >>> print(program.str_stmt(60), end='')
+        60 OPEN "NOFILE.XYZ" FOR INPUT AS # 1 ELSE 80 
+        '''
+        
+        line_nums = self.line_range(first, last)
         if not start_num:
             start_num = 10
         if not step:
             step = 10
+        if len(line_nums) == 0:
+            return
         
         # Build correspondence table
         stop_num = start_num + len(line_nums) * step
         match = dict(zip(line_nums, range(start_num, stop_num, step)))
         
-        # Renumber program lines
-        new_prog = {}
-        for old_num, new_num in match.items():
-            new_prog[new_num] = self.program[old_num]
-        
-        # Replace program
-        self.program.clear()
-        self.program.update(new_prog)
+        flow = self.flow
+        start = bisect_left(flow.line_nums, line_nums[0])
+        end = start + len(line_nums)
+        if (start > 0 and flow.line_nums[start - 1] >= start_num) or \
+                (end < len(flow.line_nums) and 
+                flow.line_nums[end] <= stop_num - step):
+            raise ValueError('Renumbered lines would move past other lines')
         
-        # Change line content
-        line_nums = self.line_numbers()
+        # Change the referring lines.  Tokens are replaced rather than 
+        # changed, as they may be shared with the tokenised lines of a 
+        # program file
+        referring = set()
         for line_num in line_nums:
+            referring.update(flow.referrers.get(line_num, ()))
+        
+        for line_num in referring:
             statement = self.program[line_num]
-            if statement[0].cat in (Token.GOTO, Token.GOSUB, Token.RESTORE):
-                old = int(statement[1].val)
-                new = match[old]
-                statement[1].val = str(new)
-            
-            if statement[0].cat == Token.OPEN:
-                if statement[-2].cat == Token.ELSE:
-                    replace_line_num(statement[-1], match)
-            
-            if statement[0].cat == Token.ON:
-                pos = find_token(statement[1:], Token.GOTO, Token.GOSUB)
-                for token in statement[pos+2:]:
-                    if token.cat == Token.UNSIGNEDINT:
-                        replace_line_num(token, match)
-            
-            if statement[0].cat == Token.IF:
-                pos1 = find_token(statement[1:], Token.GOTO, Token.GOSUB)
-                if pos1 != -1:
-                    replace_line_num(statement[pos1+2], match)
-                # Repeat in case there is another in an ELSE clause
-                pos2 = find_token(statement[pos1+2:], Token.GOTO, Token.GOSUB)
-                if pos2 != -1:
-                    replace_line_num(statement[pos1+pos2+3], match)
-            
-            if statement[0].cat == Token.IF:
-                if statement[-2].cat in (Token.THEN, Token.ELSE):
-                    replace_line_num(statement[-1], match)
-            
-            if statement[0].cat == Token.IF:
-                pos = find_token(statement[1:], Token.THEN)
-                if pos + 3 < len(statement):
-                    if statement[pos+3].cat == Token.ELSE:
-                        replace_line_num(statement[pos+2], match)
+            for index, target in flow.flows[line_num].refs:
+                if target in match:
+                    token = statement[index]
+                    statement[index] = Token(token.pos, token.cat, 
+                            str(match[target]))
+        
+        flow.renumber(match)
+        
+        # Renumber program lines and DATA statements.  The lines are all 
+        # removed before any is added back, as renumbered lines may take 
+        # the numbers of other renumbered lines
+        statements = [(match[line_num], self.program.pop(line_num)) 
+                for line_num in line_nums]
+        self.program.update(statements)
+        
+        datastmts = self.data.datastmts
+        data = [(match[line_num], datastmts.pop(line_num)) 
+                for line_num in line_nums if line_num in datastmts]
+        datastmts.update(data)
+        
+        # Statements have been changed in place, so cannot be reused
+        if self.compiler != None:
+            self.compiler.cache.clear()
     
     
     def line_numbers(self):
-        '''Return a sorted list of all line numbers used in the program.'''
+        '''Return a sorted list of all line numbers used in the program.
+        The flow graph keeps them in order as lines are added and deleted.
+        '''
         
-        return sorted(self.program.keys())
+        return list(self.flow.line_nums)
     
     
     def str_stmt(self, line_num):
-        line_text = str(line_num) + " "
-        
         statement = self.program[line_num]
         if statement[0].cat == Token.DATA:
             statement = self.data.getTokens(line_num)
-        for token in statement:
-            # Add in quotes for strings
-            if token.cat == Token.STRING:
-                line_text += '"' + token.val + '" '
-            
-            else:
-                line_text += token.val + ' '
-        line_text += '\n'
-        return line_text
+        
+        # Add in quotes for strings
+        return str(line_num) + ' ' + ' '.join(['"' + token.val + '"' 
+                if token.cat == Token.STRING else token.val 
+                for token in statement]) + ' \n'
     
     
     def save(self, file):
@@ -270,211 +463,577 @@ class Program:
             file += '.bas'
         try:
             with open(file, 'w') as outfile:
-                outfile.write(str(self))
+                # Written a line at a time rather than as one string
+                outfile.writelines(map(self.str_stmt, self.flow.line_nums))
         
         except OSError:
             raise OSError("Could not save to file")
     
     
     def __str__(self):
-        program_text = ''
+        return ''.join(map(self.str_stmt, self.flow.line_nums))
+    
+    
+    def compile(self, verbose=False):
+        '''Compiles the program ready to be run, optimising it as it goes.
+        If verbose is set, the changes made by the optimisation are listed,
+        and the executions of superinstructions are counted.  Returns the
+        compiler.
+        '''
+        
+        compiler = self.compiler
+        compiler.begin(verbose)
+        
+        self.code.clear()
         line_nums = self.line_numbers()
         for line_num in line_nums:
-            program_text += self.str_stmt(line_num)
-        return program_text
+            self.code[line_num] = compiler.compile_line(line_num,
+                    self.program[line_num])
+        
+        if compiler.open_function != None:
+            raise SyntaxError('DEF FN without FNEND for ' + \
+                    compiler.open_function.name)
+        
+        if len(compiler.loops) > 0:
+            keyword, line_num, leave = compiler.loops[-1]
+            raise SyntaxError(Token.catnames[keyword] + ' without ' + \
+                    ('WEND' if keyword == Token.WHILE else 'LOOP') + \
+                    ' in line ' + str(line_num))
+        
+        if len(compiler.selects) > 0:
+            raise SyntaxError('SELECT CASE without END SELECT in line ' + \
+                    str(compiler.selects[-1].line_num))
+        
+        for line_num, target in self.flow.undefined():
+            raise SyntaxError('Undefined line number ' + str(target) + \
+                    ' in line ' + str(line_num))
+        
+        for function, lines in compiler.multiline_functions:
+            function.body = self.function_body(function.name, lines)
+        
+        self.exec_lines = compiler.reachable(line_nums, 
+                self.flow.reachable())
+        self.positions = positions_of(self.exec_lines)
+        
+        if verbose:
+            for note in compiler.report:
+                print(note)
+        
+        return compiler
     
     
-    def run(self):
+    def function_body(self, name, lines):
+        '''Returns a closure which runs the lines of a multi-line function
+        and returns the value assigned to the function name.  The state of
+        the statement that called the function is preserved.
+        '''
+        
+        parser = self.parser
+        symbol_table = parser.symbol_table
+        positions = positions_of(lines)
+        
+        def body():
+            saved = (self.next_stmt, self.return_loop, parser.last_msg,
+                    parser.line_num, parser.tokenlist, parser.tokenindex,
+                    parser.token, parser.sign)
+            
+            # Loops within the function are separate from those outside
+            self.return_loop = {}
+            parser.last_msg = None
+            
+            # The result is zero or empty unless assigned
+            symbol_table[name] = '' if name.endswith('$') else 0
+            
+            try:
+                if self.run_lines(lines, positions) != None:
+                    raise RuntimeError('CHAIN within function ' + name + \
+                            ' in line ' + str(self.next_stmt))
+                return symbol_table[name]
+            
+            finally:
+                (self.next_stmt, self.return_loop, parser.last_msg,
+                        parser.line_num, parser.tokenlist, parser.tokenindex,
+                        parser.token, parser.sign) = saved
+        
+        return body
+    
+    
+    def memory(self):
+        '''Returns the memory used by the program, in bytes, found by 
+        walking its storage with sys.getsizeof().  The dict gives the size 
+        of each simple variable, and the elements, size and, for numeric 
+        arrays held as lists, the size if held compactly as arrays of 
+        floating point numbers, of each array (named with ()) and map 
+        (named with {}), along with the totals for the variables, the 
+        program's tokens and its DATA statements.  Objects shared between 
+        them are only counted once.
+        '''
+        
+        seen = set()
+        variables = {}
+        arrays = {}
+        
+        symbol_table = self.parser.symbol_table if self.parser else {}
+        for key, value in symbol_table.items():
+            if key.endswith('_array'):
+                name = key[:-len('_array')]
+                rows = value.rows()
+                arrays[name + '()'] = {
+                    'elements': sum(map(len, rows)),
+                    'bytes': size_of(value, seen),
+                    'compact': compact_size(value) if 
+                        not name.endswith(('$', '%')) else None,
+                    }
+            elif key.endswith('_map'):
+                arrays[key[:-len('_map')] + '{}'] = {
+                    'elements': len(value),
+                    'bytes': size_of(value, seen),
+                    'compact': None,
+                    }
+            else:
+                variables[key] = size_of(value, seen)
+        
+        variables_total = sum(variables.values()) + \
+                sum(entry['bytes'] for entry in arrays.values())
+        program_total = size_of(self.program, seen)
+        data_total = size_of(self.data.datastmts, seen)
+        
+        return {
+            'variables': variables,
+            'arrays': arrays,
+            'variables_total': variables_total,
+            'program': program_total,
+            'data': data_total,
+            'total': variables_total + program_total + data_total,
+            }
+    
+    
+    def memory_report(self):
+        '''Prints the memory used by each variable, array and map, and the
+        totals for the variables, program and DATA statements.
+        '''
+        
+        memory = self.memory()
+        
+        print('Name                Elements     Bytes   Compact')
+        for name, size in sorted(memory['variables'].items()):
+            print(name.ljust(20) + str(size).rjust(18))
+        for name, entry in sorted(memory['arrays'].items()):
+            compact = entry['compact']
+            print(name.ljust(20) + str(entry['elements']).rjust(8) + \
+                    str(entry['bytes']).rjust(10) + \
+                    (str(compact).rjust(10) if compact != None else ''))
+        
+        print('Variables'.ljust(20) + str(memory['variables_total']).rjust(18))
+        print('Program'.ljust(20) + str(memory['program']).rjust(18))
+        print('DATA'.ljust(20) + str(memory['data']).rjust(18))
+        print('Total'.ljust(20) + str(memory['total']).rjust(18))
+    
+    
+    def superinstruction_report(self, compiler):
+        '''Prints the number of times each superinstruction was compiled
+        and executed.
+        '''
+        
+        print('Superinstruction      Compiled  Executed')
+        for name in compiler.compiled:
+            print(name.ljust(20) + str(compiler.compiled[name]).rjust(10) + \
+                    str(compiler.executed[name]).rjust(10))
+    
+    
+    def run(self, verbose=False):
         '''Run the program.'''
         
-        self.parser = Parser(self.data)
+        if len(self.program) == 0:
+            raise RuntimeError('No statements to execute')
+        
+        if self.parser == None:
+            self.parser = Parser(self.data)
+            self.compiler = Compiler(self.parser)
+        else:
+            self.parser.reset()
+        
         self.data.restore(0)  # reset data pointer
-        line_nums = self.line_numbers()
+        random_source.restore()
+        self.return_loop = {}
+        compiler = self.compile(verbose)
+        line_nums = self.exec_lines
         
-        if len(line_nums) > 0:
-            # Index into the ordered list of line numbers for sequential 
-            # statement execution.  The index is will be incremented by one, 
-            # unless modified by a jump
-            index = 0
-            self.next_stmt = line_nums[index]
-
-            # Run through the program until the last has line number 
-            # has been reached.
-            while True:
+        self.reset_metrics()
+        try:
+            msg = self.run_lines(line_nums, self.positions)
+            
+            # CHAIN runs another program from its start
+            while msg != None:
+                compiler = self.chain(msg.target, verbose)
                 
-                msg = self.execute(self.next_stmt)
-                self.parser.last_msg = msg
+                # The blocks counted are those of the program running
+                if self.runs != None:
+                    self.runs.clear()
+                msg = self.run_lines(self.exec_lines, self.positions)
+        
+        finally:
+            # Report even if the program stopped with an error
+            self.finished = perf_counter()
+            self.report_metrics(True)
+            if verbose:
+                self.superinstruction_report(compiler)
+    
+    
+    def reset_metrics(self):
+        '''Zeroes the counts kept for the metrics, as a run starts.'''
+        
+        self.statements = 0
+        self.jumps = [0] * len(Msg.typenames)  # By message type
+        self.max_gosub_depth = 0
+        
+        # If profiling blocks, the number of times each run of lines 
+        # between branches was executed, as (first position, last position),
+        # for each list of lines executed by run_lines, by its id
+        self.runs = {} if self.profile_blocks else None
+        self.started = perf_counter()
+        self.finished = None
+        self.metrics_written = self.started
+        if self.parser != None:
+            self.parser.reset_counts()
+    
+    
+    def metrics(self):
+        '''Returns a dict of counts of what the program did in its latest
+        run, or has done so far if it is running, after passing it to 
+        each of the metrics hooks.
+        '''
+        
+        run_time = (self.finished or perf_counter()) - self.started
+        parser = self.parser
+        metrics = {
+            'statements': self.statements,
+            'statements_per_second': 
+                    self.statements / run_time if run_time > 0 else 0.0,
+            'run_time_seconds': run_time,
+            'jumps': {Msg.typenames[type]: count 
+                    for type, count in enumerate(self.jumps) if count > 0},
+            'max_gosub_depth': self.max_gosub_depth,
+            'bytes_read': parser.bytes_read if parser else 0,
+            'bytes_written': parser.bytes_written if parser else 0,
+            'data_values_read': parser.data_values_read if parser else 0,
+            'arrays_allocated': parser.arrays_allocated if parser else 0,
+            }
+        if self.runs != None:
+            metrics['block_executions'] = self.block_executions()
+        
+        for hook in self.metrics_hooks:
+            hook(metrics)
+        
+        return metrics
+    
+    
+    def block_executions(self):
+        '''Returns the number of times each basic block of the program was
+        executed, by the number of its first line, found from the runs of
+        lines between branches counted by run_lines.  A block's count is 
+        that of its first line that is executed, as lines without 
+        executable statements are left out when compiling.
+        
+        >>> program = Program()
+        >>> for line in ('10 S = 0', '20 FOR I = 1 TO 5', '30 IF I > 3 THEN 50',
+        ...         '40 S = S + I', '50 NEXT I'):
+        ...     program.add_stmt(Scanner().tokenise(line))
+        >>> program.profile_blocks = True
+        >>> program.run()
+        >>> program.metrics()['block_executions']
+        {10: 1, 20: 6, 40: 3, 50: 5}
+        '''
+        
+        # Each run adds its count to the lines from its first position to
+        # its last, which are summed over the positions in one pass
+        line_counts = {}
+        for line_nums, runs in self.runs.values():
+            changes = [0] * (len(line_nums) + 1)
+            for (first, last), count in runs.items():
+                changes[first] += count
+                changes[last + 1] -= count
+            
+            total = 0
+            for line_num, change in zip(line_nums, changes):
+                total += change
+                line_counts[line_num] = line_counts.get(line_num, 0) + total
+        
+        counts = {}
+        line_nums = sorted(line_counts)
+        for first, last in self.flow.blocks():
+            index = bisect_left(line_nums, first)
+            if index < len(line_nums) and line_nums[index] <= last:
+                counts[first] = line_counts[line_nums[index]]
+        
+        return counts
+    
+    
+    def report_metrics(self, final=False):
+        '''Collects the metrics, passing them to the hooks, and writes them
+        to the metrics file if set, if metrics_interval seconds have passed
+        since they were last reported or the run has ended.
+        '''
+        
+        if self.metrics_file == None and len(self.metrics_hooks) == 0:
+            return
+        
+        now = perf_counter()
+        if final or now - self.metrics_written >= self.metrics_interval:
+            self.metrics_written = now
+            metrics = self.metrics()
+            if self.metrics_file != None:
+                write_prometheus(self.metrics_file, metrics)
+    
+    
+    def run_lines(self, line_nums, positions):
+        '''Executes the given lines, in order unless a statement branches,
+        until the last line has been executed or the program is stopped.
+        Used to run the program and the body of a multi-line function.
+        The position of each line in the list is given by the positions
+        dict.  Returns the message of a CHAIN statement, which ends
+        execution, or None.
+        '''
+        
+        if len(line_nums) == 0:
+            return None
+        
+        # Lines are only checked for breakpoints, watched variables and
+        # tracing while the debugger is in use
+        execute = self.execute
+        if self.debugger.active():
+            execute = self.debugger.instrument(execute)
+        
+        parser = self.parser
+        handlers = self.msg_handlers
+        jumps = self.jumps
+        
+        runs = None
+        if self.runs != None:
+            runs = self.runs.setdefault(id(line_nums), (line_nums, {}))[1]
+        batch = metrics_batch
+        end = len(line_nums)
+        
+        # Index into the ordered list of line numbers for sequential 
+        # statement execution.  The index is will be incremented by one, 
+        # unless modified by a jump
+        index = 0
+        
+        # The lines executed in order since the last branch are counted 
+        # when the next branch is made, from the position after it, rather
+        # than counting every line
+        executed = 0
+        start = 0
+        
+        # Run through the program until the last has line number 
+        # has been reached.
+        try:
+            while index < end:
+                self.next_stmt = line_nums[index]
+                
+                msg = execute(self.next_stmt)
+                parser.last_msg = msg
                 
                 if msg:
-                    if msg.type == Msg.SIMPLE_JUMP:
-                        # GOTO or conditional branch found
-                        try:
-                            index = line_nums.index(msg.target)
-                        
-                        except ValueError:
-                            raise RuntimeError('Invalid line number supplied \
-                                    in  GOTO or conditional branch: ' + \
-                                    str(msg.target))
-                        
-                        self.next_stmt = msg.target
-                    
-                    elif msg.type == Msg.GOSUB:
-                        # Subroutine call found
-                        # Push next line number onto stack
-                        if index + 1 < len(line_nums):
-                            self.return_stack.append(line_nums[index + 1])
-                        
-                        else:
-                            raise RuntimeError('GOSUB at end of program, \
-                                    nowhere to return')
-                        
-                        # Set the index to start of subroutine
-                        try:
-                            index = line_nums.index(msg.target)
-                        
-                        except ValueError:
-                            raise RuntimeError('Invalid line number supplied \
-                                    in subroutine call: ' + str(msg.target))
-                        
-                        self.next_stmt = msg.target
-                    
-                    elif msg.type == Msg.RETURN:
-                        # RETURN found
-                        # Pop return address from stack
-                        try:
-                            index = line_nums.index(self.return_stack.pop())
-                        
-                        except ValueError:
-                            raise RuntimeError('Invalid subroutine return in \
-                                    line ' + str(self.next_stmt))
-                        
-                        except IndexError:
-                            raise RuntimeError('RETURN encountered without \
-                                    matching subroutine call in line ' \
-                                    + str(self.next_stmt))
-                        
-                        self.next_stmt = line_nums[index]
-                    
-                    elif msg.type == Msg.STOP:
-                        break
-                    
-                    elif msg.type == Msg.LOOP_BEGIN:
-                        # Loop start found
-                        # Put loop line number on stack
-                        # so that loop repeat can return to it
-                        self.return_loop[msg.loop_var] = line_nums[index]
-                        
-                        # Continue to the next statement in the loop
+                    type = msg.type
+                    if type == Msg.CHAIN:
                         index += 1
-                        
-                        if index < len(line_nums):
-                            self.next_stmt = line_nums[index]
-                        
-                        else:
-                            # Reached end of program
-                            raise RuntimeError('Program terminated within a loop')
+                        return msg
                     
-                    elif msg.type == Msg.LOOP_SKIP:
-                        # Loop variable at final value
-                        # so move past matching NEXT statement
-                        index += 1
-                        while index < len(line_nums):
-                            next_line_num = line_nums[index]
-                            temp_tokenlist = self.program[next_line_num]
-                            
-                            if temp_tokenlist[0].cat == Token.NEXT and \
-                                    len(temp_tokenlist) > 1:
-                                # Check loop variable to ensure we have not 
-                                # found NEXT belonging to a nested loop
-                                if temp_tokenlist[1].val == msg.target:
-                                    # Move the statement after this NEXT, 
-                                    # if there is one
-                                    index += 1
-                                    if index < len(line_nums):
-                                        next_line_num = line_nums[index]
-                                        # This is statement after NEXT
-                                        self.next_stmt = next_line_num
-                                        break
-                            
-                            index += 1
-                        
-                        # Check whether at end of program
-                        if index >= len(line_nums):
-                            # Terminate the program
-                            break
+                    # The handler for the kind of message gives the position
+                    # of the next line to execute, or the end to stop
+                    next_index = handlers[type](msg, index, line_nums, 
+                            positions)
+                    jumps[type] += 1
+                    if runs != None:
+                        run = (start, index)
+                        runs[run] = runs.get(run, 0) + 1
+                    executed += index + 1 - start
+                    index = start = next_index
                     
-                    elif msg.type == Msg.LOOP_REPEAT:
-                        # Loop repeat found
-                        # Pop the loop start address from the stack
-                        try:
-                            index = line_nums.index(self.return_loop.pop(msg.loop_var))
-                        
-                        except ValueError:
-                            raise RuntimeError('Invalid loop exit in line ' \
-                                    + str(self.next_stmt))
-                        
-                        except KeyError:
-                            raise RuntimeError('NEXT encountered without \
-                                    matching FOR loop in line ' \
-                                    + str(self.next_stmt))
-                        
-                        self.next_stmt = line_nums[index]
+                    if executed >= batch:
+                        self.statements += executed
+                        executed = 0
+                        self.report_metrics()
                 
                 else:
                     index += 1
-                    if index < len(line_nums):
-                        self.next_stmt = line_nums[index]
-                    
-                    else:
-                        # At end of program
-                        break
+        
+        finally:
+            # A line that failed is not counted
+            self.statements += executed + index - start
+            if runs != None and index > start:
+                run = (start, index - 1)
+                runs[run] = runs.get(run, 0) + 1
+        
+        return None
+    
+    
+    def jump_handler(self, msg, index, line_nums, positions):
+        '''Handles a GOTO or conditional branch.'''
+        
+        try:
+            return positions[msg.target]
+        
+        except (KeyError, TypeError):
+            raise RuntimeError('Invalid line number supplied in GOTO or ' + \
+                    'conditional branch: ' + str(msg.target))
+    
+    
+    def gosub_handler(self, msg, index, line_nums, positions):
+        '''Handles a subroutine call, pushing the next line number onto 
+        the return stack.
+        '''
+        
+        return_stack = self.return_stack
+        if index + 1 < len(line_nums):
+            return_stack.append(line_nums[index + 1])
+            if len(return_stack) > self.max_gosub_depth:
+                self.max_gosub_depth = len(return_stack)
         
         else:
-            raise RuntimeError('No statements to execute')
+            raise RuntimeError('GOSUB at end of program, nowhere to return')
+        
+        try:
+            return positions[msg.target]
+        
+        except (KeyError, TypeError):
+            raise RuntimeError('Invalid line number supplied in ' + \
+                    'subroutine call: ' + str(msg.target))
+    
+    
+    def return_handler(self, msg, index, line_nums, positions):
+        '''Handles a RETURN, popping the return address from the stack.'''
+        
+        try:
+            return positions[self.return_stack.pop()]
+        
+        except KeyError:
+            raise RuntimeError('Invalid subroutine return in line ' + \
+                    str(self.next_stmt))
+        
+        except IndexError:
+            raise RuntimeError('RETURN encountered without matching ' + \
+                    'subroutine call in line ' + str(self.next_stmt))
+    
+    
+    def stop_handler(self, msg, index, line_nums, positions):
+        '''Handles STOP and END, ending execution.'''
+        
+        return len(line_nums)
+    
+    
+    def loop_begin_handler(self, msg, index, line_nums, positions):
+        '''Handles the start of a loop, recording its position so that 
+        the loop repeat can return to it, and continuing to the next 
+        statement in the loop.
+        '''
+        
+        self.return_loop[msg.loop_var] = index
+        
+        if index + 1 < len(line_nums):
+            return index + 1
+        
+        # Reached end of program
+        raise RuntimeError('Program terminated within a loop')
+    
+    
+    def loop_skip_handler(self, msg, index, line_nums, positions):
+        '''Handles a FOR loop whose variable is at its final value, moving 
+        past the matching NEXT statement, found by the flow graph.  The 
+        program ends if there is none.
+        '''
+        
+        next_line_num = self.flow.loop_end(self.next_stmt, msg.target)
+        return positions.get(next_line_num, len(line_nums)) + 1
+    
+    
+    def loop_repeat_handler(self, msg, index, line_nums, positions):
+        '''Handles a loop repeat, returning to the position of the loop 
+        start.
+        '''
+        
+        try:
+            return self.return_loop.pop(msg.loop_var)
+        
+        except KeyError:
+            if not isinstance(msg.loop_var, str):
+                raise RuntimeError('End of loop encountered without ' + \
+                        'matching WHILE or DO in line ' + str(self.next_stmt))
+            
+            raise RuntimeError('NEXT encountered without matching FOR ' + \
+                    'loop in line ' + str(self.next_stmt))
+    
+    
+    def jump_past_handler(self, msg, index, line_nums, positions):
+        '''Handles leaving a structured loop, because it has finished, and
+        branching within SELECT CASE, by moving past the target line.
+        '''
+        
+        if msg.type == Msg.LOOP_EXIT:
+            self.return_loop.pop(msg.loop_var, None)
+        
+        try:
+            return positions[msg.target] + 1
+        
+        except KeyError:
+            raise RuntimeError('Invalid branch in line ' + \
+                    str(self.next_stmt))
     
     
     def execute(self, line_num):
         ''' Execute the specified line.'''
         
-        if line_num not in self.program:
-            raise RuntimeError('Line number ' + line_num + ' does not exist')
-        
-        statement = self.program[line_num]
+        if line_num not in self.code:
+            raise RuntimeError('Line number ' + str(line_num) + \
+                    ' does not exist')
         
         try:
-            return self.parser.parse(line_num, statement)
+            return self.code[line_num]()
         
         except RuntimeError as err:
             raise RuntimeError(str(err))
 
 
-def replace_line_num(token, corresp):
-    '''Helper function for RENUM command.  
-    Replaces the value (val) of a token representing a line number given 
-    the original token and a correspondence tbale matching old line numbers 
-    to new in the form of a dict mappping ints to ints.  
-    Returns the changed token.
+def positions_of(line_nums):
+    '''Returns a dict giving the position of each line number in the list,
+    so that the target of a jump can be found without searching the list.
     '''
     
-    old = int(token.val)
-    if old not in corresp:
-        return token
-    new = corresp[old]
-    token.val = str(new)
-    return token
+    return {line_num: index for index, line_num in enumerate(line_nums)}
 
 
-def find_token(stmt, *cats):
-    '''Helper function for RENUM command.  
-    Finds the position of the first token in a statement (or part statement) 
-    whose category (cat) matches any of those supplied.
-    Return the index of the token or -1 if none found that match.
+def tokenise_lines(lines, first):
+    '''Returns the tokenised lines of a batch read from a program file,
+    where first is the position in the file of the first line (counting
+    from one), so that syntax errors give the line of the file they are in.
+    Batches may be tokenised by worker processes.
     '''
     
-    pos = -1
-    for ix in range(len(stmt)):
-        if stmt[ix].cat in cats:
-            pos = ix
-            break
-    return pos
+    scanner = Scanner()
+    tokenlists = []
+    for index, line in enumerate(lines):
+        line = line.replace('\r', '').replace('\n', '').strip()
+        try:
+            tokenlists.append(scanner.tokenise(line))
+        
+        except SyntaxError as err:
+            raise SyntaxError(str(err) + ' in line ' + str(first + index) +
+                              ' of the file')
+    
+    return tokenlists
+
+
+def scan_lines(lines, first):
+    '''Tokenises a batch of lines in a worker process, returning the
+    (position, category, value) of each token rather than the Token, as
+    these are several times quicker to send back to the main process.
+    '''
+    
+    return [[(token.pos, token.cat, token.val) for token in tokenlist]
+            for tokenlist in tokenise_lines(lines, first)]
+
 
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
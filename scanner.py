@@ -97,12 +97,21 @@ class Scanner:
                     if not ((c.isalpha() or c.isdigit()) or c == '_' or c == '$'):
                         break
                 
+                # A percent sign directly after a name makes it an integer 
+                # variable, e.g. I%, rather than the modulo operator
+                if c == '%' and not token.val.upper() in Token.keywords:
+                    token.val += c
+                    c = self.get_next_char()
+                
                 # Convert keywords and names to upper case
                 token.val = token.val.upper()
                 
                 # Is it a keyword or a variable name?
                 if token.val in Token.keywords:
                     token.cat = Token.keywords[token.val]
+                elif token.val.startswith('FN') and len(token.val) > 2:
+                    # Name of a user defined function
+                    token.cat = Token.FN
                 else:
                     token.cat = Token.NAME
                 
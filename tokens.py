@@ -91,6 +91,41 @@ class Token:
     LEFT           = 87  # LEFT$ function
     RIGHT          = 88  # RIGHT$ function
     RENUM          = 89  # RENUM command
+    DEF            = 90  # DEF keyword
+    FN             = 91  # User defined function name, e.g. FNA
+    FNEND          = 92  # FNEND keyword
+    CACHE          = 93  # CACHE keyword
+    WHILE          = 94  # WHILE keyword
+    WEND           = 95  # WEND keyword
+    DO             = 96  # DO keyword
+    LOOP           = 97  # LOOP keyword
+    UNTIL          = 98  # UNTIL keyword
+    SELECT         = 99  # SELECT keyword
+    CASE           = 100 # CASE keyword
+    LEFTBRACE      = 101 # '{'
+    RIGHTBRACE     = 102 # '}'
+    EXISTS         = 103 # EXISTS function
+    DELETE         = 104 # DELETE keyword
+    KEYS           = 105 # KEYS keyword
+    SORT           = 106 # SORT keyword
+    SEARCH         = 107 # SEARCH keyword
+    BY             = 108 # BY keyword
+    DESC           = 109 # DESC keyword
+    CHAIN          = 110 # CHAIN keyword
+    COMMON         = 111 # COMMON keyword
+    MERGE          = 112 # MERGE command
+    MAT            = 113 # MAT keyword
+    BREAK          = 114 # BREAK command
+    CONT           = 115 # CONT command
+    WATCH          = 116 # WATCH command
+    TRACE          = 117 # TRACE command
+    MEM            = 118 # MEM command
+    ERASE          = 119 # ERASE keyword
+    BSAVE          = 120 # BSAVE keyword
+    BLOAD          = 121 # BLOAD keyword
+    LINE           = 122 # LINE keyword
+    READCSV        = 123 # READCSV keyword
+    LEGACY         = 124 # LEGACY keyword
     
     
     # Printable names for each token
@@ -106,7 +141,12 @@ class Token:
         'TERNARY', 'VAL', 'LEN', 'UPPER', 'LOWER', 'ROUND', 'MAX', 'MIN', 
         'INSTR', 'AND', 'OR', 'NOT', 'PI', 'RNDINT', 'OPEN', 'HASH', 
         'CLOSE', 'FSEEK', 'RESTORE', 'APPEND', 'OUTPUT', 'TAB', 
-        'SEMICOLON', 'LEFT', 'RIGHT', 'RENUM')
+        'SEMICOLON', 'LEFT', 'RIGHT', 'RENUM', 'DEF', 'FN', 'FNEND', 
+        'CACHE', 'WHILE', 'WEND', 'DO', 'LOOP', 'UNTIL', 'SELECT', 'CASE', 
+        'LEFTBRACE', 'RIGHTBRACE', 'EXISTS', 'DELETE', 'KEYS', 'SORT', 
+        'SEARCH', 'BY', 'DESC', 'CHAIN', 'COMMON', 'MERGE', 
+        'MAT', 'BREAK', 'CONT', 'WATCH', 'TRACE', 'MEM', 'ERASE', 
+        'BSAVE', 'BLOAD', 'LINE', 'READCSV', 'LEGACY')
     
     
     smalltokens =  {
@@ -129,6 +169,8 @@ class Token:
         '!=': NOTEQUAL, 
         '#' : HASH, 
         ';' : SEMICOLON, 
+        '{' : LEFTBRACE, 
+        '}' : RIGHTBRACE, 
         }
     
     
@@ -202,13 +244,45 @@ class Token:
         'LEFT$'  : LEFT, 
         'RIGHT$' : RIGHT, 
         'RENUM'  : RENUM, 
+        'DEF'    : DEF, 
+        'FNEND'  : FNEND, 
+        'CACHE'  : CACHE, 
+        'WHILE'  : WHILE, 
+        'WEND'   : WEND, 
+        'DO'     : DO, 
+        'LOOP'   : LOOP, 
+        'UNTIL'  : UNTIL, 
+        'SELECT' : SELECT, 
+        'CASE'   : CASE, 
+        'EXISTS' : EXISTS, 
+        'DELETE' : DELETE, 
+        'KEYS'   : KEYS, 
+        'SORT'   : SORT, 
+        'SEARCH' : SEARCH, 
+        'BY'     : BY, 
+        'DESC'   : DESC, 
+        'CHAIN'  : CHAIN, 
+        'COMMON' : COMMON, 
+        'MERGE'  : MERGE, 
+        'MAT'    : MAT, 
+        'BREAK'  : BREAK, 
+        'CONT'   : CONT, 
+        'WATCH'  : WATCH, 
+        'TRACE'  : TRACE, 
+        'MEM'    : MEM, 
+        'ERASE'  : ERASE, 
+        'BSAVE'  : BSAVE, 
+        'BLOAD'  : BLOAD, 
+        'LINE'   : LINE, 
+        'READCSV': READCSV,
+        'LEGACY' : LEGACY, 
         }
     
     
     # Functions
     functions = (ABS, ATN, COS, EXP, INT, LOG, POW, RND, SIN, SQR, TAN, 
         CHR, ASC, MID, TERNARY, STR, VAL, LEN, UPPER, LOWER, ROUND, MAX, 
-        MIN, INSTR, PI, RNDINT, TAB, LEFT, RIGHT)
+        MIN, INSTR, PI, RNDINT, TAB, LEFT, RIGHT, EXISTS)
     
     
     def __init__(self, pos, cat, val):